@@ -1 +1 @@
-from .helpers import args_for_model, filter_model
+from .helpers import args_for_model, filter_model, filter_query, filter_criteria
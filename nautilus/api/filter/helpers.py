@@ -35,22 +35,38 @@ def args_for_model(Model):
     return fullArgs
 
 
-def filter_model(Model, args):
-
-    # convert any args referencing pk to the actual field
-    keys = [key.replace('pk', inspect(Model).primary_key[0].name) for key in args.keys()]
+def filter_criteria(Model, args):
+    """
+        Return the conditions a record of the given model has to meet to match
+        the given arguments (see args_for_model). Unknown arguments raise an
+        AttributeError.
+    """
+    # the name of the field the pk arguments refer to
+    primary_key = Model.model_metadata().primary_keys[0]
 
-    # start off with the full list of Models
-    models = Model.query
+    criteria = []
     # for each argument
-    for arg, value in zip(keys, args.values()):
+    for arg, value in args.items():
+        # if the filter is for a group of values, drop the _in suffix
+        field = arg[:-3] if isinstance(value, list) else arg
+        # convert any args referencing pk to the actual field
+        if field == 'pk':
+            field = primary_key
+
         # if the filter is for a group of values
         if isinstance(value, list):
-            # filter the query
-            models = models.filter(getattr(Model, arg[:-3]).in_(value))
+            criteria.append(getattr(Model, field).in_(value))
         else:
-            # filter the argument
-            models = models.filter(getattr(Model, arg) == value)
+            criteria.append(getattr(Model, field) == value)
+
+    return criteria
 
+
+def filter_query(Model, args):
+    """ Return the query for the records of the given model that match the arguments. """
+    return Model.query.filter(*filter_criteria(Model, args))
+
+
+def filter_model(Model, args):
     # return the filtered list
-    return models.all()
+    return filter_query(Model, args).all()
@@ -4,5 +4,7 @@
 from .types import *
 from .mixins import *
 from .base import BaseModel
+from .outbox import OutboxRelay
+from .idempotency import DatabaseIdempotencyStore
 from .util import *
 from .serializers import *
\ No newline at end of file
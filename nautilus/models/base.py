@@ -1,4 +1,7 @@
 # external imports
+import collections
+import operator
+import types
 from sqlalchemy.ext.declarative import declared_attr
 from flask.ext.jsontools import JsonSerializableBase
 from sqlalchemy.ext.declarative import declarative_base
@@ -23,6 +26,55 @@ class _Meta(type):
 
         return
 
+# the facts about a model's table that are needed to handle every action and
+# serialize every record. they are computed once per class (see BaseModel.onCreation)
+ModelMetadata = collections.namedtuple('ModelMetadata', [
+    # the names of the primary key columns
+    'primary_keys',
+    # the python type of the values of each primary key (None if it is unknown)
+    'primary_key_types',
+    # the names of the columns that can't be null
+    'required_fields',
+    # the columns of the table
+    'columns',
+    # the names of the columns of the table
+    'column_names',
+    # the sqlalchemy type of each column
+    'column_types',
+    # a function returning the values of the columns of a record, in order
+    'column_values',
+])
+
+
+def model_metadata(Model):
+    """ Compute the metadata record of the given mapped class. """
+    mapper = inspect(Model)
+    column_names = tuple(column.name for column in mapper.columns)
+    # attrgetter returns a single value (rather than a tuple) for a single name
+    getter = operator.attrgetter(*column_names)
+    column_values = getter if len(column_names) > 1 else lambda record: (getter(record),)
+
+    return ModelMetadata(
+        primary_keys=tuple(key.name for key in mapper.primary_key),
+        primary_key_types=types.MappingProxyType({
+            key.name: _python_type(key) for key in mapper.primary_key
+        }),
+        required_fields=tuple(column.name for column in mapper.columns if not column.nullable),
+        columns=mapper.columns,
+        column_names=column_names,
+        column_types=types.MappingProxyType({column.name: column.type for column in mapper.columns}),
+        column_values=column_values,
+    )
+
+
+def _python_type(column):
+    try:
+        return column.type.python_type
+    # some custom types don't say
+    except NotImplementedError:
+        return None
+
+
 class _MixedMeta(_Meta, type(db.Model)):
     """
         This meta class mixes the sqlalchemy model meta class and the nautilus one.
@@ -43,30 +95,42 @@ class BaseModel(db.Model, JsonBase, metaclass=_MixedMeta):
             setattr(self, key, value)
 
     def _json(self):
+        metadata = type(self).model_metadata()
         # build a dictionary out of just the columns in the table
-        return {
-            column.name: getattr(self, column.name) \
-                for column in type(self).columns()
-        }
-        
+        return dict(zip(metadata.column_names, metadata.column_values(self)))
+
+
+    @classmethod
+    def onCreation(cls):
+        # if the class is mapped to a table
+        if inspect(cls, raiseerr=False) is not None:
+            # figure out what we need to know about the table once
+            cls._model_metadata = model_metadata(cls)
 
     @classmethod
-    def onCreation(cls): pass
+    def model_metadata(cls):
+        """ Return the metadata record (see ModelMetadata) of the model. """
+        # note: a subclass doesn't share the record of the model it inherits from
+        metadata = cls.__dict__.get('_model_metadata')
+        # if the record wasn't computed when the class was created
+        if metadata is None:
+            metadata = cls._model_metadata = model_metadata(cls)
+        return metadata
 
     @classmethod
     def primary_keys(cls):
-        return [key.name for key in inspect(cls).primary_key]
+        return list(cls.model_metadata().primary_keys)
 
     @classmethod
     def requiredFields(cls):
-        return [key.name for key in inspect(cls).columns if not key.nullable]
+        return list(cls.model_metadata().required_fields)
 
     @classmethod
     def columns(cls):
-        return inspect(cls).columns
+        return cls.model_metadata().columns
 
     def primary_key(self):
-        return getattr(self, type(self).primary_keys()[0])
+        return getattr(self, type(self).model_metadata().primary_keys[0])
 
     def save(self):
         # add the entry to the db session
@@ -0,0 +1,129 @@
+"""
+    This module defines a persistent record of the actions a service has
+    handled, kept in the service's database. It backs the in-memory cache of a
+    consumer (see nautilus.network.idempotency) so duplicate actions are
+    recognized by every consumer process and survive a restart. Ids are only
+    kept for as long as an action could plausibly be delivered again.
+
+    The ids are recorded once the handler has returned, in a transaction of
+    their own. If the consumer dies between the handler's commit and that
+    one, the actions are delivered and handled again, so handlers still have
+    to cope with the occasional duplicate (delivery is at least once).
+"""
+
+# external imports
+import time
+from sqlalchemy import MetaData, Table, Column, Float, Text, select, and_
+from sqlalchemy.exc import IntegrityError
+# local imports
+from nautilus.db import db
+
+# the table is only created by the services that use the store (not by db.create_all)
+metadata = MetaData()
+
+# the ids of the actions handled by each service
+processed_actions_table = Table(
+    'nautilus_processed_actions',
+    metadata,
+    Column('service', Text, primary_key=True),
+    Column('message_id', Text, primary_key=True),
+    # when the action was handled (in seconds since the epoch)
+    Column('handled_at', Float, nullable=False, index=True),
+)
+
+
+class DatabaseIdempotencyStore:
+    """
+        This store records the ids of handled actions in the database of the
+        given app, creating its table the first time it is used. Every
+        `PRUNE_INTERVAL` seconds, recording new ids also removes the ones that
+        were recorded more than `retention` seconds ago.
+
+        Args:
+            app (flask.Flask): The app whose database holds the record.
+
+            service (str): The name of the service handling the actions.
+
+            retention (optional, number): The number of seconds to remember
+                an action for. Defaults to RETENTION (a week).
+    """
+    RETENTION = 7 * 24 * 60 * 60
+    PRUNE_INTERVAL = 60 * 60
+
+    def __init__(self, app, service, retention=None):
+        self._app = app
+        self._service = service
+        self._retention = retention or self.RETENTION
+        # when the old ids were last removed
+        self._pruned_at = None
+        # whether we know the table exists
+        self._created = False
+
+    def engine(self):
+        """ Return the engine of the app's database, making sure the table is there. """
+        engine = db.get_engine(self._app)
+        if not self._created:
+            processed_actions_table.create(engine, checkfirst=True)
+            self._created = True
+        return engine
+
+    def contains(self, message_id):
+        """ Return whether the action with the given id has been handled. """
+        return message_id in self.handled([message_id])
+
+    def handled(self, message_ids):
+        """ Return the set of the given ids whose actions have been handled. """
+        # if there is nothing to look up
+        if not message_ids:
+            return set()
+
+        engine = self.engine()
+        # look every id up at once
+        rows = engine.execute(
+            select([processed_actions_table.c.message_id]).where(and_(
+                processed_actions_table.c.service == self._service,
+                processed_actions_table.c.message_id.in_(list(message_ids)),
+            ))
+        )
+
+        return {row[0] for row in rows}
+
+    def add(self, message_ids):
+        """ Record that the actions with the given ids have been handled. """
+        engine = self.engine()
+        now = time.time()
+        rows = [
+            {'service': self._service, 'message_id': message_id, 'handled_at': now}
+            for message_id in message_ids
+        ]
+        try:
+            engine.execute(processed_actions_table.insert(), rows)
+        # if one of the actions was handled twice, record the others one at a time
+        except IntegrityError:
+            for row in rows:
+                try:
+                    engine.execute(processed_actions_table.insert(), row)
+                except IntegrityError:
+                    pass
+
+        # every so often, forget the actions that are too old to show up again
+        if self._pruned_at is None or now - self._pruned_at >= self.PRUNE_INTERVAL:
+            self.prune(now)
+
+    def prune(self, now=None):
+        """
+            Remove the ids that were recorded more than `retention` seconds ago.
+
+            Returns:
+                int: The number of ids that were removed.
+        """
+        now = now or time.time()
+        self._pruned_at = now
+
+        engine = self.engine()
+        result = engine.execute(processed_actions_table.delete().where(and_(
+            processed_actions_table.c.service == self._service,
+            processed_actions_table.c.handled_at < now - self._retention,
+        )))
+
+        return result.rowcount
@@ -1,27 +1,101 @@
 # external imports
 from sqlalchemy import event
+from sqlalchemy.orm import object_session, scoped_session
 # local imports
 from nautilus.network import dispatch_action
+from nautilus.conventions.models import get_model_string
+from ..outbox import write_to_outbox
+
+# where a session keeps the (action_type, payload) of the events to send once it commits
+PENDING_EVENTS = 'nautilus_pending_events'
+
+
+def listen_for_commits(session):
+    """
+        Send the events of the session once its transaction commits. Only the
+        sessions that emit events are listened to.
+    """
+    if not event.contains(session, 'after_commit', send_pending_events):
+        event.listen(session, 'after_commit', send_pending_events)
+        event.listen(session, 'after_transaction_end', drop_pending_events)
+
+
+def send_pending_events(session):
+    # a savepoint can still be rolled back along with the transaction around it
+    if session.transaction.nested:
+        return
+
+    for action_type, payload in session.info.pop(PENDING_EVENTS, []):
+        dispatch_action(action_type=action_type, payload=payload)
+
+
+def drop_pending_events(session, transaction):
+    # the events of a transaction that didn't commit are never sent
+    if transaction.parent is None:
+        session.info.pop(PENDING_EVENTS, None)
+
 
 class CRUDNotificationCreator:
     """
         This mixin class provides basic crus event publishing when the model
         is mutated, following nautilus conventions.
+
+        By default, events are published once the transaction that made the
+        mutation commits (and dropped if it rolls back). The first event a
+        session emits attaches the listeners that do this to that session
+        only. Models that set `use_outbox = True` write their events to the
+        outbox table in the same transaction instead, and the service's outbox relay
+        publishes them once the transaction has committed (see
+        nautilus.models.outbox).
     """
 
 
     nautilus_base = True # required to prevent self-application on creation
 
+    use_outbox = False
+
     @classmethod
     def add_listener(cls, db_event, action_type):
         # on event, dispatch the appropriate action
         @event.listens_for(cls, db_event)
         def dispatchCRUDAction(mapper, connection, target):
             """ notifies the network of the new user model """
-            dispatch_action(
-                action_type='{}_{}'.format(cls.__name__.lower(), type),
-                payload=target.__json__(),
+            cls.emit_crud_action(object_session(target), action_type, target.__json__())
+
+
+    @classmethod
+    def emit_crud_action(cls, session, action_type, payload):
+        """
+            Emit the event for a mutation of the model (eg, 'update_success').
+            Handlers that change records with bulk statements, which skip the
+            mapper events, call this themselves before the transaction commits.
+
+            Args:
+                session (sqlalchemy.orm.Session): The session making the change.
+
+                action_type (str): The type of the event, without the model.
+
+                payload (dict): The payload of the event.
+        """
+        # events are attached to the session of the current scope, not the registry
+        if isinstance(session, scoped_session):
+            session = session()
+
+        # the full type of the action to emit
+        full_action_type = '{}_{}'.format(get_model_string(cls), action_type)
+
+        # if the event should be relayed from the database
+        if cls.use_outbox:
+            # add the action to the outbox as part of the transaction
+            write_to_outbox(
+                session.connection(mapper=cls.__mapper__),
+                action_type=full_action_type,
+                payload=payload,
             )
+        # otherwise send the event once the transaction commits
+        else:
+            listen_for_commits(session)
+            session.info.setdefault(PENDING_EVENTS, []).append((full_action_type, payload))
 
 
     @classmethod
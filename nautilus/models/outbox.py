@@ -0,0 +1,202 @@
+"""
+    This module defines the outbox used to publish model events transactionally.
+    Rather than talking to the broker in the middle of a flush, models that use
+    the outbox write their events to a table in the same transaction as the
+    change itself. A relay running next to the service then drains the table
+    in batches. Events are only published if the transaction commits, and are
+    published at least once even if the broker is unavailable for a while.
+    Relays claim the actions they publish so several of them (one per service
+    instance or process) can drain the same outbox.
+"""
+
+# external imports
+import json
+import logging
+import threading
+import time
+import uuid
+from sqlalchemy import Table, Column, Float, Integer, Text, select, and_, or_
+# local imports
+from nautilus.db import db
+from nautilus.network import dispatch_action, flush_actions
+
+LOGGER = logging.getLogger(__name__)
+
+# the actions waiting to be published, in the order they were created
+outbox_table = Table(
+    'nautilus_action_outbox',
+    db.metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('action_type', Text, nullable=False),
+    Column('payload', Text, nullable=False),
+    # the action keeps its id if it has to be published again
+    Column('message_id', Text, nullable=False),
+    # the relay publishing the action and when it took it on
+    Column('claimed_by', Text),
+    Column('claimed_at', Float),
+)
+
+
+def write_to_outbox(connection, action_type, payload):
+    """
+        Add an action to the outbox using the given connection so that it is
+        part of the same transaction as whatever else the connection is doing.
+    """
+    connection.execute(
+        outbox_table.insert(),
+        action_type=action_type,
+        payload=json.dumps(payload),
+        message_id=uuid.uuid4().hex,
+    )
+
+
+class OutboxRelay:
+    """
+        This relay publishes the actions in the outbox on a background thread.
+        Each batch is claimed in a short transaction and published outside of
+        it, so no database connection or lock is held while the broker
+        confirms the actions. Actions are removed from the outbox once they
+        have been published (and confirmed, if the publisher waits for
+        confirmations); the rest of the batch is released for the next try.
+        If a relay goes away in the middle of a batch, other relays take it
+        over once its claim is `claim_timeout` seconds old.
+
+        Args:
+            app (flask.Flask): The app whose database holds the outbox.
+
+            batch_size (optional, int): The maximum number of actions to
+                publish at once.
+
+            interval (optional, number): The number of seconds to wait before
+                checking an empty outbox again.
+
+            claim_timeout (optional, number): The number of seconds after which
+                the actions claimed by a relay can be claimed by another one.
+    """
+    BATCH_SIZE = 500
+    INTERVAL = 0.1
+    CLAIM_TIMEOUT = 300
+
+    def __init__(self, app, batch_size=None, interval=None, claim_timeout=None):
+        self._app = app
+        self._batch_size = batch_size or self.BATCH_SIZE
+        self._interval = interval or self.INTERVAL
+        self._claim_timeout = claim_timeout or self.CLAIM_TIMEOUT
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Start relaying actions on a background thread. """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop relaying actions once the current batch has been published. """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def drain(self):
+        """
+            Publish one batch of actions from the outbox.
+
+            Returns:
+                int: The number of actions that were published.
+        """
+        engine = db.get_engine(self._app)
+        claim, rows = self.claim(engine)
+        # if there is nothing to publish
+        if not rows:
+            return 0
+
+        # the ids of the actions that made it to the broker
+        published = []
+        try:
+            # publish every action in the batch
+            confirmations = [
+                (row.id, dispatch_action(
+                    action_type=row.action_type,
+                    payload=json.loads(row.payload),
+                    message_id=row.message_id,
+                ))
+                for row in rows
+            ]
+            # make sure nothing is left in a buffer
+            flush_actions()
+            # if the publisher waits for confirmations, so do we
+            for row_id, confirmation in confirmations:
+                if confirmation is not None:
+                    try:
+                        confirmation.result()
+                    # if the broker didn't take the action, it stays in the outbox
+                    except Exception as err:
+                        LOGGER.warning('Could not publish action %s from the outbox: %s', row_id, err)
+                        continue
+                published.append(row_id)
+        finally:
+            with engine.begin() as connection:
+                # the actions have been published so we can forget about them
+                if published:
+                    connection.execute(
+                        outbox_table.delete().where(outbox_table.c.id.in_(published))
+                    )
+                # and the rest can be picked up again
+                connection.execute(
+                    outbox_table.update().where(outbox_table.c.claimed_by == claim)
+                                         .values(claimed_by=None, claimed_at=None)
+                )
+
+        return len(published)
+
+    def claim(self, engine):
+        """
+            Claim the oldest batch of actions nobody else is publishing.
+
+            Returns:
+                tuple: The id of the claim and the claimed rows, in order.
+        """
+        claim = uuid.uuid4().hex
+        now = time.time()
+        # the actions nobody has claimed (or whose relay has gone away)
+        available = or_(
+            outbox_table.c.claimed_at.is_(None),
+            outbox_table.c.claimed_at < now - self._claim_timeout,
+        )
+        with engine.begin() as connection:
+            ids = [
+                row.id for row in connection.execute(
+                    select([outbox_table.c.id]).where(available)
+                                               .order_by(outbox_table.c.id)
+                                               .limit(self._batch_size)
+                )
+            ]
+            if not ids:
+                return claim, []
+
+            # note: the condition is checked again in case another relay got there first
+            connection.execute(
+                outbox_table.update().where(and_(outbox_table.c.id.in_(ids), available))
+                                     .values(claimed_by=claim, claimed_at=now)
+            )
+            rows = connection.execute(
+                select([outbox_table]).where(outbox_table.c.claimed_by == claim)
+                                      .order_by(outbox_table.c.id)
+            ).fetchall()
+
+        return claim, rows
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                published = self.drain()
+            # if we couldn't publish the batch, it will be retried
+            except Exception:
+                LOGGER.exception('Could not relay actions from the outbox')
+                published = 0
+
+            # if the outbox is empty, give it a moment to fill up again
+            if published < self._batch_size:
+                self._stopped.wait(self._interval)
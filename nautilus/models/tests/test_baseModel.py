@@ -24,3 +24,25 @@ class TestUtil(unittest.TestCase):
 
 
 
+
+    def test_metadata_is_computed_when_the_class_is_created(self):
+        # external imports
+        from sqlalchemy import Column, Integer, Text
+        # local imports
+        from nautilus.models import BaseModel
+
+        class MetadataModel(BaseModel):
+            key = Column(Integer, primary_key=True)
+            name = Column(Text, nullable=False)
+            color = Column(Text)
+
+        assert '_model_metadata' in MetadataModel.__dict__, (
+            "Model metadata was not computed when the class was created."
+        )
+        metadata = MetadataModel.model_metadata()
+        assert metadata.primary_keys == ('key',) and metadata.primary_key_types['key'] is int
+        assert sorted(MetadataModel.requiredFields()) == ['key', 'name']
+        assert MetadataModel(key=1, name='foo')._json() == {'key': 1, 'name': 'foo', 'color': None}
+        # the record can't be changed by accident
+        with self.assertRaises(TypeError):
+            metadata.column_types['name'] = Integer()
@@ -0,0 +1,71 @@
+import unittest
+
+class TestIdempotencyStore(unittest.TestCase):
+
+    def setUp(self):
+        # external imports
+        from flask import Flask
+        # local imports
+        from nautilus.db import db
+
+        # create an app with an in-memory database
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        from nautilus.db import db
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_records_handled_actions_per_service(self):
+        # import the store to be tested
+        from nautilus.models import DatabaseIdempotencyStore
+
+        store = DatabaseIdempotencyStore(self.app, 'foo')
+        store.add(['a', 'b'])
+        # recording an action twice is harmless
+        store.add(['b', 'c'])
+
+        assert store.contains('a') and store.contains('c'), (
+            "Store did not record the handled actions."
+        )
+        assert not DatabaseIdempotencyStore(self.app, 'bar').contains('a'), (
+            "Store shared its record with another service."
+        )
+
+    def test_forgets_old_actions(self):
+        # external imports
+        import time
+        # import the store to be tested
+        from nautilus.models import DatabaseIdempotencyStore
+
+        store = DatabaseIdempotencyStore(self.app, 'foo', retention=60)
+        store.add(['a'])
+        store.add(['b'])
+
+        assert store.handled(['a', 'b', 'c']) == {'a', 'b'}
+        # a minute and a half later
+        assert store.prune(time.time() + 90) == 2, (
+            "Store did not remove the ids past their retention."
+        )
+        assert not store.contains('a')
+
+    def test_creates_its_table_only_when_used(self):
+        # external imports
+        from sqlalchemy import inspect
+        # local imports
+        from nautilus.db import db
+        from nautilus.models import DatabaseIdempotencyStore
+
+        engine = db.get_engine(self.app)
+        assert 'nautilus_processed_actions' not in inspect(engine).get_table_names(), (
+            "Every service created the table of the idempotency store."
+        )
+
+        DatabaseIdempotencyStore(self.app, 'foo').add(['a'])
+        assert 'nautilus_processed_actions' in inspect(engine).get_table_names()
@@ -0,0 +1,118 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+class TestOutbox(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # external imports
+        from sqlalchemy import Column, Text
+        # local imports
+        from nautilus.models import BaseModel, HasID, CRUDNotificationCreator
+
+        class OutboxModel(CRUDNotificationCreator, HasID, BaseModel):
+            use_outbox = True
+            name = Column(Text)
+
+        cls.Model = OutboxModel
+
+    def setUp(self):
+        # external imports
+        from flask import Flask
+        # local imports
+        from nautilus.db import db
+
+        # create an app with an in-memory database
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        from nautilus.db import db
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_events_are_written_to_the_outbox(self):
+        # local imports
+        from nautilus.db import db
+        from nautilus.models.outbox import outbox_table
+
+        with patch('nautilus.models.mixins.crudNotificationCreator.dispatch_action') as dispatch_mock:
+            # create a model and then roll back another one
+            self.Model(name='foo').save()
+            db.session.add(self.Model(name='bar'))
+            db.session.flush()
+            db.session.rollback()
+
+        rows = db.session.execute(outbox_table.select()).fetchall()
+
+        assert not dispatch_mock.called, (
+            "Outbox model published its event directly."
+        )
+        assert [row.action_type for row in rows] == ['outboxmodel_create_success'], (
+            "Outbox did not hold exactly the committed event."
+        )
+
+    def test_relay_drains_the_outbox(self):
+        # local imports
+        from nautilus.db import db
+        from nautilus.models.outbox import OutboxRelay, outbox_table
+
+        self.Model(name='foo').save()
+        self.Model(name='bar').save()
+
+        with patch('nautilus.models.outbox.dispatch_action', return_value=None) as dispatch_mock:
+            published = OutboxRelay(self.app).drain()
+
+        assert published == 2 and dispatch_mock.call_count == 2, (
+            "Relay did not publish every event in the outbox."
+        )
+        assert not db.session.execute(outbox_table.select()).fetchall(), (
+            "Relay did not clear the outbox."
+        )
+
+    def test_relays_claim_their_batches(self):
+        # local imports
+        from nautilus.db import db
+        from nautilus.models.outbox import OutboxRelay
+
+        self.Model(name='foo').save()
+        self.Model(name='bar').save()
+
+        # two relays drain the outbox at the same time
+        first, second = OutboxRelay(self.app, batch_size=2), OutboxRelay(self.app, batch_size=2)
+        first_claim, first_rows = first.claim(db.get_engine(self.app))
+        second_claim, second_rows = second.claim(db.get_engine(self.app))
+
+        assert len(first_rows) == 2 and not second_rows, (
+            "Relays claimed the same actions."
+        )
+
+    def test_relay_keeps_the_actions_it_could_not_publish(self):
+        # external imports
+        from concurrent.futures import Future
+        # local imports
+        from nautilus.db import db
+        from nautilus.models.outbox import OutboxRelay, outbox_table
+
+        self.Model(name='foo').save()
+        self.Model(name='bar').save()
+
+        # the broker takes the first action and not the second
+        confirmations = [Future(), Future()]
+        confirmations[0].set_result(True)
+        confirmations[1].set_exception(IOError('nacked'))
+        with patch('nautilus.models.outbox.dispatch_action', side_effect=confirmations):
+            published = OutboxRelay(self.app).drain()
+
+        rows = db.session.execute(outbox_table.select()).fetchall()
+        assert published == 1 and [row.id for row in rows] == [2], (
+            "Relay did not keep exactly the action the broker didn't take."
+        )
+        assert rows[0].claimed_by is None, (
+            "Relay did not release the action it could not publish."
+        )
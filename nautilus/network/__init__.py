@@ -1,9 +1,13 @@
 from .consumers import *
-from .dispatch import dispatch_action
+from .dispatch import dispatch_action, dispatch_action_async, flush_actions
+from .idempotency import IdempotencyCache
 from .util import (
     query_graphql_service,
     query_service,
     combine_action_handlers,
+    ActionRouter,
+    ActionsFailed,
+    batch_handler,
     query_api
 )
 from .actionHandlers import *
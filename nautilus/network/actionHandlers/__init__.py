@@ -5,3 +5,7 @@ from .deleteHandler import deleteHandler
 
 def noop_handler(action_type, payload):
     return
+
+# the noop handler isn't interested in any action
+noop_handler.action_types = []
+noop_handler.partition_fields = ()
@@ -1,5 +1,11 @@
+# external imports
+import logging
 # local imports
 from nautilus.conventions.actions import getCRUDAction
+from nautilus.network.util import batch_handler
+from .transaction import apply_actions
+
+LOGGER = logging.getLogger(__name__)
 
 def createHandler(Model):
     """
@@ -7,29 +13,63 @@ def createHandler(Model):
         the specified model when a create action is recieved, assuming the
         action follows nautilus convetions.
 
+        The handler takes batches (see nautilus.network.util.accepts_batches)
+        so the consumer gathers the create actions that arrive close together
+        and the handler writes them in a single transaction. If the transaction
+        fails, the records are written one at a time and only the actions that
+        still fail are raised (see nautilus.network.util.ActionsFailed).
+        Actions missing a required field are skipped. Models that emit events (see
+        nautilus.models.CRUDNotificationCreator) still emit a create_success
+        event for every record.
+
         Args:
             Model (nautilus.BaseModel): The model to create when the action
                 received.
 
         Returns:
-            function(action_type, payload): The action handler for this model
+            function(actions): The action handler for this model. It can also
+                be called with a single action (see
+                nautilus.network.util.batch_handler).
     """
-    def action_handler(action_type, payload):
-        # if the payload represents a new instance of `Model`
-        if action_type == getCRUDAction('create', Model):
-            # for each required field
-            for requirement in Model.requiredFields():
-                # ensure the value is in the payload
-                if not requirement in payload:
-                    print("Required field not found in payload: {}".format(requirement))
-                    # todo: check all required fields rather than failing on the first
-                    return
-
-            # create a new model
-            new_model = Model(**payload)
-
-            # save the new model instance
-            new_model.save()
+    # necessary imports
+    from nautilus.db import db
+
+    # the type of action the handler responds to
+    create_action = getCRUDAction('create', Model)
+    # the fields every new record needs
+    required_fields = frozenset(Model.model_metadata().required_fields)
+
+    @batch_handler
+    def action_handler(actions):
+        # the actions to create records for, along with their payloads
+        creates = []
+        for action in actions:
+            action_type, payload = action
+            # if the payload doesn't represent a new instance of `Model`
+            if action_type != create_action:
+                continue
+
+            # check the required fields all at once
+            missing = required_fields.difference(payload)
+            if missing:
+                LOGGER.warning("Required fields not found in payload: {}".format(
+                    ', '.join(sorted(missing))
+                ))
+                continue
+
+            creates.append((action, payload))
+
+        # save the new model instances together
+        apply_actions(create_records, creates)
+
+    def create_records(creates):
+        # create a new model for every payload
+        db.session.add_all([Model(**payload) for _, payload in creates])
+
+    # the handler only cares about one type of action
+    action_handler.action_types = [create_action]
+    # actions for the same record have to be handled in order
+    action_handler.partition_fields = Model.primary_keys()
 
     # return the handler
     return action_handler
@@ -1,24 +1,67 @@
+# external imports
+import itertools
+
 def CRUDHandler(Model):
     """
         This action handler factory reaturns an action handler that
         responds to actions with CRUD types (following nautilus conventions)
         and performs the necessary mutation on the model's database.
 
+        The handler takes batches and keeps them in the order they arrived:
+        each run of consecutive actions of the same type is passed to the
+        matching handler (see createHandler, updateHandler and deleteHandler)
+        before the next run, so a record that is deleted and created again
+        within a batch ends up created. Runs that only partly fail don't stop
+        the rest of the batch (see nautilus.network.util.ActionsFailed).
+
         Args:
             Model (nautilus.BaseModel): The model to delete when the action
                 received.
 
         Returns:
-            function(type, payload): The action handler for this model
+            function(actions): The action handler for this model. It can also
+                be called with a single action (see
+                nautilus.network.util.batch_handler).
     """
 
     # import the necessary modules
-    from nautilus.network import combine_action_handlers
+    from nautilus.network.util import ActionsFailed, batch_handler, multi_record_types_for
     from . import updateHandler, createHandler, deleteHandler
 
-    # combine them into one handler
-    return combine_action_handlers(
-        updateHandler(Model),
-        createHandler(Model),
-        deleteHandler(Model),
-    )
+    # the handler for each type of action
+    handlers = {}
+    # the types of actions that can apply to several records
+    multi_record_types = set()
+    for handler in (createHandler(Model), updateHandler(Model), deleteHandler(Model)):
+        for action_type in handler.action_types:
+            handlers[action_type] = handler
+        multi_record_types.update(multi_record_types_for(handler))
+
+    @batch_handler
+    def action_handler(actions):
+        # the actions the handlers failed to handle
+        failures = []
+        # go over the runs of actions with the same type, in order
+        for action_type, run in itertools.groupby(actions, key=lambda action: action[0]):
+            # if the actions aren't for this model
+            if action_type not in handlers:
+                continue
+
+            try:
+                handlers[action_type](list(run))
+            # if only some of the actions failed, keep going with the rest of the batch
+            except ActionsFailed as err:
+                failures.extend(err.failures)
+
+        if failures:
+            raise ActionsFailed(failures)
+
+    # the handler only cares about the model's actions
+    action_handler.action_types = list(handlers)
+    # actions for the same record have to be handled in order
+    action_handler.partition_fields = Model.primary_keys()
+    # and some of them can apply to several records
+    action_handler.multi_record_types = frozenset(multi_record_types)
+
+    # return the handler
+    return action_handler
@@ -1,47 +1,183 @@
+# external imports
+import logging
+from sqlalchemy import select, and_, or_
 # local imports
 from nautilus.conventions.actions import getCRUDAction
+from nautilus.network.util import batch_handler
+from .transaction import apply_actions
 
-def deleteHandler(Model):
+LOGGER = logging.getLogger(__name__)
+
+# the maximum number of records removed by a single statement
+CHUNK_SIZE = 500
+
+def deleteHandler(Model, chunk_size=None):
     """
         This factory returns an action handler that deletes a new instance of
         the specified model when a delete action is recieved, assuming the
         action follows nautilus convetions.
 
+        The payload of a delete action is either the primary key of the record
+        to remove, a list of primary keys, or a dictionary of filters like the
+        arguments of the model's API (see nautilus.api.filter.args_for_model).
+        Records of models with a composite primary key are identified by a
+        dictionary with every field of the key (or a list of them).
+        The records targeted by a batch of actions are removed with one
+        `DELETE ... WHERE <primary key> IN (...)` statement per chunk of
+        records and the batch is committed together. If the transaction fails,
+        the actions are applied one at a time and only the ones that still fail
+        are raised (see nautilus.network.util.ActionsFailed). Models that emit events
+        (see nautilus.models.CRUDNotificationCreator) emit a delete_success
+        event for every record that was removed.
+
+        Since lists and filters can remove any number of records, deletes are
+        declared as multi-record actions (see
+        nautilus.network.util.multi_record_types_for) so concurrent consumers
+        don't run them alongside other actions for the same records.
+
         Args:
             Model (nautilus.BaseModel): The model to delete when the action
                 received.
 
+            chunk_size (optional, int): The maximum number of records removed
+                by a single statement. Defaults to CHUNK_SIZE.
+
         Returns:
-            function(type, payload): The action handler for this model
+            function(actions): The action handler for this model. It can also
+                be called with a single action (see
+                nautilus.network.util.batch_handler).
     """
     # necessary imports
     from nautilus.db import db
+    from nautilus.api.filter import filter_criteria
+
+    # the type of action the handler responds to
+    delete_action = getCRUDAction('delete', Model)
+    # the table holding the records
+    table = Model.__table__
+    # what we know about the columns of the table
+    metadata = Model.model_metadata()
+    # the columns identifying the records
+    primary_keys = tuple(table.c[key] for key in metadata.primary_keys)
+    # the number of records removed at once
+    chunk_size = chunk_size or CHUNK_SIZE
+
+    @batch_handler
+    def action_handler(actions):
+        # the actions that remove records, along with the primary keys of the records
+        deletes = []
+        for action in actions:
+            action_type, payload = action
+            # if the payload represents a new instance of `model`
+            if action_type == delete_action:
+                keys = record_keys(payload)
+                # if there is something to remove
+                if keys:
+                    deletes.append((action, keys))
+
+        # remove the records together
+        apply_actions(remove_records, deletes)
+
+    def remove_records(deletes):
+        # the first time a record is removed is the only one that counts
+        keys = list(dict.fromkeys(key for _, action_keys in deletes for key in action_keys))
+
+        for start in range(0, len(keys), chunk_size):
+            delete_records(keys[start:start + chunk_size])
+
+    def record_keys(payload):
+        """ Return the primary keys (as tuples) of the records the payload refers to. """
+        # if the payload is a set of filters
+        if isinstance(payload, dict) and not identifies_record(payload):
+            try:
+                criteria = filter_criteria(Model, payload)
+            # if we don't know how to filter on one of the fields
+            except AttributeError as err:
+                LOGGER.warning("Could not filter records to delete: {}".format(err))
+                return []
+            # if there would be nothing to filter on, there is nothing to remove
+            if not criteria:
+                return []
+
+            return [
+                tuple(row) for row in
+                db.session.execute(select(list(primary_keys)).where(and_(*criteria)))
+            ]
+
+        # if the payload is a single record
+        if not isinstance(payload, list):
+            payload = [payload]
+
+        keys = []
+        for record in payload:
+            key = parse_key(record)
+            # we couldn't read the key so its not the right one. don't do anything
+            if key is None:
+                LOGGER.warning("Could not read the primary key of delete: {}".format(record))
+            else:
+                keys.append(key)
+
+        return keys
+
+    def identifies_record(payload):
+        """ Return whether the dictionary holds exactly the composite primary key of a record. """
+        return len(primary_keys) > 1 and set(payload) == set(metadata.primary_keys)
+
+    def parse_key(record):
+        """ Return the primary key the record refers to as a tuple, or None if we can't tell. """
+        # records of models with a composite key are identified by every field of the key
+        if len(primary_keys) > 1:
+            if not isinstance(record, dict) or not identifies_record(record):
+                return None
+            values = [record[column.name] for column in primary_keys]
+        else:
+            values = [record]
+
+        key = []
+        for column, value in zip(primary_keys, values):
+            # note: the payload is casted to the same type as the key for equality checks
+            key_type = metadata.primary_key_types[column.name]
+            try:
+                key.append(key_type(value) if key_type else value)
+            except (TypeError, ValueError):
+                return None
+
+        return tuple(key)
+
+    def matching(keys):
+        """ Return the clause matching the records with the given primary keys. """
+        # if a single column identifies the records
+        if len(primary_keys) == 1:
+            return primary_keys[0].in_([key for key, in keys])
+
+        return or_(*[
+            and_(*[column == value for column, value in zip(primary_keys, key)])
+            for key in keys
+        ])
+
+    def delete_records(keys):
+        # if the model emits events
+        if hasattr(Model, 'emit_crud_action'):
+            # hold on to the records so the events can describe them
+            records = [
+                dict(row.items()) for row in
+                db.session.execute(select([table]).where(matching(keys)))
+            ]
+        else:
+            records = []
+
+        # remove the records
+        db.session.execute(table.delete().where(matching(keys)))
 
-    def action_handler(action_type, payload):
-        # if the payload represents a new instance of `model`
-        if action_type == getCRUDAction('delete', Model):
-
-            # for now only handle a single selector specified by a string
-            if not isinstance(payload, str):
-                return
-
-            # go over each primary key
-            for key in Model.primary_keys():
-                # find the model with the matching primary key
-                # the primary key field
-                primaryKey = getattr(Model, key)
-                try:
-                    # note: the payload is casted to the same type as the key for equality checks
-                    model = Model.query.filter(primaryKey == type(primaryKey)(payload))
-                except TypeError:
-                    # we couldn't cast the key so its not the right one. don't do anything
-                    pass
-
-                # remove the model from the databaes
-                # todo: move this inside base model? Can a model remove itself?
-                db.session.delete(model)
-                db.session.commit()
+        for record in records:
+            Model.emit_crud_action(db.session, 'delete_success', record)
 
+    # the handler only cares about one type of action
+    action_handler.action_types = [delete_action]
+    # actions for the same record have to be handled in order
+    action_handler.partition_fields = Model.primary_keys()
+    # a delete can remove any number of records
+    action_handler.multi_record_types = [delete_action]
 
     # return the handler
     return action_handler
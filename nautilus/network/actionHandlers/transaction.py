@@ -0,0 +1,58 @@
+# external imports
+import logging
+# local imports
+from nautilus.network.util import ActionsFailed
+
+LOGGER = logging.getLogger(__name__)
+
+def apply_actions(apply, actions):
+    """
+        Write the given actions to the database in a single transaction. If
+        that fails, each action is written again in a transaction of its own
+        so one bad record doesn't keep the rest of the batch from being saved.
+
+        Args:
+            apply (function): Makes the changes for a list of actions without
+                committing them.
+
+            actions (list): The (action, change) pairs to write, where action is
+                the (action_type, payload) tuple the handler was given and change
+                is whatever `apply` needs to write it.
+
+        Raises:
+            nautilus.network.util.ActionsFailed: With the actions that could
+                not be written on their own.
+    """
+    # necessary imports
+    from nautilus.db import db
+
+    # if there is nothing to write
+    if not actions:
+        return
+
+    try:
+        apply(actions)
+        db.session.commit()
+        return
+    # if the batch couldn't be written, none of it was
+    except Exception as err:
+        db.session.rollback()
+        # a single action would fail the same way again
+        if len(actions) == 1:
+            raise ActionsFailed([(actions[0][0], err)])
+        LOGGER.warning("Could not write a batch of {} actions, writing them one at a time: {}".format(
+            len(actions), err
+        ))
+
+    # the actions that failed on their own
+    failures = []
+    for action in actions:
+        try:
+            apply([action])
+            db.session.commit()
+        except Exception as err:
+            db.session.rollback()
+            failures.append((action[0], err))
+
+    if failures:
+        raise ActionsFailed(failures)
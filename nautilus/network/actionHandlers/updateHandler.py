@@ -1,5 +1,12 @@
+# external imports
+import logging
+from sqlalchemy import bindparam, select
 # local imports
 from nautilus.conventions.actions import getCRUDAction
+from nautilus.network.util import batch_handler
+from .transaction import apply_actions
+
+LOGGER = logging.getLogger(__name__)
 
 def updateHandler(Model):
     """
@@ -7,49 +14,150 @@ def updateHandler(Model):
         the specified model when a update action is recieved, assuming the
         action follows nautilus convetions.
 
+        Each record is changed with a single `UPDATE ... WHERE <primary key> = ?`
+        statement without loading it first. Consecutive actions in a batch that
+        change the same columns share one statement (executed with every set of
+        parameters at once) and the whole batch is committed together. If the
+        transaction fails, the updates are written one at a time and only the
+        actions that still fail are raised (see
+        nautilus.network.util.ActionsFailed). Models
+        that emit events (see nautilus.models.CRUDNotificationCreator) emit an
+        update_success event with the primary key and changed columns of every
+        record that was updated.
+
         Args:
             Model (nautilus.BaseModel): The model to update when the action
                 received.
 
         Returns:
-            function(type, payload): The action handler for this model
+            function(actions): The action handler for this model. It can also
+                be called with a single action (see
+                nautilus.network.util.batch_handler).
     """
-    def action_handler(action_type, payload):
-        # if the payload represents a new instance of `Model`
-        if action_type == getCRUDAction('update', Model):
-
-            # go over each primary key
-            for key in Model.primary_keys():
-                # if the key is in the payload
-                if key in payload:
-                    # then we can use it to identify the model we are editing
-
-                    # figure out the primary key field
-                    primary_key_field = getattr(Model, key)
-
-                    # note: the payload is casted to the same type as the key for equality checks
-                    # todo: add pk filter
-                    try:
-                        model = Model.query.filter(
-                            primary_key_field == type(primary_key_field)(payload[key])
-                        )
-                    # if we couldn't cast the key
-                    except TypeError:
-                        pass
-
-                    # remove the key from the payload
-                    payload.pop(key, None)
-
-                    # for every key,value pair
-                    for key, value in payload.items():
-                        # update the model's attribute
-                        setattr(model, key, value)
-
-                    # save the updates
-                    model.save()
-
-                    # don't look for any more identifiers
-                    break
+    # necessary imports
+    from nautilus.db import db
+
+    # the type of action the handler responds to
+    update_action = getCRUDAction('update', Model)
+    # the table holding the records
+    table = Model.__table__
+    # what we know about the columns of the table
+    metadata = Model.model_metadata()
+    column_names = frozenset(metadata.column_names)
+
+    # the statement updating a record, by the primary key identifying it. the
+    # columns to change are taken from the parameters the statement is executed with
+    statements = {
+        key: table.update().where(table.c[key] == bindparam('_' + key))
+        for key in metadata.primary_keys
+    }
+
+    @batch_handler
+    def action_handler(actions):
+        # the actions to apply, along with the update they describe
+        updates = []
+        for action in actions:
+            action_type, payload = action
+            # if the payload doesn't describe an update to `Model`
+            if action_type != update_action:
+                continue
+
+            update = parse_update(payload)
+            # if we couldn't tell what to update
+            if update is None:
+                continue
+
+            updates.append((action, update))
+
+        # write the updates together
+        apply_actions(update_records, updates)
+
+    def update_records(updates):
+        # the runs of consecutive updates that change the same columns, as
+        # (primary key, columns, [(primary key value, changes)])
+        groups = []
+        for _, (key, value, changes) in updates:
+            columns = tuple(sorted(changes))
+            # if the update changes the same columns as the one before
+            if groups and groups[-1][:2] == (key, columns):
+                groups[-1][2].append((value, changes))
+            else:
+                groups.append((key, columns, [(value, changes)]))
+
+        for key, _, group in groups:
+            # update every record in the group with one statement
+            db.session.execute(statements[key], [
+                dict(changes, **{'_' + key: value}) for value, changes in group
+            ])
+            # only emit events for the records that exist
+            emit_events(key, group)
+
+    def parse_update(payload):
+        """ Return the primary key, its value and the changes the payload describes. """
+        # the payload has to be a dictionary
+        if not isinstance(payload, dict):
+            LOGGER.warning("Encountered invalid update: {}".format(payload))
+            return None
+
+        # go over each primary key
+        for key in metadata.primary_keys:
+            # if the key is in the payload
+            if key in payload:
+                # then we can use it to identify the model we are editing
+                break
+        else:
+            LOGGER.warning("Update does not identify a record: {}".format(payload))
+            return None
+
+        # note: the payload is casted to the same type as the key for equality checks
+        key_type = metadata.primary_key_types[key]
+        try:
+            value = key_type(payload[key]) if key_type else payload[key]
+        # if we couldn't cast the key
+        except (TypeError, ValueError):
+            LOGGER.warning("Could not read the primary key of update: {}".format(payload))
+            return None
+
+        # the columns to change
+        changes = {
+            column: column_value for column, column_value in payload.items()
+            if column != key and column in column_names
+        }
+        # if there are fields that aren't columns
+        if len(changes) < len(payload) - 1:
+            LOGGER.warning("Ignoring unknown fields in update: {}".format(
+                ', '.join(sorted(set(payload) - set(changes) - {key}))
+            ))
+        # if nothing would change
+        if not changes:
+            return None
+
+        return key, value, changes
+
+    def emit_events(key, updates):
+        # if the model doesn't emit events
+        if not hasattr(Model, 'emit_crud_action'):
+            return
+
+        # find out which of the records exist
+        # note: drivers don't agree on the row count of a statement executed with
+        # several sets of parameters, so it can't tell us
+        values = [value for value, _ in updates]
+        existing = {
+            row[0] for row in db.session.execute(
+                select([table.c[key]]).where(table.c[key].in_(values))
+            )
+        }
+
+        for value, changes in updates:
+            if value not in existing:
+                continue
+            Model.emit_crud_action(db.session, 'update_success', dict(changes, **{key: value}))
+
+    # the handler only cares about one type of action
+    action_handler.action_types = [update_action]
+    # actions for the same record have to be handled in order
+    action_handler.partition_fields = Model.primary_keys()
 
     # return the handler
     return action_handler
@@ -0,0 +1,153 @@
+"""
+    This module defines the codecs used to turn actions into message bodies and
+    back. The codec used for a message is named by its AMQP content_type so
+    services can read messages from publishers that use a different codec.
+    Messages without a content_type are assumed to be JSON.
+
+    Large bodies can also be compressed, in which case the compression is named
+    by the content_encoding of the message.
+"""
+
+# external imports
+import json
+import threading
+import zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONCodec:
+    """ Encodes actions as utf-8 JSON. Every service understands this codec. """
+
+    content_type = 'application/json'
+
+    def encode(self, data):
+        return json.dumps(data).encode('utf-8')
+
+    def decode(self, body):
+        return json.loads(body.decode('utf-8'))
+
+
+class MsgPackCodec:
+    """ Encodes actions with msgpack, which is smaller and faster than JSON. """
+
+    content_type = 'application/msgpack'
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, body):
+        return msgpack.unpackb(body, raw=False)
+
+
+# the codecs this process understands, by content type
+_codecs = {}
+
+# the codec used when a message does not say how it was encoded
+DEFAULT_CONTENT_TYPE = JSONCodec.content_type
+
+
+def register_codec(codec):
+    """ Teach the current process how to read and write the given codec's content type. """
+    _codecs[codec.content_type] = codec
+
+
+def get_codec(content_type=None):
+    """
+        Return the codec for the given content type.
+
+        Args:
+            content_type (optional, str): The content type of the message. If
+                None, the default (JSON) codec is returned.
+
+        Raises:
+            ValueError: If there is no codec for the content type.
+    """
+    try:
+        return _codecs[content_type or DEFAULT_CONTENT_TYPE]
+    except KeyError:
+        raise ValueError("No codec registered for content type: {}".format(content_type))
+
+
+class CompressionStats:
+    """ Keeps track of how much space compression has saved the current process. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    def record(self, raw_size, compressed_size):
+        with self._lock:
+            self.messages += 1
+            self.raw_bytes += raw_size
+            self.compressed_bytes += compressed_size
+
+    @property
+    def ratio(self):
+        """ The size of the compressed bodies relative to the original ones. """
+        return self.compressed_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'messages': self.messages,
+                'raw_bytes': self.raw_bytes,
+                'compressed_bytes': self.compressed_bytes,
+                'ratio': self.ratio,
+            }
+
+
+# the compression applied to messages published by this process
+compression_stats = CompressionStats()
+
+# the compression schemes this process understands, by content encoding
+_encodings = {}
+
+# the compression used for large messages
+DEFAULT_CONTENT_ENCODING = 'zlib'
+
+
+def register_encoding(content_encoding, compress, decompress):
+    """ Teach the current process how to compress and decompress the given content encoding. """
+    _encodings[content_encoding] = (compress, decompress)
+
+
+def compress(body, content_encoding=DEFAULT_CONTENT_ENCODING):
+    """
+        Compress the given message body.
+
+        Returns:
+            bytes: The compressed body, or None if compressing did not make
+                the body any smaller.
+    """
+    compressed = _encodings[content_encoding][0](body)
+    compression_stats.record(len(body), len(compressed))
+    # only bother with the compressed body if it's worth it
+    return compressed if len(compressed) < len(body) else None
+
+
+def decompress(body, content_encoding):
+    """
+        Decompress the given message body.
+
+        Raises:
+            ValueError: If there is no way to decompress the content encoding.
+    """
+    try:
+        decompressor = _encodings[content_encoding][1]
+    except KeyError:
+        raise ValueError("No decompressor registered for content encoding: {}".format(content_encoding))
+
+    return decompressor(body)
+
+
+register_codec(JSONCodec())
+# msgpack is optional
+if msgpack:
+    register_codec(MsgPackCodec())
+
+register_encoding('zlib', zlib.compress, zlib.decompress)
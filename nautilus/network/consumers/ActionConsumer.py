@@ -1,41 +1,655 @@
 # external imports
-import json
+import collections
+import functools
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pika
 # local imports
-from . import BasicConsumer
+from . import BasicConsumer, PartitionedExecutor
+from ..codecs import get_codec, decompress
+from ..dispatch import (
+    ACTION_EXCHANGES, DEAD_LETTER_EXCHANGE, DEAD_LETTER_QUEUE, DISPATCHED_AT_HEADER, RETURN_EXCHANGE
+)
+from ..idempotency import IdempotencyCache
+from ..metrics import ConsumerMetrics
+from ..util import (
+    action_types_for, partition_fields_for, partition_key, accepts_batches, ActionsFailed,
+    multi_record_types_for
+)
 
 LOGGER = logging.getLogger(__name__)
 
+# the fields of the properties of a message
+PROPERTY_FIELDS = tuple(vars(pika.BasicProperties()))
+
 
 class ActionConsumer(BasicConsumer):
-    """ This async consumer looks for messages in the action exchange and parses them as json """
+    """
+        This async consumer looks for messages in the action exchange and
+        decodes them with the codec named by their content type (JSON if
+        there isn't one), decompressing them first if necessary.
+
+        A message is acknowledged once the handler returns. If the handler
+        raises an exception, the action is published to a delay queue and
+        comes back to the consumer once its delay is up (the delays grow with
+        every attempt). Failed actions find their way back through an exchange
+        that routes them by service (see `service`), so they reach whichever
+        consumers of the service are around at the time (even after a
+        restart). Once it has run out of attempts, or if the message can't be
+        decoded at all, it is sent to the dead-letter exchange along with the
+        error so it can be inspected and replayed later (see
+        nautilus.network.deadLetters). Retried actions are not kept in order.
+
+        Actions are published with their type in the message properties, so
+        the actions the handler did not declare an interest in (see
+        nautilus.network.util.action_types_for) are acknowledged and dropped
+        without being decoded.
+
+        The ids of the handled actions are kept in a cache (see
+        nautilus.network.idempotency) so an action that is delivered again is
+        acknowledged without being handled a second time (or even decoded, if
+        its id is still in memory). The cache's persistent store is consulted
+        once per batch, on the thread that handles it. The ids are recorded
+        after the handler returns, so an action whose consumer dies in between
+        is handled again: handlers see each action at least once.
+
+        By default handlers run one at a time on the IO loop; with a
+        concurrency greater than one they run on a pool of threads and the
+        prefetch count (which defaults to the concurrency) bounds the number
+        of actions in flight.
+
+        If the handler declares the payload fields that identify a record
+        (see nautilus.network.util.partition_fields_for), concurrent actions
+        are spread over ordered lanes by record instead: actions for different
+        records run in parallel while the actions for a single record are
+        handled in the order they arrived. Actions that can apply to several
+        records (see nautilus.network.util.multi_record_types_for) and don't
+        identify one wait for every lane to catch up and hold them all back
+        until they are handled.
+
+        Handlers that accept batches (see nautilus.network.util.accepts_batches)
+        are called with a list of (action_type, payload) tuples instead. A batch
+        is handed over once it holds `batch_size` actions or its first action
+        has waited `batch_delay` milliseconds, and its messages are settled
+        together once the handler returns. If the handler only fails some of
+        the batch (see nautilus.network.util.ActionsFailed), just those
+        actions are retried.
+
+        The consumer keeps counters and latency histograms for every type of
+        action (see nautilus.network.metrics): how long actions took to arrive
+        after they were dispatched, to be decoded, handled and acknowledged.
+        `metrics_snapshot` returns them along with the number of actions in
+        flight.
+
+        Args:
+            action_handler (function): The callback fired when an action is
+                received.
+
+            exchange_type (optional, str): 'fanout' to receive every action or
+                'topic' to only receive the types of actions declared by the
+                handler (see nautilus.network.util.action_types_for).
+
+            transport (optional, object): The transport to receive actions
+                over (see nautilus.network.transports). Defaults to AMQP.
+
+            prefetch_count (optional, int): The maximum number of
+                unacknowledged actions the broker will send the consumer.
+
+            concurrency (optional, int): The number of handlers that can run
+                at once.
+
+            batch_size (optional, int): The maximum number of actions in a batch.
+
+            batch_delay (optional, number): The maximum number of milliseconds
+                an action waits for its batch to fill up.
+
+            queue (optional, str): The name of the queue to read actions from.
+                Consumers given the same name (in this process or any other)
+                share the actions between them. Defaults to a queue of the
+                consumer's own. Unless the queue is durable, it is deleted
+                once its last consumer goes away.
+
+            durable (optional, bool): Whether the queue should survive its
+                consumers (and broker restarts) so actions that arrive while
+                nobody is listening are handled once a consumer comes back.
+
+            retry_delays (optional, list): The number of milliseconds to wait
+                before each retry of a failed action. Pass an empty list to
+                dead-letter actions as soon as they fail.
+
+            idempotency_cache (optional, IdempotencyCache): The cache of
+                handled action ids. Defaults to one that lives in memory.
+
+            service (optional, str): The name of the service the consumer
+                belongs to. Retried and replayed actions go back to the
+                consumers of the service. Defaults to the name of the queue.
+    """
 
     MESSAGE_URL = 'amqp://localhost/'
 
     EXCHANGE = 'actions'
     EXCHANGE_TYPE = 'fanout'
     QUEUE = None # ensures the parent uses an automatically assigned name
+    QUEUE_AUTO_DELETE = True
+    CONCURRENCY = 1
+    BATCH_SIZE = 100
+    BATCH_DELAY = 50
+    RETRY_DELAYS = (1000, 5000, 25000)
+    RETRY_EXCHANGE = 'actions.retry.{}'
+    # the partition key of the actions that can apply to any record
+    EVERY_RECORD = object()
+
 
+    def __init__(self, action_handler, exchange_type=None, transport=None,
+                 prefetch_count=None, concurrency=None, batch_size=None, batch_delay=None,
+                 queue=None, durable=False, retry_delays=None, idempotency_cache=None,
+                 service=None):
+        concurrency = concurrency or self.CONCURRENCY
+        # whether the handler wants its actions in batches
+        self._batched = accepts_batches(action_handler)
+        self._batch_size = (batch_size or self.BATCH_SIZE) if self._batched else 1
+        self._batch_delay = batch_delay or self.BATCH_DELAY
+        # if handlers run concurrently (or in batches), don't take on more actions than we can handle
+        if prefetch_count is None and concurrency * self._batch_size > 1:
+            prefetch_count = concurrency * self._batch_size
 
-    def __init__(self, action_handler):
         # use the same url for all action consumers
-        super().__init__(self.MESSAGE_URL)
+        super().__init__(self.MESSAGE_URL, transport=transport, prefetch_count=prefetch_count)
         # save the handler
         self._action_handler = action_handler
+        # the types of actions the handler wants (None for all of them)
+        self._action_types = action_types_for(action_handler)
+        # the fields identifying the record of an action (if the handler cares about order)
+        self._partition_fields = partition_fields_for(action_handler)
+        # the types of actions that can apply to several records
+        self._multi_record_types = multi_record_types_for(action_handler)
+        # the (channel, delivery tag, action) tuples waiting for the batch to fill up
+        self._batch = []
+        # the timer that hands over a batch that isn't full
+        self._batch_timeout = None
+        # the delays between the attempts at handling an action
+        self._retry_delays = tuple(self.RETRY_DELAYS if retry_delays is None else retry_delays)
+        # the (properties, body) of the messages that haven't been settled, by (channel, delivery tag)
+        self._messages = {}
+        # the ids of the actions that have been handled already
+        self._handled_ids = idempotency_cache or IdempotencyCache()
+        # the service that failed actions are sent back to
+        self._service = service
+        # the declarations we are waiting on before we can consume
+        self._pending_declarations = 0
+        # the counters and latencies of the actions, by type
+        self.metrics = ConsumerMetrics()
+
+        # the workers running the handler (None if the handler runs on the IO loop)
+        self._executor = self.create_executor(concurrency)
+
+        # if we are listening to a different exchange than the default one
+        if exchange_type:
+            exchange = ACTION_EXCHANGES[exchange_type]
+            self.EXCHANGE = exchange['name']
+            self.EXCHANGE_TYPE = exchange['type']
+
+        # if the consumer shares its queue with others
+        if queue:
+            self.QUEUE = queue
+        # if the queue should hold on to actions while nobody is listening
+        if durable:
+            self.QUEUE_DURABLE = True
+            self.QUEUE_AUTO_DELETE = False
+
+
+    def create_executor(self, concurrency):
+        """ Return the executor that runs the handler, or None to run it on the IO loop. """
+        # if the handler runs on the IO loop
+        if concurrency == 1:
+            return None
+        # if actions for the same record have to stay in order
+        elif self._partition_fields:
+            return PartitionedExecutor(lanes=concurrency)
+        # otherwise any worker can handle any action
+        else:
+            return ThreadPoolExecutor(max_workers=concurrency)
+
+
+    def routing_keys(self):
+        """ Bind the queue to the action types the handler is interested in. """
+        # fanout exchanges ignore the routing key
+        if self.EXCHANGE_TYPE != 'topic':
+            return super().routing_keys()
+
+        # if the handler did not say which actions it handles, it gets all of them
+        if self._action_types is None:
+            return ['#']
+
+        return sorted(self._action_types)
+
+
+    def start_consuming(self):
+        """ Declare the queues that failed actions go through before consuming. """
+        # each delay has an exchange and queue of its own, whose messages are sent
+        # back to the service named by their routing key
+        queues = [
+            (self.RETRY_EXCHANGE.format(delay), {
+                'x-message-ttl': delay,
+                'x-dead-letter-exchange': RETURN_EXCHANGE['name'],
+            })
+            for delay in sorted(set(self._retry_delays))
+        ]
+        # the actions that couldn't be handled end up in the dead-letter queue
+        queues.append((DEAD_LETTER_QUEUE, None))
+        exchanges = [name for name, _ in queues[:-1]] + [DEAD_LETTER_EXCHANGE['name']]
+
+        # if we are restoring the topology, there is no need to wait for the replies
+        callback = None if self._declared else self.on_retry_declareok
+        nowait = self._declared
+
+        self._pending_declarations = 3 * len(queues) + 2
+        # the actions of our service come back to our queue
+        self._channel.exchange_declare(callback, RETURN_EXCHANGE['name'], RETURN_EXCHANGE['type'],
+                                       durable=RETURN_EXCHANGE['durable'], nowait=nowait)
+        self._channel.queue_bind(callback, queue=self._queue_name, exchange=RETURN_EXCHANGE['name'],
+                                 routing_key=self.service, nowait=nowait)
+        for exchange, (queue, arguments) in zip(exchanges, queues):
+            LOGGER.info('Declaring %s for failed actions', queue)
+            self._channel.exchange_declare(callback, exchange, 'fanout', durable=True,
+                                           nowait=nowait)
+            self._channel.queue_declare(callback, queue=queue, durable=True, arguments=arguments,
+                                        nowait=nowait)
+            self._channel.queue_bind(callback, queue=queue, exchange=exchange, routing_key='',
+                                     nowait=nowait)
+
+        if self._declared:
+            super().start_consuming()
+
+
+    @property
+    def service(self):
+        """ The name that retried and replayed actions are sent back to. """
+        return self._service or self._queue_name
+
+
+    def on_retry_declareok(self, unused_frame):
+        """ Start consuming once the retry and dead-letter queues are in place. """
+        self._pending_declarations -= 1
+        if self._pending_declarations == 0:
+            super().start_consuming()
 
 
     def on_message(self, channel, method, properties, body):
         """ Call the actionHandler when a message is recieved """
         # pass the message onto the parent class first
         super().on_message(channel, method, properties, body)
-        # decode the body as a byte string
-        body_string = body.decode('utf-8')
-        # parse the body as json
-        body_data = json.loads(body_string)
-        # if there is a type and payload
-        if 'type' in body_data and 'payload' in body_data:
-            # pass the type and payload to the action handler
-            self._action_handler(action_type=body_data['type'], payload=body_data['payload'])
-        # otherwise its an invalid action
+
+        # if the publisher told us the type of the action and the handler doesn't want it
+        if properties.type and self._action_types is not None \
+                           and properties.type not in self._action_types:
+            # drop it without bothering to decode it
+            self.metrics.count(properties.type, 'dropped')
+            self.settle_message(channel, method.delivery_tag, handled=True)
+            return
+
+        # hold on to the message in case the action has to be retried
+        self._messages[(channel, method.delivery_tag)] = (properties, body)
+
+        # if we have handled the action recently (ie, it was redelivered or published
+        # twice). the idempotency store is checked once the batch is handed over
+        if properties.message_id and self._handled_ids.seen(properties.message_id):
+            LOGGER.info('Skipping duplicate action %s', properties.message_id)
+            self.metrics.count(properties.type, 'duplicates')
+            self.settle_message(channel, method.delivery_tag, handled=True)
+            return
+
+        # if we are shutting down, let another consumer handle the action
+        if self._closing:
+            self.settle_message(channel, method.delivery_tag, handled=False, requeue=True)
+            return
+
+        decode_started = time.monotonic()
+        try:
+            # if the body was compressed
+            if properties.content_encoding:
+                # decompress it
+                body = decompress(body, properties.content_encoding)
+            # decode the body with the codec the message was encoded with
+            body_data = get_codec(properties.content_type).decode(body)
+        # if we can't read the message (unknown codec, corrupt body, ...) it
+        # won't get any better by trying again
+        except Exception as err:
+            LOGGER.warning('Could not decode action: {}'.format(err))
+            self.metrics.count(properties.type, 'failed')
+            self.settle_message(channel, method.delivery_tag, handled=False, error=err, retry=False)
+            return
+
+        # if there isn't a type and payload its an invalid action
+        if not isinstance(body_data, dict) or 'type' not in body_data or 'payload' not in body_data:
+            LOGGER.warning('Encountered invalid action: {}'.format(body_data))
+            self.metrics.count(properties.type, 'failed')
+            self.settle_message(channel, method.delivery_tag, handled=False,
+                                error='Invalid action', retry=False)
+            return
+
+        self.record_arrival(body_data['type'], properties, time.monotonic() - decode_started)
+
+        # add the action to the current batch
+        self._batch.append((channel, method.delivery_tag, body_data))
+        # if the batch is full
+        if len(self._batch) >= self._batch_size:
+            self.flush_batch()
+        # if this is the first action of a new batch
+        elif len(self._batch) == 1:
+            # make sure it doesn't wait forever
+            self._batch_timeout = self._connection.add_timeout(
+                self._batch_delay / 1000, self.flush_batch
+            )
+
+
+    def record_arrival(self, action_type, properties, decode_time):
+        """ Count a decoded action and record how long it took to get here. """
+        self.metrics.count(action_type, 'received')
+        self.metrics.observe(action_type, 'decode', decode_time)
+
+        headers = properties.headers or {}
+        # retried actions spent most of their trip waiting in a delay queue
+        if DISPATCHED_AT_HEADER in headers and not headers.get('x-retries'):
+            lag = time.time() - headers[DISPATCHED_AT_HEADER] / 1000
+            # clocks on different hosts can disagree
+            self.metrics.observe(action_type, 'lag', max(lag, 0))
+
+
+    def metrics_snapshot(self):
+        """
+            Return the metrics of the consumer as a dictionary that can be
+            sent to another process (see nautilus.network.metrics.merge_snapshots).
+        """
+        return {
+            'actions': self.metrics.snapshot(),
+            # the actions that have been received but not settled
+            'in_flight': len(self._messages),
+            # the actions waiting for their batch to fill up
+            'batching': len(self._batch),
+            'recoveries': self.recoveries,
+            'recovery_time': self.recovery_time,
+        }
+
+
+    def flush_batch(self):
+        """ Hand the actions waiting in the current batch over to the handler. """
+        # if the batch filled up before the timer went off
+        if self._batch_timeout is not None:
+            self._connection.remove_timeout(self._batch_timeout)
+            self._batch_timeout = None
+
+        batch, self._batch = self._batch, []
+        # if there is nothing to handle or we are shutting down (the broker
+        # will redeliver the actions once the channel closes)
+        if not batch or self._closing:
+            return
+
+        self.submit_batch(batch)
+
+
+    def submit_batch(self, batch):
+        """ Arrange for the handler to be called with the given batch. """
+        # if the handler runs on the IO loop
+        if self._executor is None:
+            self.handle_batch(batch)
+            return
+
+        try:
+            # if actions for the same record have to stay in order
+            if self._partition_fields:
+                for key, messages in self.partition_batch(batch):
+                    # if the actions could apply to any record, every lane waits for them
+                    if key is self.EVERY_RECORD:
+                        self._executor.submit_barrier(self.handle_batch, messages)
+                    else:
+                        self._executor.submit(key, self.handle_batch, messages)
+            else:
+                # hand the batch off to any worker
+                self._executor.submit(self.handle_batch, batch)
+        # if the workers were shut down in the meantime
+        except RuntimeError:
+            for channel, delivery_tag, action in batch:
+                self.settle_message(channel, delivery_tag, handled=False, requeue=True)
+
+
+    def partition_batch(self, batch):
+        """
+            Split the batch into the (partition key, messages) parts that can be
+            handled in parallel, in order. The actions that can apply to several
+            records get parts of their own with EVERY_RECORD as their key.
+        """
+        parts = []
+        # the messages since the last multi-record action, by lane
+        lanes = collections.OrderedDict()
+        for message in batch:
+            action = message[2]
+            key = partition_key(self._partition_fields, action['payload'])
+            # if the action can touch any record
+            if key is None and action['type'] in self._multi_record_types:
+                # the actions before it are handled first
+                parts.extend(lanes.values())
+                lanes = collections.OrderedDict()
+                # and consecutive multi-record actions are handled together
+                if parts and parts[-1][0] is self.EVERY_RECORD:
+                    parts[-1][1].append(message)
+                else:
+                    parts.append((self.EVERY_RECORD, [message]))
+            else:
+                lanes.setdefault(self.lane(key), (key, []))[1].append(message)
+        parts.extend(lanes.values())
+
+        return parts
+
+
+    def lane(self, key):
+        """ Return the lane that handles the actions with the given partition key. """
+        return self._executor.lane(key)
+
+
+    def handle_batch(self, batch):
+        """ Pass the batch to the handler and settle its messages once it's done. """
+        started = time.monotonic()
+        # the positions of the actions that were handled before
+        duplicates = self.find_duplicates(batch)
+        # the (action_type, payload) tuples of the batch
+        actions = [(action['type'], action['payload']) for _, _, action in batch]
+        # the ones the handler has to see
+        new_actions = [action for index, action in enumerate(actions) if index not in duplicates]
+        try:
+            # if the handler takes the whole batch
+            if self._batched:
+                # unless every action was a duplicate
+                if new_actions:
+                    self._action_handler(new_actions)
+            else:
+                # pass the type and payload to the action handler
+                for action_type, payload in new_actions:
+                    self._action_handler(action_type=action_type, payload=payload)
+        # if the handler only failed some of the actions
+        except ActionsFailed as err:
+            LOGGER.warning('Could not handle actions: {}'.format(
+                ', '.join(action_type for (action_type, _), _ in err.failures)
+            ))
+            error = err
+        # if the handler failed
+        except Exception as err:
+            LOGGER.exception('Could not handle actions: {}'.format(
+                ', '.join(action_type for action_type, _ in new_actions)
+            ))
+            error = err
+        else:
+            error = None
+
+        errors = self.batch_errors(actions, error, duplicates)
+        # make sure the handled actions aren't handled again before they are acknowledged
+        self.record_handled(batch, errors, duplicates)
+
+        settle = functools.partial(
+            self.complete_batch, batch, errors, started, time.monotonic(), duplicates
+        )
+        # the channel can only be used from the IO loop
+        if self._executor is None:
+            settle()
+        else:
+            self._connection.ioloop.add_callback_threadsafe(settle)
+
+
+    def message_id(self, channel, delivery_tag):
+        """ Return the id of the action in the given message (None if it doesn't have one). """
+        properties, _ = self._messages.get((channel, delivery_tag), (None, None))
+        return properties.message_id if properties is not None else None
+
+
+    def find_duplicates(self, batch):
+        """
+            Return the positions of the actions in the batch that have been
+            handled before. The ids that aren't in memory are looked up in the
+            idempotency store at once, on the thread handling the batch.
+        """
+        message_ids = [self.message_id(channel, delivery_tag) for channel, delivery_tag, _ in batch]
+        handled = self._handled_ids.handled([message_id for message_id in message_ids if message_id])
+
+        return frozenset(
+            index for index, message_id in enumerate(message_ids) if message_id in handled
+        )
+
+
+    def batch_errors(self, actions, error, duplicates=frozenset()):
+        """
+            Return the error each action of a batch failed with (None if it was
+            handled). If the handler raised ActionsFailed, only the actions it
+            names failed.
+        """
+        # if only some of the actions failed
+        if isinstance(error, ActionsFailed):
+            failures = {id(action): action_error for action, action_error in error.failures}
+            return [failures.get(id(action)) for action in actions]
+
+        return [None if index in duplicates else error for index in range(len(actions))]
+
+
+    def record_handled(self, batch, errors, duplicates=frozenset()):
+        """
+            Add the ids of the newly handled actions of a batch to the idempotency
+            cache. This happens after (and apart from) whatever the handler
+            committed, so duplicates are only skipped on a best effort basis.
+        """
+        self._handled_ids.add([
+            self.message_id(channel, delivery_tag)
+            for index, ((channel, delivery_tag, _), error) in enumerate(zip(batch, errors))
+            if error is None and index not in duplicates
+        ])
+
+
+    def complete_batch(self, batch, errors, started, finished, duplicates=frozenset()):
+        """
+            Settle the messages of a batch the handler is done with given the
+            error each of them failed with (see batch_errors), recording how
+            long the handler and the acknowledgement took.
+        """
+        # the failed messages are settled first so acknowledging the handled
+        # ones together can't cover them
+        for (channel, delivery_tag, _), error in zip(batch, errors):
+            if error is not None:
+                self.settle_message(channel, delivery_tag, False, error=error)
+        handled = [
+            (channel, delivery_tag)
+            for (channel, delivery_tag, _), error in zip(batch, errors)
+            if error is None
+        ]
+        if handled:
+            self.settle_batch(handled, True)
+
+        acked = time.monotonic()
+        for index, ((_, _, action), error) in enumerate(zip(batch, errors)):
+            # duplicates never made it to the handler
+            if index in duplicates:
+                self.metrics.count(action['type'], 'duplicates')
+                continue
+
+            self.metrics.count(action['type'], 'handled' if error is None else 'failed')
+            # the handler's time is shared by the actions in the batch
+            self.metrics.observe(action['type'], 'handler',
+                                 (finished - started) / (len(batch) - len(duplicates)))
+            self.metrics.observe(action['type'], 'ack', acked - finished)
+
+
+    def settle_batch(self, messages, handled, error=None):
+        """ Settle the (channel, delivery tag) pairs of a batch together. """
+        # if every earlier message has been settled already (the batches are
+        # handled in order on the IO loop) a single ack covers the whole batch
+        if handled and self._executor is None and len(messages) > 1 \
+                   and all(channel is self._channel for channel, _ in messages):
+            channel, delivery_tag = messages[-1]
+            if channel.is_open:
+                for message in messages:
+                    self._messages.pop(message, None)
+                self.acknowledge_message(delivery_tag, multiple=True)
+                return
+
+        for channel, delivery_tag in messages:
+            self.settle_message(channel, delivery_tag, handled, error=error)
+
+
+    def settle_message(self, channel, delivery_tag, handled, requeue=False, error=None,
+                       retry=True):
+        """
+            Acknowledge the message if it was handled. Otherwise, requeue it
+            if asked to or pass it on to be retried (or dead-lettered).
+        """
+        message = self._messages.pop((channel, delivery_tag), None)
+        # delivery tags only mean something to the channel that delivered the message
+        if channel is not self._channel or not channel.is_open:
+            LOGGER.warning('Channel closed before message %s was settled', delivery_tag)
+            return
+
+        if handled:
+            self.acknowledge_message(delivery_tag)
+        elif requeue or message is None:
+            self.reject_message(delivery_tag, requeue=requeue)
         else:
-            LOGGER.warning('Encountered invalid action: {}'.format(body_string))
+            self.retry_message(delivery_tag, *message, error=error, retry=retry)
+
+
+    def retry_message(self, delivery_tag, properties, body, error=None, retry=True):
+        """
+            Publish a failed action to the delay queue for its next attempt,
+            or to the dead-letter exchange once it has run out of attempts,
+            and acknowledge the original message.
+        """
+        headers = dict(properties.headers or {})
+        attempts = headers.get('x-retries', 0)
+        # if the action gets another chance
+        if retry and attempts < len(self._retry_delays):
+            delay = self._retry_delays[attempts]
+            LOGGER.info('Retrying message %s in %sms', delivery_tag, delay)
+            exchange = self.RETRY_EXCHANGE.format(delay)
+            headers['x-retries'] = attempts + 1
+        else:
+            LOGGER.warning('Dead-lettering message %s: %s', delivery_tag, error)
+            exchange = DEAD_LETTER_EXCHANGE['name']
+            headers['x-error'] = '{}: {}'.format(type(error).__name__, error) \
+                                 if isinstance(error, Exception) else str(error)
+        # remember where the action came from so it can find its way back
+        headers['x-service'] = self.service
+        # the delivered properties can be shared (eg, with the other queues of an
+        # in-process broker) so the retry gets a copy of its own
+        properties = pika.BasicProperties(**dict(
+            {field: getattr(properties, field) for field in PROPERTY_FIELDS},
+            headers=headers
+        ))
+
+        # the routing key sends the action back to our service when its delay is up
+        self._channel.basic_publish(exchange, self.service, body, properties)
+        self.acknowledge_message(delivery_tag)
+
+
+    def stop(self):
+        """ Wait for the running handlers to finish before shutting down. """
+        self._closing = True
+        # the handlers queue up their acks on the IO loop, which the parent restarts
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        super().stop()
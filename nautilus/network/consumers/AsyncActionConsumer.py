@@ -0,0 +1,222 @@
+# external imports
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+# local imports
+from . import ActionConsumer
+from ..util import ActionsFailed
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncActionConsumer(ActionConsumer):
+    """
+        This consumer is the asyncio counterpart of ActionConsumer. The
+        connection runs on an asyncio event loop and every action (or batch)
+        is handled in a task of its own, so handlers declared with `async def`
+        can overlap their I/O. Synchronous handlers still work: they are run
+        on a pool of threads so they don't block the loop.
+
+        The prefetch count (which defaults to `concurrency` times the batch
+        size) bounds the number of actions in flight. If the handler declares
+        the fields that identify a record, the actions for each record are
+        handled one after the other, and the actions that can apply to any
+        record wait for (and hold back) everything else.
+
+        Args:
+            action_handler (function): The callback (or coroutine function)
+                fired when an action is received.
+
+            loop (optional, asyncio.AbstractEventLoop): The event loop to run
+                on. Defaults to a new event loop created when the consumer runs.
+
+            concurrency (optional, int): The number of actions that can be
+                handled at once.
+
+            The remaining arguments are passed to ActionConsumer.
+    """
+
+    CONCURRENCY = 10
+
+    def __init__(self, action_handler, loop=None, **kwargs):
+        # the loop is created lazily so it belongs to the process that runs the consumer
+        self.loop = loop
+        self._owns_loop = loop is None
+        # the tasks handling actions
+        self._tasks = set()
+        # the last task for each record, by partition key
+        self._lanes = {}
+        # the last task handling actions that can apply to any record
+        self._barrier = None
+        super().__init__(action_handler, **kwargs)
+
+
+    def create_executor(self, concurrency):
+        """ Synchronous handlers run on a pool of threads as big as the concurrency. """
+        return ThreadPoolExecutor(max_workers=concurrency)
+
+
+    def connect(self):
+        """ Connect on the consumer's event loop, returning the connection handle. """
+        # if this is the first time we are connecting
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+
+        LOGGER.info('Connecting to %s over %s', self._url, self._transport.name)
+        return self._transport.connect(self._url, self.on_connection_open, loop=self.loop)
+
+
+    def run(self):
+        """ Consume actions until the consumer is stopped. """
+        super().run()
+        # once the consumer has shut down, so can the loop it created
+        self._close_loop()
+
+
+    def reconnect(self):
+        """ Connect again on the same event loop, which keeps running in the meantime. """
+        if not self._closing:
+            self._connection = self.connect()
+
+
+    def submit_batch(self, batch):
+        """ Handle the batch in a task on the event loop. """
+        # if actions for the same record have to stay in order
+        if self._partition_fields:
+            for key, messages in self.partition_batch(batch):
+                # if the actions could apply to any record
+                if key is self.EVERY_RECORD:
+                    # wait for everything that came before them
+                    previous = list(self._lanes.values())
+                    if self._barrier is not None:
+                        previous.append(self._barrier)
+                    task = self._start_task(self.handle_batch_async(messages, after=previous))
+                    # and make everything after them wait
+                    self._lanes = {}
+                    self._barrier = task
+                    task.add_done_callback(self._on_barrier_done)
+                    continue
+
+                # wait for the previous actions for the record (or any record) before handling these
+                previous = self._lanes.get(key, self._barrier)
+                task = self._start_task(self.handle_batch_async(
+                    messages, after=[previous] if previous is not None else ()
+                ))
+                self._lanes[key] = task
+                task.add_done_callback(functools.partial(self._on_lane_done, key))
+        else:
+            self._start_task(self.handle_batch_async(batch))
+
+
+    async def handle_batch_async(self, batch, after=()):
+        """
+            Pass the batch to the handler and settle its messages once it's
+            done, after the given tasks.
+        """
+        # if we have to wait our turn
+        if after:
+            await asyncio.wait(after)
+
+        started = time.monotonic()
+        # the positions of the actions that were handled before
+        duplicates = await self._off_loop(self.find_duplicates, batch)
+        # the (action_type, payload) tuples of the batch
+        actions = [(action['type'], action['payload']) for _, _, action in batch]
+        # the ones the handler has to see
+        new_actions = [action for index, action in enumerate(actions) if index not in duplicates]
+        try:
+            # if the handler takes the whole batch
+            if self._batched:
+                # unless every action was a duplicate
+                if new_actions:
+                    await self._call_handler(new_actions)
+            else:
+                # pass the type and payload to the action handler
+                for action_type, payload in new_actions:
+                    await self._call_handler(action_type=action_type, payload=payload)
+        # if the handler only failed some of the actions
+        except ActionsFailed as err:
+            LOGGER.warning('Could not handle actions: {}'.format(
+                ', '.join(action_type for (action_type, _), _ in err.failures)
+            ))
+            error = err
+        # if the handler failed
+        except Exception as err:
+            LOGGER.exception('Could not handle actions: {}'.format(
+                ', '.join(action_type for action_type, _ in new_actions)
+            ))
+            error = err
+        else:
+            error = None
+
+        errors = self.batch_errors(actions, error, duplicates)
+        # make sure the handled actions aren't handled again before they are acknowledged
+        await self._off_loop(self.record_handled, batch, errors, duplicates)
+
+        # we are back on the event loop so we can use the channel
+        self.complete_batch(batch, errors, started, time.monotonic(), duplicates)
+
+
+    async def _off_loop(self, function, *args):
+        """ Call a function that may talk to the idempotency store without blocking the event loop. """
+        # if the ids are only kept in memory, there is nothing to wait for
+        if self._handled_ids.store is None:
+            return function(*args)
+
+        return await self.loop.run_in_executor(self._executor, functools.partial(function, *args))
+
+
+    async def _call_handler(self, *args, **kwargs):
+        """ Call the handler without blocking the event loop. """
+        # if the handler is a coroutine function
+        if asyncio.iscoroutinefunction(self._action_handler):
+            return await self._action_handler(*args, **kwargs)
+
+        # otherwise run it on a thread
+        return await self.loop.run_in_executor(
+            self._executor, functools.partial(self._action_handler, *args, **kwargs)
+        )
+
+
+    def _start_task(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+
+    def _on_lane_done(self, key, task):
+        # forget the record unless there are more actions for it
+        if self._lanes.get(key) is task:
+            del self._lanes[key]
+
+
+    def lane(self, key):
+        """ Every record gets a lane of its own. """
+        return key
+
+
+    def _on_barrier_done(self, task):
+        # forget the barrier unless there is another one
+        if self._barrier is task:
+            self._barrier = None
+
+
+    def stop(self):
+        """ Wait for the running handlers to finish before shutting down. """
+        self._closing = True
+        # if the loop isn't running, give the tasks a chance to finish
+        if self._tasks and not self.loop.is_running():
+            self.loop.run_until_complete(asyncio.wait(list(self._tasks)))
+        super().stop()
+        self._close_loop()
+
+
+    def _close_loop(self):
+        # only close the loop if it is ours and nothing is using it anymore
+        if self._owns_loop and self._closing and self.loop is not None \
+                           and not self.loop.is_running() and not self.loop.is_closed():
+            self.loop.close()
@@ -27,7 +27,10 @@
 
 # external imports
 import logging
-import pika
+import random
+import time
+# local imports
+from ..transports import get_transport
 
 LOGGER = logging.getLogger(__name__)
 
@@ -40,6 +43,13 @@ class BasicConsumer:
     be closed, which usually are tied to permission related issues or
     socket timeouts.
 
+    The first attempt to reconnect is made right away. After that, the
+    consumer waits a random amount of time that grows with every failed
+    attempt (up to RECONNECT_MAX_DELAY seconds) so a crowd of consumers
+    doesn't reconnect in lockstep. Once reconnected, everything the consumer
+    declared before is declared again in a single pass and the time it took
+    to recover is kept in `recovery_time`.
+
     If the channel is closed, it will indicate a problem with one of the
     commands that were issued and that should surface in the output as well.
 
@@ -48,13 +58,21 @@ class BasicConsumer:
     EXCHANGE_TYPE = None
     QUEUE = None
     QUEUE_EXCLUSIVE = False
+    QUEUE_DURABLE = False
+    QUEUE_AUTO_DELETE = False
     ROUTING_KEY = None
+    PREFETCH_COUNT = 0
+    RECONNECT_DELAY = 0.5
+    RECONNECT_MAX_DELAY = 30
 
-    def __init__(self, amqp_url):
+    def __init__(self, amqp_url, transport=None, prefetch_count=None):
         """Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
 
         :param str amqp_url: The AMQP url to connect with
+        :param transport: The transport to connect through (defaults to AMQP)
+        :param int prefetch_count: The maximum number of unacknowledged
+            messages the broker will send (0 for no limit)
 
         """
         self._connection = None
@@ -62,7 +80,20 @@ class BasicConsumer:
         self._closing = False
         self._consumer_tag = None
         self._queue_name = None
+        self._pending_bindings = 0
         self._url = amqp_url
+        self._transport = transport or get_transport()
+        self._prefetch_count = self.PREFETCH_COUNT if prefetch_count is None else prefetch_count
+        # the number of attempts to reconnect since the connection was lost
+        self._reconnect_attempts = 0
+        # when the connection was lost (None while we are connected)
+        self._disconnected_at = None
+        # whether the topology has been declared before (and can be restored without waiting)
+        self._declared = False
+        # the number of times the consumer has recovered from a lost connection
+        self.recoveries = 0
+        # the number of seconds the last recovery took
+        self.recovery_time = None
 
     def connect(self):
         """This method connects to RabbitMQ, returning the connection handle.
@@ -72,10 +103,9 @@ class BasicConsumer:
         :rtype: pika.SelectConnection
 
         """
-        LOGGER.info('Connecting to %s', self._url)
-        return pika.SelectConnection(pika.URLParameters(self._url),
-                                     self.on_connection_open,
-                                     stop_ioloop_on_close=False)
+        LOGGER.info('Connecting to %s over %s', self._url, self._transport.name)
+        return self._transport.connect(self._url, self.on_connection_open,
+                                       on_open_error_callback=self.on_connection_open_error)
 
     def on_connection_open(self, unused_connection):
         """This method is called by pika once the connection to RabbitMQ has
@@ -89,6 +119,22 @@ class BasicConsumer:
         self.add_on_connection_close_callback()
         self.open_channel()
 
+    def on_connection_open_error(self, connection, error):
+        """This method is called by pika if the connection to RabbitMQ
+        can't be established. We try again after a while. Since pika might
+        call this before the connection is even returned to us, the retry is
+        scheduled on the connection we are given.
+
+        :type connection: pika.SelectConnection
+        :param str|Exception error: The reason the connection failed
+
+        """
+        if self._disconnected_at is None:
+            self._disconnected_at = time.monotonic()
+        delay = self.reconnect_delay()
+        LOGGER.warning('Could not connect, retrying in %.2f seconds: %s', delay, error)
+        connection.add_timeout(delay, self.reconnect)
+
     def add_on_connection_close_callback(self):
         """This method adds an on close callback that will be invoked by pika
         when RabbitMQ closes the connection to the publisher unexpectedly.
@@ -111,9 +157,27 @@ class BasicConsumer:
         if self._closing:
             self._connection.ioloop.stop()
         else:
-            LOGGER.warning('Connection closed, reopening in 5 seconds: (%s) %s',
-                           reply_code, reply_text)
-            self._connection.add_timeout(5, self.reconnect)
+            self._disconnected_at = time.monotonic()
+            delay = self.reconnect_delay()
+            LOGGER.warning('Connection closed, reopening in %.2f seconds: (%s) %s',
+                           delay, reply_code, reply_text)
+            self._connection.add_timeout(delay, self.reconnect)
+
+    def reconnect_delay(self):
+        """Return the number of seconds to wait before the next attempt to
+        reconnect: none for the first attempt and then a random delay (so
+        consumers spread out) whose ceiling doubles with every attempt.
+
+        :rtype: float
+
+        """
+        attempt = self._reconnect_attempts
+        self._reconnect_attempts += 1
+        # the first attempt is made right away
+        if attempt == 0:
+            return 0
+        ceiling = min(self.RECONNECT_MAX_DELAY, self.RECONNECT_DELAY * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
 
     def reconnect(self):
         """Will be invoked by the IOLoop timer if the connection is
@@ -152,7 +216,37 @@ class BasicConsumer:
         LOGGER.info('Channel opened')
         self._channel = channel
         self.add_on_channel_close_callback()
-        self.setup_exchange(self.EXCHANGE)
+        # if we have been here before, we know what to declare
+        if self._declared:
+            self.restore_topology()
+        else:
+            self.setup_exchange(self.EXCHANGE)
+
+    def restore_topology(self):
+        """Declare the exchange, queue and bindings the consumer set up before
+        the connection was lost. The declarations are sent with nowait so the
+        broker doesn't reply to them and pika doesn't hold each one back until
+        the previous one is answered. Only the prefetch limit and the consumer
+        itself wait on a reply. The exception is a queue named by the broker,
+        whose new name we have to wait for.
+
+        """
+        LOGGER.info('Restoring exchange %s and queue %s',
+                    self.EXCHANGE, self.QUEUE or '(automatically named)')
+        self._channel.exchange_declare(None, self.EXCHANGE, self.EXCHANGE_TYPE, durable=True,
+                                       nowait=True)
+        # if the broker has to name the queue
+        if not self.QUEUE:
+            self.setup_queue()
+            return
+
+        self._channel.queue_declare(None,
+                                    queue = self.QUEUE,
+                                    durable = self.QUEUE_DURABLE,
+                                    exclusive = self.QUEUE_EXCLUSIVE,
+                                    auto_delete = self.QUEUE_AUTO_DELETE,
+                                    nowait = True)
+        self.bind_queue(self.QUEUE)
 
     def add_on_channel_close_callback(self):
         """This method tells pika to call the on_channel_closed method if
@@ -207,31 +301,69 @@ class BasicConsumer:
         command. When it is complete, the on_queue_declareok method will
         be invoked by pika.
 
-        :param str|unicode queue_name: The name of the queue to declare.
+        If QUEUE is not set, the broker names the queue for us.
 
         """
-        result = self._channel.queue_declare(self.on_queue_declareok)
+        LOGGER.info('Declaring queue %s', self.QUEUE or '(automatically named)')
+        self._channel.queue_declare(self.on_queue_declareok,
+                                    queue = self.QUEUE or '',
+                                    durable = self.QUEUE_DURABLE,
+                                    exclusive = self.QUEUE_EXCLUSIVE,
+                                    auto_delete = self.QUEUE_AUTO_DELETE)
 
 
     def on_queue_declareok(self, method_frame):
         """Method invoked by pika when the Queue.Declare RPC call made in
         setup_queue has completed. In this method we will bind the queue
-        and exchange together with the routing key by issuing the Queue.Bind
-        RPC command. When this command is complete, the on_bindok method will
-        be invoked by pika.
+        and exchange together with each of the routing keys by issuing the
+        Queue.Bind RPC command. When these commands are complete, the on_bindok
+        method will be invoked by pika.
 
         :param pika.frame.Method method_frame: The Queue.DeclareOk frame
 
+        """
+        self.bind_queue(self.QUEUE or method_frame.method.queue)
+
+    def bind_queue(self, queue_name):
+        """Bind the queue to the exchange with each of the routing keys. When
+        restoring the topology, we don't wait for the bindings before
+        consuming.
+
+        :param str|unicode queue_name: The name of the declared queue
+
         """
         # save the generated queue name
-        self._queue_name = self.QUEUE or method_frame.method.queue
-        # log the activity
-        LOGGER.info('Binding %s to %s with routing key %s',
-                    self.EXCHANGE, self._queue_name, self.ROUTING_KEY)
-        self._channel.queue_bind(self.on_bindok,
-                                    queue = self._queue_name,
-                                    routing_key = self.ROUTING_KEY,
-                                    exchange = self.EXCHANGE)
+        self._queue_name = queue_name
+        # the bindings we are waiting on
+        routing_keys = self.routing_keys()
+        self._pending_bindings = len(routing_keys)
+        # if there is nothing to bind (or nothing to wait for)
+        if not routing_keys or self._declared:
+            for routing_key in routing_keys:
+                self._channel.queue_bind(None,
+                                         queue = self._queue_name,
+                                         routing_key = routing_key,
+                                         exchange = self.EXCHANGE,
+                                         nowait = True)
+            self.start_consuming()
+            return
+
+        for routing_key in routing_keys:
+            # log the activity
+            LOGGER.info('Binding %s to %s with routing key %s',
+                        self.EXCHANGE, self._queue_name, routing_key)
+            self._channel.queue_bind(self.on_bindok,
+                                        queue = self._queue_name,
+                                        routing_key = routing_key,
+                                        exchange = self.EXCHANGE)
+
+    def routing_keys(self):
+        """Return the list of routing keys to bind the queue with.
+
+        :rtype: list
+
+        """
+        return [self.ROUTING_KEY]
 
     def on_bindok(self, unused_frame):
         """Invoked by pika when the Queue.Bind method has completed. At this
@@ -242,9 +374,38 @@ class BasicConsumer:
 
         """
         LOGGER.info('Queue bound')
-        self.start_consuming()
+        self._pending_bindings -= 1
+        # once every binding is in place
+        if self._pending_bindings == 0:
+            self.start_consuming()
 
     def start_consuming(self):
+        """This method limits the number of unacknowledged messages the
+        broker will send us by issuing the Basic.Qos RPC command, if there is
+        a prefetch count. Once the limit is in place (or right away if there
+        isn't one), the consume method is invoked.
+
+        """
+        if self._prefetch_count:
+            LOGGER.info('Setting the prefetch count to %s', self._prefetch_count)
+            # when restoring, the consumer can be registered right behind the limit
+            self._channel.basic_qos(None if self._declared else self.on_basic_qos_ok,
+                                    prefetch_count = self._prefetch_count)
+            if not self._declared:
+                return
+        self.consume()
+
+    def on_basic_qos_ok(self, unused_frame):
+        """Invoked by pika when the Basic.Qos method has completed. At this
+        point we can start consuming messages.
+
+        :param pika.frame.Method unused_frame: The Basic.QosOk response frame
+
+        """
+        LOGGER.info('QOS set')
+        self.consume()
+
+    def consume(self):
         """This method sets up the consumer by first calling
         add_on_cancel_callback so that the object is notified if RabbitMQ
         cancels the consumer. It then issues the Basic.Consume RPC command
@@ -259,6 +420,15 @@ class BasicConsumer:
         self._consumer_tag = self._channel.basic_consume(self.on_message,
                                                          self._queue_name,
                                                          exclusive = self.QUEUE_EXCLUSIVE)
+        # if the connection is lost from now on, the topology can be restored without waiting
+        self._declared = True
+        self._reconnect_attempts = 0
+        # if we just recovered from a lost connection
+        if self._disconnected_at is not None:
+            self.recovery_time = time.monotonic() - self._disconnected_at
+            self.recoveries += 1
+            self._disconnected_at = None
+            LOGGER.info('Recovered from a lost connection in %.3f seconds', self.recovery_time)
 
     def add_on_cancel_callback(self):
         """Add a callback that will be invoked if RabbitMQ cancels the consumer
@@ -299,15 +469,29 @@ class BasicConsumer:
                     method.delivery_tag, properties.app_id, body[:50])
         # self.acknowledge_message(method.delivery_tag)
 
-    def acknowledge_message(self, delivery_tag):
+    def acknowledge_message(self, delivery_tag, multiple=False):
         """Acknowledge the message delivery from RabbitMQ by sending a
         Basic.Ack RPC method for the delivery tag.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool multiple: Also acknowledge every earlier delivery
 
         """
         LOGGER.info('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        self._channel.basic_ack(delivery_tag, multiple=multiple)
+
+    def reject_message(self, delivery_tag, requeue=False):
+        """Reject the message delivery from RabbitMQ by sending a
+        Basic.Reject RPC method for the delivery tag. Unless the message is
+        requeued, the broker drops it (or dead-letters it, if the queue has a
+        dead-letter exchange).
+
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool requeue: Whether the broker should deliver the message again
+
+        """
+        LOGGER.info('Rejecting message %s', delivery_tag)
+        self._channel.basic_reject(delivery_tag, requeue=requeue)
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
@@ -365,6 +549,16 @@ class BasicConsumer:
             self._connection.ioloop.start()
         LOGGER.info('Stopped')
 
+    def stop_threadsafe(self):
+        """Stop the consumer from a thread other than the one running its
+        IOLoop. The shutdown is handed to the IOLoop so it happens in the same
+        order as everything else on the connection; the thread that called run
+        returns once the connection has closed.
+
+        """
+        if self._connection:
+            self._connection.ioloop.add_callback_threadsafe(self.stop)
+
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
         LOGGER.info('Closing connection')
@@ -0,0 +1,63 @@
+# external imports
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PartitionedExecutor:
+    """
+        This executor runs tasks on a fixed number of ordered lanes. Tasks
+        submitted with the same key always run on the same lane, one after the
+        other in the order they were submitted, while tasks on different lanes
+        run in parallel. A barrier runs once every lane has caught up with it
+        and holds every lane back until it is done.
+
+        Args:
+            lanes (int): The number of lanes (and threads).
+    """
+
+    def __init__(self, lanes):
+        self._lanes = [ThreadPoolExecutor(max_workers=1) for _ in range(lanes)]
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+            Schedule fn(*args, **kwargs) on the lane for the given key,
+            returning its future. Tasks without a key all share the first
+            lane so they keep their relative order.
+        """
+        return self._lanes[self.lane(key)].submit(fn, *args, **kwargs)
+
+    def submit_barrier(self, fn, *args, **kwargs):
+        """
+            Schedule fn(*args, **kwargs) to run after every task submitted so
+            far and before any task submitted after it, returning its future.
+        """
+        # the other lanes check in once they get to the barrier
+        arrived = threading.Semaphore(0)
+        finished = threading.Event()
+
+        def hold():
+            arrived.release()
+            finished.wait()
+
+        def run():
+            # wait for the other lanes to catch up
+            for _ in self._lanes[1:]:
+                arrived.acquire()
+            try:
+                return fn(*args, **kwargs)
+            # let the other lanes go
+            finally:
+                finished.set()
+
+        for lane in self._lanes[1:]:
+            lane.submit(hold)
+        # the barrier itself runs on the first lane
+        return self._lanes[0].submit(run)
+
+    def lane(self, key):
+        """ Return the index of the lane that runs the tasks with the given key. """
+        return hash(key) % len(self._lanes) if key is not None else 0
+
+    def shutdown(self, wait=True):
+        for lane in self._lanes:
+            lane.shutdown(wait=wait)
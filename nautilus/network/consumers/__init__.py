@@ -1,2 +1,4 @@
 from .BasicConsumer import BasicConsumer
+from .PartitionedExecutor import PartitionedExecutor
 from .ActionConsumer import ActionConsumer
+from .AsyncActionConsumer import AsyncActionConsumer
@@ -0,0 +1,139 @@
+"""
+    This module defines the tools used to look after the actions that services
+    gave up on. Consumers send an action to the dead-letter exchange (along
+    with the error that got it there) once it has run out of attempts, and the
+    actions wait in the dead-letter queue until they are inspected or replayed.
+    Actions remember the service that failed them rather than its queue, so
+    they can be replayed after the service has been restarted.
+"""
+
+# external imports
+import pika
+# local imports
+from .codecs import get_codec, decompress
+from .dispatch import DEAD_LETTER_QUEUE, RETURN_EXCHANGE
+
+# the headers the consumers add to a dead action
+DEAD_LETTER_HEADERS = ('x-retries', 'x-error', 'x-service')
+
+
+def inspect_dead_letters(amqp_url='amqp://localhost/', limit=None):
+    """
+        Return the actions waiting in the dead-letter queue without removing
+        them from it.
+
+        Args:
+            amqp_url (optional, str): The url of the broker.
+
+            limit (optional, int): The maximum number of actions to return.
+
+        Returns:
+            list: A dictionary for each action with its type, payload, the
+                service it came from, the error that killed it, and the number
+                of times it was retried.
+    """
+    connection = pika.BlockingConnection(pika.URLParameters(amqp_url))
+    try:
+        channel = connection.channel()
+        dead_letters = []
+        for method, properties, body in _dead_letters(channel, limit):
+            headers = properties.headers or {}
+            action = _decode(properties, body)
+            dead_letters.append({
+                'type': action.get('type'),
+                'payload': action.get('payload'),
+                'service': headers.get('x-service'),
+                'error': headers.get('x-error'),
+                'retries': headers.get('x-retries', 0),
+            })
+
+        return dead_letters
+    # closing the connection puts the actions we looked at back in the queue
+    finally:
+        connection.close()
+
+
+def replay_dead_letters(amqp_url='amqp://localhost/', limit=None, service=None):
+    """
+        Send the actions in the dead-letter queue back to the services they
+        came from, with a fresh set of attempts. Actions whose service has no
+        consumers bound at the moment are left where they are.
+
+        Args:
+            amqp_url (optional, str): The url of the broker.
+
+            limit (optional, int): The maximum number of actions to replay.
+
+            service (optional, str): Only replay the actions that came from
+                this service.
+
+        Returns:
+            int: The number of actions that were replayed.
+    """
+    connection = pika.BlockingConnection(pika.URLParameters(amqp_url))
+    try:
+        channel = connection.channel()
+        # the broker tells us about the actions it can't route
+        channel.confirm_delivery()
+        channel.exchange_declare(exchange=RETURN_EXCHANGE['name'],
+                                 exchange_type=RETURN_EXCHANGE['type'],
+                                 durable=RETURN_EXCHANGE['durable'])
+        # the services nobody is listening for
+        unreachable = set()
+        replayed = 0
+        for method, properties, body in _dead_letters(channel):
+            headers = properties.headers or {}
+            origin = headers.get('x-service')
+            # if we are not supposed to touch this action
+            if origin is None or (service and origin != service) or origin in unreachable:
+                continue
+
+            # the action starts over once it's back with its service
+            properties.headers = {
+                key: value for key, value in headers.items() if key not in DEAD_LETTER_HEADERS
+            }
+            # if there is no queue to take the action
+            if not channel.basic_publish(RETURN_EXCHANGE['name'], origin, body, properties,
+                                         mandatory=True):
+                unreachable.add(origin)
+                continue
+            channel.basic_ack(method.delivery_tag)
+
+            replayed += 1
+            if limit and replayed >= limit:
+                break
+
+        return replayed
+    # the actions we skipped go back in the queue
+    finally:
+        connection.close()
+
+
+def _dead_letters(channel, limit=None):
+    """ Yield the (method, properties, body) of the actions in the dead-letter queue. """
+    count = 0
+    while not limit or count < limit:
+        method, properties, body = channel.basic_get(queue=DEAD_LETTER_QUEUE)
+        # if the queue is empty (or every action in it is in our hands)
+        if method is None:
+            return
+        count += 1
+        yield method, properties, body
+
+
+def _decode(properties, body):
+    """ Return the action in the body, or the raw body as its payload if it isn't one. """
+    try:
+        if properties.content_encoding:
+            body = decompress(body, properties.content_encoding)
+        action = get_codec(properties.content_type).decode(body)
+    # the action might have been dead-lettered because it couldn't be decoded
+    # (unknown codec, corrupt compression, ...)
+    except Exception:
+        return {'payload': body}
+
+    # if the body didn't hold an action
+    if not isinstance(action, dict):
+        return {'payload': action}
+
+    return action
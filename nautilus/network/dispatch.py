@@ -1,26 +1,203 @@
 """ Various helper functions for dealing with backend actions """
 
 # external imports
-import pika, json
+import asyncio
+import os
+import threading
+import time
+import uuid
+import pika
+# local imports
+from .publishers import BasicPublisher, AsyncPublisher
+from .codecs import get_codec, compress, DEFAULT_CONTENT_TYPE, DEFAULT_CONTENT_ENCODING
 
-def dispatch(body, exchange, routing_key=''):
+# the exchange that sends every action to every service
+ACTION_EXCHANGE = {
+    'name': 'actions',
+    'type': 'fanout',
+    'durable': True,
+}
+
+# the exchange that only sends actions to the services bound to their type
+TOPIC_ACTION_EXCHANGE = {
+    'name': 'action_topics',
+    'type': 'topic',
+    'durable': True,
+}
+
+# the exchanges that actions can be dispatched over, by type
+ACTION_EXCHANGES = {
+    'fanout': ACTION_EXCHANGE,
+    'topic': TOPIC_ACTION_EXCHANGE,
+}
+
+# the exchange that actions go to once a service has given up on handling them
+DEAD_LETTER_EXCHANGE = {
+    'name': 'actions.dead',
+    'type': 'fanout',
+    'durable': True,
+}
+
+# the queue that holds the dead actions until they are inspected or replayed
+DEAD_LETTER_QUEUE = 'actions.dead'
+
+# the exchange that brings retried and replayed actions back to the service
+# that failed them (whose consumers bind their queues with its name)
+RETURN_EXCHANGE = {
+    'name': 'actions.return',
+    'type': 'direct',
+    'durable': True,
+}
+
+# the header holding the time (in milliseconds since the epoch) an action was dispatched
+DISPATCHED_AT_HEADER = 'x-dispatched-at'
+
+# the factory used to create the process-wide publisher
+_publisher_factory = BasicPublisher
+# the process-wide publisher along with the id of the process that created it
+_publisher = None
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+# the factory used to create the publisher for coroutines
+_async_publisher_factory = AsyncPublisher
+# the publisher used by coroutines along with the id of the process that created it
+_async_publisher = None
+_async_publisher_pid = None
+
+# the content type of the codec used to encode actions
+_content_type = DEFAULT_CONTENT_TYPE
+# the size (in bytes) at which action bodies are compressed
+_compress_threshold = None
+# the exchange that actions are dispatched over
+_action_exchange = ACTION_EXCHANGE
+
+
+def configure_dispatch(publisher=None, async_publisher=None, codec=None,
+                       compress_threshold=None, exchange_type=None):
+    """
+        Configure how actions are sent over the network by this process.
+
+        Args:
+            publisher (optional, callable): A factory that takes no arguments
+                and returns the publisher to use (see nautilus.network.publishers).
+                The factory is called again in any process forked after the
+                publisher was created.
+
+            async_publisher (optional, callable): A factory that takes an event
+                loop and returns the publisher to use with dispatch_action_async.
+
+            codec (optional, str): The content type of the codec used to encode
+                actions (see nautilus.network.codecs).
+
+            compress_threshold (optional, int): Compress action bodies that are
+                at least this many bytes. Pass 0 to turn compression off.
+
+            exchange_type (optional, str): 'fanout' to send every action to every
+                service or 'topic' to route actions by their type. Every service
+                in a cloud should use the same exchange type.
+    """
+    global _publisher_factory, _async_publisher_factory, _async_publisher, \
+           _content_type, _compress_threshold, _action_exchange
+
+    # if we are replacing the publisher
+    if publisher:
+        # close the current one
+        close_publisher()
+        # and use the new factory from now on
+        _publisher_factory = publisher
+
+    # if we are replacing the publisher used by coroutines
+    if async_publisher:
+        # the next coroutine to dispatch an action will create a new one
+        _async_publisher_factory = async_publisher
+        _async_publisher = None
+
+    # if we are changing the way actions are encoded
+    if codec:
+        # make sure we know how to use the codec before we rely on it
+        _content_type = get_codec(codec).content_type
+
+    # if we are changing which actions are compressed
+    if compress_threshold is not None:
+        _compress_threshold = compress_threshold or None
+
+    # if we are changing the exchange
+    if exchange_type:
+        _action_exchange = ACTION_EXCHANGES[exchange_type]
+
+
+def get_publisher():
+    """
+        Return the publisher for the current process, creating it if this
+        process has not used one yet. Connections cannot be shared across a
+        fork so a child process never reuses its parent's publisher.
+    """
+    global _publisher, _publisher_pid
+
+    pid = os.getpid()
+    # if there is no publisher we can use in this process
+    if _publisher is None or _publisher_pid != pid:
+        with _publisher_lock:
+            # make sure another thread didn't beat us to it
+            if _publisher is None or _publisher_pid != pid:
+                # note: the parent's publisher is dropped but not closed since
+                # its connections still belong to the parent
+                _publisher = _publisher_factory()
+                _publisher_pid = pid
+
+    return _publisher
+
+
+def flush_actions():
+    """ Send any actions that the publisher of the current process is holding onto. """
+    # if this process has a publisher of its own
+    if _publisher is not None and _publisher_pid == os.getpid():
+        _publisher.flush()
+
+
+def close_publisher():
+    """ Close the publisher of the current process, if there is one. """
+    global _publisher, _publisher_pid
+
+    with _publisher_lock:
+        # only the process that created the publisher can close it
+        if _publisher is not None and _publisher_pid == os.getpid():
+            _publisher.close()
+        # forget the publisher
+        _publisher = None
+        _publisher_pid = None
+
+
+def get_async_publisher():
+    """
+        Return the publisher used by coroutines on the current event loop,
+        creating it if necessary. Like get_publisher, a child process never
+        reuses the publisher of its parent.
+    """
+    global _async_publisher, _async_publisher_pid
+
+    loop = asyncio.get_event_loop()
+    # if there is no publisher we can use on this loop
+    if _async_publisher is None or _async_publisher_pid != os.getpid() \
+                                or _async_publisher.loop is not loop:
+        _async_publisher = _async_publisher_factory(loop=loop)
+        _async_publisher_pid = os.getpid()
+
+    return _async_publisher
+
+
+def dispatch(body, exchange, routing_key='', properties=None):
     """ dispatch the action through the message queue """
-    # connect to the rabbit mq server
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-    # open a channel
-    channel = connection.channel()
-    # make sure the exchange matches our expectations
-    channel.exchange_declare(
-        exchange=exchange['name'],
-        type=exchange['type'],
-        durable=exchange['durable']
+    return get_publisher().publish(
+        body=body,
+        exchange=exchange,
+        routing_key=routing_key,
+        properties=properties
     )
-    # send the message over the exchange
-    channel.basic_publish(exchange=exchange['name'], routing_key=routing_key, body=body)
-    # close the connection
-    connection.close()
 
-def dispatch_action(action_type, payload):
+
+def dispatch_action(action_type, payload, message_id=None):
     """
         This function dispatches an event over the action exchange with the designated
         type and payload.
@@ -29,19 +206,89 @@ def dispatch_action(action_type, payload):
             action_type (string): The type of the action. Used by action handlers to figure out
                 if it should respond to the event.
             payload (anything serializable): The payload associated with the action.
+            message_id (optional, string): The id consumers use to recognize the
+                action if it is delivered more than once. Defaults to a new id.
+
+        Returns:
+            concurrent.futures.Future: If the publisher waits for confirmations
+                (see nautilus.network.publishers.ConfirmPublisher), a future that
+                resolves once the broker has the action. If it sends actions in
+                batches (see nautilus.network.publishers.BatchPublisher), a future
+                that resolves once the batch is sent. Otherwise None.
     """
-    # the exchange to dispatch to
-    exchange = {
-        'name': 'actions',
-        'type': 'fanout',
-        'durable': True,
-    }
+    # encode the action
+    body, properties = _serialize_action(action_type, payload, message_id)
+    # and dispatch it over the exchange, routed by its type
+    return dispatch(
+        body=body,
+        exchange=_action_exchange,
+        routing_key=action_type,
+        properties=properties
+    )
+
+
+async def dispatch_action_async(action_type, payload, message_id=None):
+    """
+        This coroutine dispatches an event over the action exchange and waits
+        for the broker to confirm it. Every coroutine on the event loop shares
+        the same connection.
+
+        Args:
+            action_type (string): The type of the action. Used by action handlers to figure out
+                if it should respond to the event.
+            payload (anything serializable): The payload associated with the action.
+            message_id (optional, string): The id consumers use to recognize the
+                action if it is delivered more than once. Defaults to a new id.
+
+        Example:
+
+            .. code-block:: python
 
+                await asyncio.gather(*[
+                    dispatch_action_async('create_recipe', {'name': name}) for name in names
+                ])
+    """
+    # encode the action
+    body, properties = _serialize_action(action_type, payload, message_id)
+    # and dispatch it over the exchange, routed by its type
+    return await get_async_publisher().publish(
+        body=body,
+        exchange=_action_exchange,
+        routing_key=action_type,
+        properties=properties
+    )
+
+
+def _serialize_action(action_type, payload, message_id=None):
+    """ Build the message body and properties for an action with the given type and payload. """
     # the action object
     action = {
         'type': action_type,
         'payload': payload,
     }
 
-    # dispatch a stringified version of the action over the exchange
-    dispatch(body=json.dumps(action), exchange=exchange)
+    # encode the action with the designated codec
+    body = get_codec(_content_type).encode(action)
+
+    # compress the body if it is big enough to be worth it
+    content_encoding = None
+    if _compress_threshold and len(body) >= _compress_threshold:
+        compressed = compress(body)
+        # if compressing actually saved some space
+        if compressed is not None:
+            body = compressed
+            content_encoding = DEFAULT_CONTENT_ENCODING
+
+    # let the consumer know how to decode the body (and recognize it if it shows up twice)
+    properties = pika.BasicProperties(
+        content_type=_content_type,
+        content_encoding=content_encoding,
+        message_id=message_id or uuid.uuid4().hex,
+        # consumers can skip the actions they don't care about without decoding them
+        type=action_type,
+        # consumers measure how long the action took to reach them (in milliseconds
+        # since the timestamp property only counts seconds)
+        headers={DISPATCHED_AT_HEADER: int(time.time() * 1000)},
+    )
+
+    return body, properties
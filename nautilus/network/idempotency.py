@@ -0,0 +1,90 @@
+"""
+    This module defines the cache consumers use to recognize actions they have
+    already handled. Delivery is at least once, so an action can show up again
+    after a reconnect (or be published twice by a relay that crashed at the
+    wrong time). Every dispatched action carries a message id, and a consumer
+    that has seen the id before can drop the action without handling it again.
+"""
+
+# external imports
+import collections
+import threading
+
+
+class IdempotencyCache:
+    """
+        A bounded set of the ids of the actions that have been handled. The
+        least recently seen ids are forgotten once the cache is full.
+
+        Args:
+            size (optional, int): The number of ids to hold on to.
+
+            store (optional, object): A persistent record of handled ids
+                with `handled(message_ids)` (returning the set of those that
+                were handled) and `add(message_ids)` methods (see
+                nautilus.models.idempotency). The store is consulted for the
+                ids that aren't in memory so duplicates are recognized across
+                restarts and processes.
+    """
+    SIZE = 10000
+
+    def __init__(self, size=None, store=None):
+        self._size = size or self.SIZE
+        self.store = store
+        self._lock = threading.Lock()
+        self._ids = collections.OrderedDict()
+
+    def __contains__(self, message_id):
+        """ Return whether the action with the given id has been handled. """
+        return message_id in self.handled([message_id])
+
+    def seen(self, message_id):
+        """
+            Return whether the action with the given id was handled recently,
+            without consulting the store.
+        """
+        with self._lock:
+            # if we've seen the id recently
+            if message_id in self._ids:
+                self._ids.move_to_end(message_id)
+                return True
+
+        return False
+
+    def handled(self, message_ids):
+        """
+            Return the set of the given ids whose actions have been handled,
+            looking the ids that aren't in memory up in the store all at once.
+        """
+        handled = {message_id for message_id in message_ids if self.seen(message_id)}
+        # the ids we haven't seen recently
+        unknown = [message_id for message_id in message_ids if message_id not in handled]
+
+        # if some of the actions might have been handled by another process (or before a restart)
+        if unknown and self.store is not None:
+            stored = self.store.handled(unknown)
+            if stored:
+                self._remember(stored)
+                handled.update(stored)
+
+        return handled
+
+    def add(self, message_ids):
+        """ Record that the actions with the given ids have been handled. """
+        message_ids = [message_id for message_id in message_ids if message_id]
+        # if there is nothing to remember
+        if not message_ids:
+            return
+
+        self._remember(message_ids)
+        if self.store is not None:
+            self.store.add(message_ids)
+
+    def _remember(self, message_ids):
+        with self._lock:
+            for message_id in message_ids:
+                self._ids[message_id] = True
+                self._ids.move_to_end(message_id)
+            # forget the oldest ids once we have too many
+            while len(self._ids) > self._size:
+                self._ids.popitem(last=False)
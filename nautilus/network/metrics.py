@@ -0,0 +1,129 @@
+"""
+    This module defines the metrics kept by action consumers. Every type of
+    action gets its own counters along with latency histograms for each stage
+    of its trip through the consumer. Snapshots of the metrics are plain
+    dictionaries so they can be sent between processes and merged.
+"""
+
+# external imports
+import bisect
+import collections
+import threading
+
+# the upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+# the events counted for each type of action
+COUNTERS = ('received', 'handled', 'failed', 'dropped', 'duplicates')
+
+# the stages timed for each type of action
+STAGES = (
+    # from dispatch_action to the consumer
+    'lag',
+    # decompressing and decoding the body
+    'decode',
+    # running the handler
+    'handler',
+    # from the handler returning to the message being settled
+    'ack',
+)
+
+
+class Histogram:
+    """ Counts observations in fixed buckets, keeping track of their sum. """
+
+    def __init__(self):
+        # the last bucket holds everything bigger than the last bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {
+            'buckets': list(BUCKETS) + ['+Inf'],
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class _ActionMetrics:
+    """ The metrics for one type of action. """
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.histograms = {stage: Histogram() for stage in STAGES}
+
+    def snapshot(self):
+        snapshot = dict(self.counters)
+        snapshot.update({stage: histogram.snapshot() for stage, histogram in self.histograms.items()})
+        return snapshot
+
+
+class ConsumerMetrics:
+    """
+        The counters and latency histograms of a consumer, by action type. Every
+        method is thread-safe since actions can be handled on worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._actions = collections.defaultdict(_ActionMetrics)
+
+    def count(self, action_type, counter, amount=1):
+        """ Add to one of the counters (see COUNTERS) of the given type of action. """
+        with self._lock:
+            self._actions[action_type or 'unknown'].counters[counter] += amount
+
+    def observe(self, action_type, stage, seconds):
+        """ Record how long one of the stages (see STAGES) took for an action of the given type. """
+        with self._lock:
+            self._actions[action_type or 'unknown'].histograms[stage].observe(seconds)
+
+    def snapshot(self):
+        """ Return the metrics of every type of action as a dictionary. """
+        with self._lock:
+            return {
+                action_type: metrics.snapshot() for action_type, metrics in self._actions.items()
+            }
+
+
+def merge_snapshots(snapshots):
+    """
+        Combine the snapshots of several consumers (see ActionConsumer.metrics_snapshot)
+        into one, adding up their counters, histograms and gauges (except for
+        the recovery time, which is the longest of them).
+    """
+    merged = {'actions': {}}
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            # the slowest recovery is the one worth knowing about
+            if key == 'recovery_time':
+                merged[key] = max(merged.get(key) or 0, value or 0)
+                continue
+            # the other gauges add up
+            elif key != 'actions':
+                merged[key] = merged.get(key, 0) + (value or 0)
+                continue
+
+            for action_type, metrics in value.items():
+                total = merged['actions'].setdefault(action_type, {})
+                for name, metric in metrics.items():
+                    # if the metric is a counter
+                    if not isinstance(metric, dict):
+                        total[name] = total.get(name, 0) + metric
+                    # if it's a histogram we haven't seen yet
+                    elif name not in total:
+                        total[name] = dict(metric, counts=list(metric['counts']))
+                    else:
+                        histogram = total[name]
+                        histogram['counts'] = [a + b for a, b in zip(histogram['counts'], metric['counts'])]
+                        histogram['sum'] += metric['sum']
+                        histogram['count'] += metric['count']
+
+    return merged
@@ -0,0 +1,227 @@
+"""
+    This publisher sends messages through RabbitMQ from coroutines running on
+    an asyncio event loop.
+"""
+
+# external imports
+import asyncio
+import collections
+import logging
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+# local imports
+from .ConfirmPublisher import DeliveryFailed
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncPublisher:
+    """
+        This publisher drives a single AsyncioConnection on the given event
+        loop and can be shared by any number of coroutines running on it. The
+        channel is in confirm mode so awaiting a publish resolves once the
+        broker has taken responsibility for the message; up to `window`
+        publishes can be waiting on a confirmation at once.
+
+        Args:
+            amqp_url (optional, str): The AMQP url to connect with.
+
+            window (optional, int): The maximum number of unconfirmed messages.
+                Pass 0 for an unbounded window.
+
+            timeout (optional, number): The number of seconds to wait for a
+                confirmation before raising asyncio.TimeoutError.
+
+            loop (optional, asyncio.AbstractEventLoop): The event loop to run
+                on. Defaults to the loop the publisher is first used on.
+
+        Example:
+
+            .. code-block:: python
+
+                publisher = AsyncPublisher()
+
+                async def create_recipes(names):
+                    exchange = {'name': 'recipes', 'type': 'fanout', 'durable': True}
+                    await asyncio.gather(*[
+                        publisher.publish(body=name, exchange=exchange) for name in names
+                    ])
+    """
+    MESSAGE_URL = 'amqp://localhost/'
+    WINDOW = 1000
+    TIMEOUT = 30
+
+    def __init__(self, amqp_url=None, window=None, timeout=None, loop=None):
+        self._url = amqp_url or self.MESSAGE_URL
+        self.loop = loop
+        self._window_size = self.WINDOW if window is None else window
+        # created on the running loop by the first publish
+        self._window = None
+        self._timeout = timeout or self.TIMEOUT
+
+        self._connection = None
+        # resolves to the open channel
+        self._channel = None
+        # resolves once the exchange with the given name has been declared
+        self._exchanges = {}
+        # the futures of the messages waiting on a confirmation, by delivery tag
+        self._deliveries = collections.OrderedDict()
+        # the delivery tag of the last message sent over the current channel
+        self._message_number = 0
+
+    async def publish(self, body, exchange, routing_key='', properties=None):
+        """
+            Publish the given body over the exchange and wait for the broker to
+            confirm it.
+
+            Args:
+                body (bytes|str): The message body.
+                exchange (dict): The name, type, and durability of the exchange.
+                routing_key (optional, str): The routing key of the message.
+                properties (optional, pika.BasicProperties): The message properties.
+
+            Raises:
+                DeliveryFailed: If the broker nacked the message or the
+                    connection closed before it was confirmed.
+                asyncio.TimeoutError: If the broker did not answer in time.
+        """
+        # the publisher belongs to the loop it is first used on
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        # the window is created inside the loop so it is bound to it
+        if self._window is None and self._window_size:
+            self._window = asyncio.Semaphore(self._window_size)
+
+        # wait for a spot to open up in the window
+        if self._window:
+            await self._window.acquire()
+
+        try:
+            channel = await self._get_channel()
+            # make sure the exchange matches our expectations
+            await self._declare_exchange(channel, exchange)
+
+            channel.basic_publish(
+                exchange=exchange['name'],
+                routing_key=routing_key,
+                body=body,
+                properties=properties
+            )
+            # keep track of the message until the broker confirms it
+            self._message_number += 1
+            confirmation = self.loop.create_future()
+            self._deliveries[self._message_number] = confirmation
+
+            return await asyncio.wait_for(confirmation, self._timeout)
+
+        finally:
+            # make room in the window for another message
+            if self._window:
+                self._window.release()
+
+    async def flush(self):
+        """ Wait until every message published so far has been confirmed (or has failed). """
+        if self._deliveries:
+            await asyncio.wait(list(self._deliveries.values()))
+
+    async def close(self):
+        """ Wait for the outstanding confirmations and then close the connection. """
+        await self.flush()
+        if self._connection and not self._connection.is_closed:
+            self._connection.close()
+
+    def _get_channel(self):
+        """ Return a future that resolves to an open channel, connecting if necessary. """
+        # if there is no channel on its way
+        if self._channel is None:
+            self._channel = self.loop.create_future()
+            self._connection = self.connect()
+
+        return self._channel
+
+    def connect(self):
+        """ Connect to RabbitMQ, returning the connection handle. """
+        LOGGER.info('Connecting to %s', self._url)
+        return AsyncioConnection(pika.URLParameters(self._url),
+                                 on_open_callback=self.on_connection_open,
+                                 on_open_error_callback=self.on_connection_error,
+                                 on_close_callback=self.on_connection_closed,
+                                 stop_ioloop_on_close=False,
+                                 custom_ioloop=self.loop)
+
+    def on_connection_open(self, connection):
+        LOGGER.info('Connection opened')
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_error(self, connection, error):
+        LOGGER.warning('Could not connect: %s', error)
+        # the next publish will try again
+        channel, self._channel = self._channel, None
+        if channel and not channel.done():
+            channel.set_exception(DeliveryFailed('Could not connect: {}'.format(error)))
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        """ Fail every outstanding message. The next publish reconnects. """
+        LOGGER.warning('Connection closed: (%s) %s', reply_code, reply_text)
+        reason = 'Connection closed: ({}) {}'.format(reply_code, reply_text)
+
+        channel, self._channel = self._channel, None
+        if channel and not channel.done():
+            channel.set_exception(DeliveryFailed(reason))
+
+        # declarations and delivery tags are scoped to the channel
+        exchanges, self._exchanges = self._exchanges, {}
+        deliveries, self._deliveries = self._deliveries, collections.OrderedDict()
+        for waiting in list(exchanges.values()) + list(deliveries.values()):
+            if not waiting.done():
+                waiting.set_exception(DeliveryFailed(reason))
+
+    def on_channel_open(self, channel):
+        """ Put the new channel in confirm mode and hand it to the waiting publishes. """
+        LOGGER.info('Channel opened')
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.confirm_delivery(self.on_delivery_confirmation)
+        self._message_number = 0
+        self._channel.set_result(channel)
+
+    def on_channel_closed(self, channel, reply_code, reply_text):
+        LOGGER.warning('Channel %i was closed: (%s) %s', channel, reply_code, reply_text)
+        # closing the connection will fail the outstanding messages
+        if not self._connection.is_closing and not self._connection.is_closed:
+            self._connection.close()
+
+    def on_delivery_confirmation(self, method_frame):
+        """ Resolve the future of every message covered by the confirmation. """
+        method = method_frame.method
+        acked = method.NAME == 'Basic.Ack'
+
+        # the delivery tags covered by the confirmation
+        if method.multiple:
+            tags = [tag for tag in self._deliveries if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            confirmation = self._deliveries.pop(tag, None)
+            # if the publish already gave up on the message
+            if confirmation is None or confirmation.done():
+                continue
+
+            if acked:
+                confirmation.set_result(True)
+            else:
+                confirmation.set_exception(DeliveryFailed('Message was nacked by the broker'))
+
+    def _declare_exchange(self, channel, exchange):
+        """ Return a future that resolves once the exchange has been declared on the channel. """
+        # if no one has declared the exchange yet
+        if exchange['name'] not in self._exchanges:
+            declared = self._exchanges[exchange['name']] = self.loop.create_future()
+            channel.exchange_declare(
+                lambda frame: declared.done() or declared.set_result(True),
+                exchange['name'],
+                exchange['type'],
+                durable=exchange['durable']
+            )
+
+        return self._exchanges[exchange['name']]
@@ -0,0 +1,225 @@
+"""
+    This is the basic publisher class used to send messages through RabbitMQ.
+    Rather than paying for a connection handshake on every message, it keeps a
+    pool of long-lived connections (each with a single channel) that are
+    checked out for the duration of a publish.
+
+    Blocking connections only talk to the broker while they are being used,
+    so an idle connection doesn't answer heartbeats and the broker eventually
+    drops it. Connections catch up on their I/O when they are checked out and
+    are replaced once they have been idle for too long.
+"""
+
+# external imports
+import logging
+import queue
+import threading
+import time
+import pika
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _PooledChannel:
+    """ A single connection/channel pair owned by a publisher pool. """
+
+    def __init__(self, amqp_url):
+        self.connection = pika.BlockingConnection(pika.URLParameters(amqp_url))
+        self.channel = self.connection.channel()
+        # the names of the exchanges that have been declared on this channel
+        self.exchanges = set()
+        # when the channel was last put back in the pool
+        self.last_used = time.monotonic()
+
+    @property
+    def is_open(self):
+        return self.connection.is_open and self.channel.is_open
+
+    def refresh(self):
+        """
+            Process whatever happened on the connection while it was idle
+            (heartbeats, the broker closing it, ...), returning whether the
+            channel can still be used.
+        """
+        try:
+            self.connection.process_data_events(time_limit=0)
+        except pika.exceptions.AMQPError:
+            return False
+        return self.is_open
+
+    def declare_exchange(self, exchange):
+        """ Declare the given exchange unless this channel already has. """
+        if exchange['name'] not in self.exchanges:
+            self.channel.exchange_declare(
+                exchange=exchange['name'],
+                exchange_type=exchange['type'],
+                durable=exchange['durable']
+            )
+            self.exchanges.add(exchange['name'])
+
+    def close(self):
+        try:
+            self.connection.close()
+        # the connection might have already been closed by the broker
+        except pika.exceptions.AMQPError:
+            pass
+
+
+class BasicPublisher:
+    """
+        This publisher maintains a pool of blocking connections to RabbitMQ
+        which are reused across publishes. Connections are opened lazily (up to
+        the size of the pool) and exchange declarations are cached per channel
+        so a publish on a warm pool is a single basic_publish. Connections
+        that have been idle for more than `max_idle` seconds are replaced
+        rather than reused, since the broker might have given up on them.
+        If a channel fails in the middle of a batch, the messages it hadn't
+        sent yet are published again on a fresh connection.
+
+        Publishers are not fork-safe: a child process should create its own
+        publisher rather than reuse one created by its parent (see
+        nautilus.network.dispatch.get_publisher).
+
+        Args:
+            amqp_url (optional, str): The AMQP url to connect with.
+
+            pool_size (optional, int): The maximum number of connections to
+                keep open at once.
+
+            max_idle (optional, number): The number of seconds a connection
+                can sit in the pool before it is replaced.
+    """
+    MESSAGE_URL = 'amqp://localhost/'
+    POOL_SIZE = 4
+    MAX_IDLE = 30
+
+    def __init__(self, amqp_url=None, pool_size=None, max_idle=None):
+        self._url = amqp_url or self.MESSAGE_URL
+        self._pool_size = pool_size or self.POOL_SIZE
+        self._max_idle = max_idle or self.MAX_IDLE
+        # idle channels waiting to be used
+        self._pool = queue.LifoQueue()
+        # the number of channels owned by the pool (idle or checked out)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def publish(self, body, exchange, routing_key='', properties=None):
+        """
+            Publish the given body over the exchange.
+
+            Args:
+                body (bytes|str): The message body.
+                exchange (dict): The name, type, and durability of the exchange.
+                routing_key (optional, str): The routing key of the message.
+                properties (optional, pika.BasicProperties): The message properties.
+        """
+        self.publish_many([(body, exchange, routing_key, properties)])
+
+    def publish_many(self, messages):
+        """
+            Publish a sequence of (body, exchange, routing_key, properties)
+            tuples over a single checked out channel.
+        """
+        # make sure we can slice the messages
+        messages = list(messages)
+        # the number of messages that made it onto a channel
+        sent = 0
+
+        slot = self._checkout()
+        try:
+            for message in messages:
+                self._publish(slot, message)
+                sent += 1
+        # if the connection went away under us
+        except pika.exceptions.AMQPError as err:
+            LOGGER.warning('Publishing channel failed after %s of %s messages, reconnecting: %r',
+                           sent, len(messages), err)
+            # throw away the broken channel and send the rest on a fresh one
+            # note: the message that failed is assumed not to have made it
+            self._discard(slot)
+            slot = self._open()
+            try:
+                for message in messages[sent:]:
+                    self._publish(slot, message)
+            except Exception:
+                self._discard(slot)
+                raise
+        except Exception:
+            self._discard(slot)
+            raise
+
+        # the channel is healthy so put it back in the pool
+        slot.last_used = time.monotonic()
+        self._pool.put(slot)
+
+    def flush(self):
+        """ Messages are sent as soon as they are published so there is nothing to do. """
+
+    def close(self):
+        """ Close every idle connection in the pool. """
+        while True:
+            try:
+                slot = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(slot)
+
+    def _publish(self, slot, message):
+        body, exchange, routing_key, properties = message
+        # make sure the exchange matches our expectations
+        slot.declare_exchange(exchange)
+        # send the message over the exchange
+        slot.channel.basic_publish(
+            exchange=exchange['name'],
+            routing_key=routing_key,
+            body=body,
+            properties=properties
+        )
+
+    def _checkout(self):
+        """ Grab an idle channel from the pool, opening a new one if there is room. """
+        while True:
+            try:
+                slot = self._pool.get_nowait()
+            except queue.Empty:
+                # if there is room for another connection
+                with self._lock:
+                    has_room = self._size < self._pool_size
+                    # claim the spot before another thread does
+                    if has_room:
+                        self._size += 1
+                # open a new one
+                if has_room:
+                    return self._connect()
+                # otherwise wait for another thread to return a channel
+                slot = self._pool.get()
+
+            # if the broker might have given up on the connection, start over
+            if time.monotonic() - slot.last_used > self._max_idle:
+                self._discard(slot)
+                return self._open()
+            # only hand out channels that are still alive
+            if slot.refresh():
+                return slot
+            self._discard(slot)
+
+    def _open(self):
+        """ Open a new channel that counts against the size of the pool. """
+        with self._lock:
+            self._size += 1
+        return self._connect()
+
+    def _connect(self):
+        """ Open a new channel in a spot of the pool that has already been claimed. """
+        try:
+            return _PooledChannel(self._url)
+        except Exception:
+            with self._lock:
+                self._size -= 1
+            raise
+
+    def _discard(self, slot):
+        """ Close the given channel and free up its spot in the pool. """
+        slot.close()
+        with self._lock:
+            self._size -= 1
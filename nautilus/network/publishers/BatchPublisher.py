@@ -0,0 +1,202 @@
+"""
+    This publisher buffers messages in memory and hands them off to another
+    publisher in batches, trading a little latency for far fewer trips to the
+    broker.
+"""
+
+# external imports
+import logging
+import threading
+from concurrent.futures import CancelledError, Future
+# local imports
+from .BasicPublisher import BasicPublisher
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BatchPublisher:
+    """
+        This publisher queues messages until one of its limits is reached and
+        then sends the whole batch over a single channel of the underlying
+        publisher. Messages are always sent in the order they were published.
+
+        Every publish returns a concurrent.futures.Future for each message. If
+        the underlying publisher returns futures of its own (see
+        nautilus.network.publishers.ConfirmPublisher), the future follows the
+        one of the message. Otherwise it resolves to True once the batch has
+        been handed off. If a batch can't be sent, its messages are put back at
+        the front of the buffer and sent again with the next flush, so publish
+        never raises: the futures resolve once the messages are sent (and can't
+        be cancelled once they have been handed out).
+
+        Args:
+            publisher (optional, BasicPublisher): The publisher used to send
+                each batch. Defaults to a new BasicPublisher.
+
+            max_count (optional, int): The number of buffered messages that
+                triggers a flush.
+
+            max_bytes (optional, int): The combined size of the buffered message
+                bodies that triggers a flush.
+
+            max_delay (optional, int): The maximum number of milliseconds a
+                message can wait in the buffer.
+    """
+    MAX_COUNT = 100
+    MAX_BYTES = 1024 * 1024
+    MAX_DELAY = 50
+
+    def __init__(self, publisher=None, max_count=None, max_bytes=None, max_delay=None):
+        self._publisher = publisher or BasicPublisher()
+        self._max_count = max_count or self.MAX_COUNT
+        self._max_bytes = max_bytes or self.MAX_BYTES
+        self._max_delay = max_delay or self.MAX_DELAY
+        # the (message, future) pairs waiting to be sent and the size of their bodies
+        self._buffer = []
+        self._buffer_bytes = 0
+        # the timer that flushes the buffer when the oldest message is too old
+        self._timer = None
+        # guards the buffer
+        self._lock = threading.Lock()
+        # makes sure batches are sent one at a time (and therefore in order)
+        self._flush_lock = threading.Lock()
+        # whether the publisher is shutting down
+        self._closing = False
+
+    def publish(self, body, exchange, routing_key='', properties=None):
+        """
+            Add the message to the buffer, flushing it if it is full.
+
+            Returns:
+                concurrent.futures.Future: Resolves once the message has been sent.
+        """
+        return self.publish_many([(body, exchange, routing_key, properties)])[0]
+
+    def publish_many(self, messages):
+        """
+            Add a sequence of (body, exchange, routing_key, properties) tuples
+            to the buffer, returning the future of each one.
+        """
+        futures = []
+        with self._lock:
+            for message in messages:
+                future = Future()
+                # the message is ours to send from now on
+                future.set_running_or_notify_cancel()
+                self._buffer.append((message, future))
+                self._buffer_bytes += len(message[0])
+                futures.append(future)
+
+            # if one of the limits has been reached
+            is_full = len(self._buffer) >= self._max_count \
+                            or self._buffer_bytes >= self._max_bytes
+
+            # if the buffer needs to be flushed eventually
+            if not is_full and self._buffer:
+                self._start_timer()
+
+        # send the buffer if its full
+        if is_full:
+            try:
+                self.flush()
+            # the batch stays in the buffer (and the futures pending) until it can be sent.
+            # raising would only make the caller publish the messages a second time
+            except Exception:
+                pass
+
+        return futures
+
+    def flush(self):
+        """
+            Send every buffered message.
+
+            Returns:
+                list: The futures of the messages that were sent.
+
+            Raises:
+                Exception: Whatever the underlying publisher raised. The messages
+                    are kept in the buffer and sent with the next flush.
+        """
+        with self._flush_lock:
+            # grab the current buffer and start a new one
+            with self._lock:
+                batch = self._buffer
+                self._buffer = []
+                self._buffer_bytes = 0
+                # the buffer is empty so there's nothing left to time out
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+
+            # if there is nothing to send
+            if not batch:
+                return []
+
+            messages = [message for message, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = self._publisher.publish_many(messages)
+            except Exception:
+                LOGGER.error('Could not publish a batch of %s messages, keeping them for the next flush',
+                             len(messages))
+                # put the batch back in front of anything published in the meantime
+                with self._lock:
+                    self._buffer[:0] = batch
+                    self._buffer_bytes += sum(len(message[0]) for message in messages)
+                    # try again once the messages have waited a while longer
+                    if not self._closing:
+                        self._start_timer()
+                raise
+
+            # if the underlying publisher tracks each message
+            if results is not None:
+                for future, result in zip(futures, results):
+                    _follow(future, result)
+            else:
+                for future in futures:
+                    future.set_result(True)
+
+            return futures
+
+    def close(self):
+        """ Send whatever is left in the buffer and close the underlying publisher. """
+        self._closing = True
+        try:
+            self.flush()
+        finally:
+            self._publisher.close()
+
+    def _start_timer(self):
+        """ Flush the buffer once the oldest message has waited long enough. Must hold _lock. """
+        if not self._timer:
+            self._timer = threading.Timer(self._max_delay / 1000, self._flush_on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        # there is nobody to raise to on the timer thread
+        except Exception:
+            LOGGER.exception('Failed to flush buffered messages')
+
+
+def _follow(future, result):
+    """ Resolve the future like the one the underlying publisher returned for the message. """
+    # if the publisher didn't hand out a future for the message
+    if not hasattr(result, 'add_done_callback'):
+        future.set_result(True if result is None else result)
+        return
+
+    def copy(result):
+        # note: our future is running so it can't be cancelled along with the other one
+        if result.cancelled():
+            future.set_exception(CancelledError())
+            return
+        error = result.exception()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result.result())
+
+    result.add_done_callback(copy)
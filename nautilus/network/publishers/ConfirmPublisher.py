@@ -0,0 +1,352 @@
+"""
+    This publisher uses RabbitMQ publisher confirms to make sure messages reach
+    the broker without waiting on a round trip for each one.
+    source: http://pika.readthedocs.org/en/latest/examples/asynchronous_publisher_example.html
+"""
+
+# external imports
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError, wait
+import pika
+from pika.adapters.select_connection import IOLoop
+
+LOGGER = logging.getLogger(__name__)
+
+
+class DeliveryFailed(Exception):
+    """ Raised by the future of a message the broker did not take responsibility for. """
+
+
+class ConfirmPublisher:
+    """
+        This publisher puts its channel in confirm mode and runs the connection
+        on a background IOLoop. Up to `window` messages can be waiting on a
+        confirmation at once; once the window is full, publish blocks until the
+        broker catches up.
+
+        Every publish returns a concurrent.futures.Future which resolves to True
+        when the broker acks the message (the future is already running, so it
+        can't be cancelled). If the broker nacks the message or the
+        connection is lost first, the future raises DeliveryFailed. If there is
+        no answer within `timeout` seconds of the call to publish (including
+        the time spent waiting for a connection), the future raises TimeoutError.
+
+        Args:
+            amqp_url (optional, str): The AMQP url to connect with.
+
+            window (optional, int): The maximum number of unconfirmed messages.
+                Pass 0 for an unbounded window.
+
+            timeout (optional, number): The number of seconds to wait for a
+                confirmation.
+
+            on_nack (optional, function): Called with the (body, exchange,
+                routing_key, properties) tuple of every failed message.
+
+            on_timeout (optional, function): Called with the (body, exchange,
+                routing_key, properties) tuple of every message that timed out.
+    """
+    MESSAGE_URL = 'amqp://localhost/'
+    WINDOW = 1000
+    TIMEOUT = 30
+    RECONNECT_DELAY = 5
+
+    def __init__(self, amqp_url=None, window=None, timeout=None, on_nack=None,
+                 on_timeout=None):
+        self._url = amqp_url or self.MESSAGE_URL
+        window = self.WINDOW if window is None else window
+        self._window = threading.BoundedSemaphore(window) if window else None
+        self._timeout = timeout or self.TIMEOUT
+        self._on_nack = on_nack
+        self._on_timeout = on_timeout
+
+        # the IOLoop is shared by every connection we open
+        self._ioloop = IOLoop()
+        self._thread = None
+        self._connection = None
+        self._channel = None
+        self._closing = False
+        self._lock = threading.Lock()
+
+        # the (future, message, deadline) of the messages waiting to be written to the
+        # channel. publishers append to it and the IOLoop pops from the other end
+        self._outbox = collections.deque()
+        # messages waiting on a confirmation, ordered by delivery tag
+        self._deliveries = collections.OrderedDict()
+        # the delivery tag of the last message sent over the current channel
+        self._message_number = 0
+        # the exchanges declared on the current channel
+        self._exchanges = set()
+        # every future that hasn't resolved yet
+        self._futures = set()
+
+    def publish(self, body, exchange, routing_key='', properties=None):
+        """
+            Publish the given body over the exchange.
+
+            Args:
+                body (bytes|str): The message body.
+                exchange (dict): The name, type, and durability of the exchange.
+                routing_key (optional, str): The routing key of the message.
+                properties (optional, pika.BasicProperties): The message properties.
+
+            Returns:
+                concurrent.futures.Future: Resolves when the broker confirms the message.
+        """
+        return self.publish_many([(body, exchange, routing_key, properties)])[0]
+
+    def publish_many(self, messages):
+        """
+            Publish a sequence of (body, exchange, routing_key, properties)
+            tuples, returning the future of each one.
+        """
+        # make sure the IOLoop is running
+        self._start()
+
+        futures = []
+        # whether there are messages the IOLoop doesn't know about
+        pending = False
+        for message in messages:
+            # if the window is full
+            if self._window and not self._window.acquire(blocking=False):
+                # the messages we already queued have to go out before anything can be confirmed
+                if pending:
+                    self._ioloop.add_callback_threadsafe(self._publish_pending)
+                    pending = False
+                # wait for a spot to open up
+                self._window.acquire()
+
+            future = Future()
+            # the IOLoop resolves the future from now on, so it can't be cancelled
+            future.set_running_or_notify_cancel()
+            with self._lock:
+                self._futures.add(future)
+            future.add_done_callback(self._on_future_done)
+
+            # hand the message off to the IOLoop
+            self._outbox.append((future, message, time.monotonic() + self._timeout))
+            futures.append(future)
+            pending = True
+
+        # wake up the IOLoop to send the messages
+        if pending:
+            self._ioloop.add_callback_threadsafe(self._publish_pending)
+
+        return futures
+
+    def flush(self, timeout=None):
+        """ Wait until every message published so far has been confirmed (or has failed). """
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures, timeout=timeout)
+
+    def close(self):
+        """ Wait for the outstanding confirmations and then close the connection. """
+        # if the IOLoop never started there is nothing to do
+        if not self._thread:
+            return
+
+        self.flush(timeout=self._timeout)
+        self._closing = True
+        # close the connection from the IOLoop
+        self._ioloop.add_callback_threadsafe(self._close_connection)
+        self._thread.join()
+
+    def _start(self):
+        """ Start the IOLoop on a background thread if it isn't running yet. """
+        with self._lock:
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        self._connection = self.connect()
+        # schedule the first check for messages that have waited too long
+        self._ioloop.add_timeout(1, self._check_timeouts)
+        self._ioloop.start()
+
+    def connect(self):
+        """ Connect to RabbitMQ, returning the connection handle. """
+        LOGGER.info('Connecting to %s', self._url)
+        return pika.SelectConnection(pika.URLParameters(self._url),
+                                     on_open_callback=self.on_connection_open,
+                                     on_open_error_callback=self.on_connection_error,
+                                     on_close_callback=self.on_connection_closed,
+                                     stop_ioloop_on_close=False,
+                                     custom_ioloop=self._ioloop)
+
+    def on_connection_open(self, connection):
+        LOGGER.info('Connection opened')
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_error(self, connection, error):
+        LOGGER.warning('Could not connect, retrying in %s seconds: %s',
+                       self.RECONNECT_DELAY, error)
+        self._ioloop.add_timeout(self.RECONNECT_DELAY, self.reconnect)
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        """ Fail every outstanding message and reconnect unless we are closing. """
+        self._channel = None
+        self._fail_deliveries('Connection closed: ({}) {}'.format(reply_code, reply_text))
+
+        if self._closing:
+            self._ioloop.stop()
+        else:
+            LOGGER.warning('Connection closed, reopening in %s seconds: (%s) %s',
+                           self.RECONNECT_DELAY, reply_code, reply_text)
+            self._ioloop.add_timeout(self.RECONNECT_DELAY, self.reconnect)
+
+    def reconnect(self):
+        if not self._closing:
+            self._connection = self.connect()
+
+    def on_channel_open(self, channel):
+        """ Put the new channel in confirm mode and send anything that is waiting. """
+        LOGGER.info('Channel opened')
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.confirm_delivery(self.on_delivery_confirmation)
+        # delivery tags and declarations are scoped to the channel
+        self._message_number = 0
+        self._exchanges = set()
+        self._channel = channel
+        self._publish_pending()
+
+    def on_channel_closed(self, channel, reply_code, reply_text):
+        LOGGER.warning('Channel %i was closed: (%s) %s', channel, reply_code, reply_text)
+        self._channel = None
+        # closing the connection will fail the outstanding messages and reconnect
+        if not self._connection.is_closing and not self._connection.is_closed:
+            self._connection.close()
+
+    def on_delivery_confirmation(self, method_frame):
+        """ Resolve the future of every message covered by the confirmation. """
+        method = method_frame.method
+        acked = method.NAME == 'Basic.Ack'
+
+        # the delivery tags covered by the confirmation
+        if method.multiple:
+            tags = [tag for tag in self._deliveries if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            delivery = self._deliveries.pop(tag, None)
+            # if we already gave up on the message
+            if delivery is None:
+                continue
+
+            future, message, deadline = delivery
+            # if the message was already resolved some other way
+            if future.done():
+                continue
+            if acked:
+                future.set_result(True)
+            else:
+                self._fail(future, message, 'Message was nacked by the broker')
+
+    def _publish_pending(self):
+        """ Write every message waiting in the outbox to the channel. """
+        while self._channel and self._channel.is_open:
+            try:
+                future, message, deadline = self._outbox.popleft()
+            except IndexError:
+                return
+
+            body, exchange, routing_key, properties = message
+            # make sure the exchange matches our expectations
+            if exchange['name'] not in self._exchanges:
+                self._channel.exchange_declare(
+                    self._on_exchange_declareok,
+                    exchange['name'],
+                    exchange['type'],
+                    durable=exchange['durable']
+                )
+                self._exchanges.add(exchange['name'])
+
+            self._channel.basic_publish(
+                exchange=exchange['name'],
+                routing_key=routing_key,
+                body=body,
+                properties=properties
+            )
+            # keep track of the message until the broker confirms it
+            self._message_number += 1
+            self._deliveries[self._message_number] = (future, message, deadline)
+
+    def _on_exchange_declareok(self, unused_frame):
+        LOGGER.info('Exchange declared')
+
+    def _check_timeouts(self):
+        """ Give up on the messages that have waited too long for a confirmation. """
+        now = time.monotonic()
+        # deliveries are ordered by deadline so we can stop at the first live one
+        while self._deliveries:
+            tag, (future, message, deadline) = next(iter(self._deliveries.items()))
+            if deadline > now:
+                break
+            del self._deliveries[tag]
+            self._time_out(future, message)
+
+        # the messages waiting for a connection are ordered by deadline too
+        while self._outbox and self._outbox[0][2] <= now:
+            future, message, deadline = self._outbox.popleft()
+            self._time_out(future, message)
+
+        # check again in a bit
+        self._ioloop.add_timeout(1, self._check_timeouts)
+
+    def _time_out(self, future, message):
+        # note: setting the outcome of a resolved future would kill the IOLoop
+        if future.done():
+            return
+        future.set_exception(TimeoutError('Broker did not confirm the message in time'))
+        # let the user know
+        if self._on_timeout:
+            self._on_timeout(message)
+        else:
+            LOGGER.warning('Timed out waiting for the broker to confirm a message')
+
+    def _fail_deliveries(self, reason):
+        """ Fail every message that is waiting on a confirmation. """
+        deliveries = self._deliveries
+        self._deliveries = collections.OrderedDict()
+        for future, message, deadline in deliveries.values():
+            self._fail(future, message, reason)
+
+    def _fail_outbox(self, reason):
+        """ Fail every message that hasn't been written to the channel. """
+        while True:
+            try:
+                future, message, deadline = self._outbox.popleft()
+            except IndexError:
+                return
+            self._fail(future, message, reason)
+
+    def _fail(self, future, message, reason):
+        if future.done():
+            return
+        future.set_exception(DeliveryFailed(reason))
+        # let the user know
+        if self._on_nack:
+            self._on_nack(message)
+        else:
+            LOGGER.warning('Failed to deliver a message: %s', reason)
+
+    def _on_future_done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+        # make room in the window for another message
+        if self._window:
+            self._window.release()
+
+    def _close_connection(self):
+        # fail the messages that never made it to the broker
+        self._fail_outbox('Publisher closed before the message was sent')
+        if self._connection and not self._connection.is_closed:
+            self._connection.close()
+        else:
+            self._ioloop.stop()
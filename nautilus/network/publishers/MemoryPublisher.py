@@ -0,0 +1,90 @@
+"""
+    This publisher hands messages straight to an in-process broker (see
+    nautilus.network.transports) rather than sending them over the network.
+"""
+
+# external imports
+import asyncio
+import pika
+
+
+class MemoryPublisher:
+    """
+        This publisher routes messages through a MemoryBroker in the current
+        process. Publishing is synchronous: by the time publish returns, the
+        message is sitting in every queue bound to the exchange.
+
+        Args:
+            broker (MemoryBroker): The broker to publish to.
+    """
+
+    def __init__(self, broker):
+        self._broker = broker
+        # the exchanges that have been declared by this publisher
+        self._exchanges = set()
+
+    def publish(self, body, exchange, routing_key='', properties=None):
+        """
+            Publish the given body over the exchange.
+
+            Args:
+                body (bytes|str): The message body.
+                exchange (dict): The name, type, and durability of the exchange.
+                routing_key (optional, str): The routing key of the message.
+                properties (optional, pika.BasicProperties): The message properties.
+        """
+        self.publish_many([(body, exchange, routing_key, properties)])
+
+    def publish_many(self, messages):
+        """ Publish a sequence of (body, exchange, routing_key, properties) tuples. """
+        for body, exchange, routing_key, properties in messages:
+            # make sure the exchange matches our expectations
+            if exchange['name'] not in self._exchanges:
+                self._broker.declare_exchange(exchange['name'], exchange['type'])
+                self._exchanges.add(exchange['name'])
+
+            # consumers always see the body as bytes
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+
+            self._broker.publish(
+                exchange['name'],
+                routing_key,
+                body,
+                properties or pika.BasicProperties()
+            )
+
+    def flush(self):
+        """ Messages are delivered as soon as they are published so there is nothing to do. """
+
+    def close(self):
+        """ There is no connection to close. """
+
+
+class MemoryAsyncPublisher:
+    """
+        The counterpart of MemoryPublisher used by coroutines (see
+        nautilus.network.dispatch.dispatch_action_async). Since the broker
+        takes the message immediately there is never anything to wait for.
+
+        Args:
+            broker (MemoryBroker): The broker to publish to.
+
+            loop (optional, asyncio.AbstractEventLoop): The event loop the
+                publisher is used from.
+    """
+
+    def __init__(self, broker, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self._publisher = MemoryPublisher(broker)
+
+    async def publish(self, body, exchange, routing_key='', properties=None):
+        """ Publish the given body over the exchange. """
+        self._publisher.publish(body, exchange, routing_key, properties)
+        return True
+
+    async def flush(self):
+        """ Messages are delivered as soon as they are published so there is nothing to do. """
+
+    async def close(self):
+        """ There is no connection to close. """
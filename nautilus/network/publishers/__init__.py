@@ -0,0 +1,5 @@
+from .BasicPublisher import BasicPublisher
+from .BatchPublisher import BatchPublisher
+from .ConfirmPublisher import ConfirmPublisher, DeliveryFailed
+from .AsyncPublisher import AsyncPublisher
+from .MemoryPublisher import MemoryPublisher, MemoryAsyncPublisher
@@ -0,0 +1,291 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+class TestCRUDHandlers(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # external imports
+        from sqlalchemy import Column, Integer, Text
+        # local imports
+        from nautilus.models import BaseModel, HasID, CRUDNotificationCreator
+
+        class HandlerModel(CRUDNotificationCreator, HasID, BaseModel):
+            name = Column(Text, nullable=False)
+            color = Column(Text)
+
+        class CompositeModel(CRUDNotificationCreator, BaseModel):
+            region = Column(Text, primary_key=True)
+            code = Column(Integer, primary_key=True)
+
+        cls.Model = HandlerModel
+        cls.CompositeModel = CompositeModel
+
+    def setUp(self):
+        # external imports
+        from flask import Flask
+        # local imports
+        from nautilus.db import db
+
+        # create an app with an in-memory database
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        # capture the events emitted by the model
+        patcher = patch('nautilus.models.mixins.crudNotificationCreator.dispatch_action')
+        self.dispatch_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        from nautilus.db import db
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_creates_a_batch_in_one_transaction(self):
+        # external imports
+        from sqlalchemy import event
+        # local imports
+        from nautilus.db import db
+        from nautilus.network.actionHandlers import createHandler
+
+        commits = []
+        @event.listens_for(db.session(), 'after_commit')
+        def count_commit(session):
+            commits.append(session)
+
+        handler = createHandler(self.Model)
+        handler([
+            ('create_handlermodel', {'name': 'foo'}),
+            # missing the name
+            ('create_handlermodel', {'color': 'red'}),
+            ('update_handlermodel', {'id': 1, 'name': 'baz'}),
+            ('create_handlermodel', {'name': 'bar', 'color': 'blue'}),
+        ])
+
+        assert sorted(model.name for model in self.Model.query.all()) == ['bar', 'foo'], (
+            "Create handler did not create exactly the valid records."
+        )
+        assert len(commits) == 1, (
+            "Create handler did not write the batch in a single commit."
+        )
+        assert self.dispatch_mock.call_count == 2, (
+            "Create handler did not emit an event for every record."
+        )
+
+    def test_updates_records_without_loading_them(self):
+        # local imports
+        from nautilus.db import db
+        from nautilus.network.actionHandlers import updateHandler
+
+        db.session.add_all([self.Model(name='foo'), self.Model(name='bar')])
+        db.session.commit()
+        db.session.expunge_all()
+        self.dispatch_mock.reset_mock()
+
+        handler = updateHandler(self.Model)
+        with patch.object(self.Model, '__init__', side_effect=AssertionError('loaded')):
+            handler([
+                ('update_handlermodel', {'id': '1', 'color': 'red'}),
+                ('update_handlermodel', {'id': 2, 'color': 'blue'}),
+                # the record doesn't exist
+                ('update_handlermodel', {'id': 3, 'color': 'green'}),
+                ('update_handlermodel', {'id': 1, 'name': 'baz'}),
+            ])
+
+        records = {model.id: (model.name, model.color) for model in self.Model.query.all()}
+        assert records == {1: ('baz', 'red'), 2: ('bar', 'blue')}, (
+            "Update handler did not apply every update."
+        )
+        events = [call[1]['payload'] for call in self.dispatch_mock.call_args_list]
+        assert events == [{'id': 1, 'color': 'red'}, {'id': 2, 'color': 'blue'}, {'id': 1, 'name': 'baz'}], (
+            "Update handler did not emit the changed columns of the updated records."
+        )
+
+    def test_update_events_dont_trust_the_row_count(self):
+        # external imports
+        from sqlalchemy.sql.expression import Update
+        # local imports
+        from nautilus.db import db
+        from nautilus.network.actionHandlers import updateHandler
+
+        db.session.add(self.Model(name='foo'))
+        db.session.commit()
+        self.dispatch_mock.reset_mock()
+
+        # a driver that doesn't know how many rows an executemany touched
+        execute = db.session.execute
+        def miscounted_execute(statement, *args, **kwargs):
+            result = execute(statement, *args, **kwargs)
+            return MagicMock(rowcount=2) if isinstance(statement, Update) else result
+
+        with patch.object(db.session, 'execute', side_effect=miscounted_execute):
+            updateHandler(self.Model)([
+                ('update_handlermodel', {'id': 1, 'color': 'red'}),
+                # the record doesn't exist
+                ('update_handlermodel', {'id': 2, 'color': 'red'}),
+            ])
+
+        events = [call[1]['payload'] for call in self.dispatch_mock.call_args_list]
+        assert events == [{'id': 1, 'color': 'red'}], (
+            "Update handler emitted an event for a record that doesn't exist."
+        )
+
+    def test_handlers_can_be_called_with_a_single_action(self):
+        # local imports
+        from nautilus.network.actionHandlers import CRUDHandler, updateHandler
+
+        handler = CRUDHandler(self.Model)
+        handler('create_handlermodel', {'name': 'foo'})
+        handler(action_type='create_handlermodel', payload={'name': 'bar'})
+        updateHandler(self.Model)('update_handlermodel', {'id': 1, 'color': 'red'})
+
+        records = {model.id: (model.name, model.color) for model in self.Model.query.all()}
+        assert records == {1: ('foo', 'red'), 2: ('bar', None)}, (
+            "Handlers did not handle the single actions they were given."
+        )
+        assert handler.batched, (
+            "CRUD handler stopped taking batches."
+        )
+
+    def test_deletes_records_in_chunks(self):
+        # external imports
+        from sqlalchemy import event
+        # local imports
+        from nautilus.db import db
+        from nautilus.network.actionHandlers import deleteHandler
+
+        db.session.add_all([self.Model(name=str(index), color='red' if index % 2 else 'blue')
+                            for index in range(1, 11)])
+        db.session.commit()
+        self.dispatch_mock.reset_mock()
+
+        statements = []
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count_statement(connection, cursor, statement, *args):
+            statements.append(statement)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', count_statement)
+
+        handler = deleteHandler(self.Model, chunk_size=4)
+        handler([
+            ('delete_handlermodel', '1'),
+            ('delete_handlermodel', [2, 4, 'nope']),
+            # the odd records
+            ('delete_handlermodel', {'color': 'red'}),
+            ('delete_handlermodel', {'name_in': ['6', '8', '10'], 'color': 'blue', 'pk_in': [8, 10]}),
+        ])
+
+        assert [model.name for model in self.Model.query.all()] == ['6'], (
+            "Delete handler did not remove every targeted record."
+        )
+        assert len([statement for statement in statements if statement.startswith('DELETE')]) == 3, (
+            "Delete handler did not remove the records in chunks."
+        )
+        events = sorted(call[1]['payload']['id'] for call in self.dispatch_mock.call_args_list)
+        assert events == [1, 2, 3, 4, 5, 7, 8, 9, 10], (
+            "Delete handler did not emit an event for every removed record."
+        )
+
+    def test_writes_the_rest_of_a_batch_when_a_record_fails(self):
+        # local imports
+        from nautilus.network import ActionsFailed
+        from nautilus.network.actionHandlers import createHandler
+
+        actions = [
+            ('create_handlermodel', {'id': 1, 'name': 'foo'}),
+            # the record already exists
+            ('create_handlermodel', {'id': 1, 'name': 'bar'}),
+            ('create_handlermodel', {'name': 'baz'}),
+        ]
+        handler = createHandler(self.Model)
+        with self.assertRaises(ActionsFailed) as context:
+            handler(actions)
+
+        assert [action for action, _ in context.exception.failures] == [actions[1]], (
+            "Create handler did not raise exactly the failed action."
+        )
+        assert sorted(model.name for model in self.Model.query.all()) == ['baz', 'foo'], (
+            "Create handler did not write the rest of the batch."
+        )
+        assert self.dispatch_mock.call_count == 2, (
+            "Create handler emitted events for records that were rolled back."
+        )
+
+    def test_crud_handler_keeps_actions_in_order(self):
+        # local imports
+        from nautilus.db import db
+        from nautilus.network.actionHandlers import CRUDHandler
+
+        db.session.add(self.Model(name='foo'))
+        db.session.commit()
+
+        handler = CRUDHandler(self.Model)
+        handler([
+            ('delete_handlermodel', 1),
+            ('create_handlermodel', {'id': 1, 'name': 'bar'}),
+            ('update_handlermodel', {'id': 1, 'color': 'red'}),
+            ('create_handlermodel', {'name': 'baz'}),
+        ])
+
+        records = {model.id: (model.name, model.color) for model in self.Model.query.all()}
+        assert records == {1: ('bar', 'red'), 2: ('baz', None)}, (
+            "CRUD handler did not apply the actions in the order they arrived."
+        )
+
+    def test_deletes_records_with_composite_keys(self):
+        # local imports
+        from nautilus.db import db
+        from nautilus.network.actionHandlers import deleteHandler
+
+        db.session.add_all([
+            self.CompositeModel(region=region, code=code)
+            for region in ['eu', 'us'] for code in [1, 2]
+        ])
+        db.session.commit()
+
+        handler = deleteHandler(self.CompositeModel)
+        handler([
+            ('delete_compositemodel', {'region': 'eu', 'code': '1'}),
+            ('delete_compositemodel', [{'region': 'us', 'code': 2}]),
+            # doesn't say which record to remove
+            ('delete_compositemodel', 'eu'),
+        ])
+
+        records = {(model.region, model.code) for model in self.CompositeModel.query.all()}
+        assert records == {('eu', 2), ('us', 1)}, (
+            "Delete handler did not remove the records by their whole primary key."
+        )
+
+    def test_events_wait_for_the_session_to_commit(self):
+        # external imports
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+        # local imports
+        from nautilus.db import db
+        from nautilus.models.mixins.crudNotificationCreator import send_pending_events
+
+        # a session that never emits an event
+        other = Session(bind=db.engine)
+        self.addCleanup(other.close)
+
+        db.session.add(self.Model(name='foo'))
+        db.session.flush()
+        assert not self.dispatch_mock.called, (
+            "Model published its event before the transaction committed."
+        )
+        db.session.commit()
+        # an event that is rolled back is never sent
+        db.session.add(self.Model(name='bar'))
+        db.session.flush()
+        db.session.rollback()
+
+        assert [call[1]['payload']['name'] for call in self.dispatch_mock.call_args_list] == ['foo']
+        assert event.contains(db.session(), 'after_commit', send_pending_events)
+        assert not event.contains(Session, 'after_commit', send_pending_events) \
+               and not event.contains(other, 'after_commit', send_pending_events), (
+            "Model listened to sessions that don't emit its events."
+        )
@@ -0,0 +1,421 @@
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+class TestActionConsumer(unittest.TestCase):
+
+    def test_decodes_messages_with_their_codec(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+        from nautilus.network.codecs import get_codec
+
+        handler = MagicMock()
+        consumer = ActionConsumer(action_handler=handler)
+
+        # a message from a service that names its codec
+        body = get_codec('application/json').encode({'type': 'foo', 'payload': 'bar'})
+        properties = MagicMock(content_type='application/json', content_encoding=None)
+        consumer.on_message(MagicMock(), MagicMock(), properties, body)
+
+        # a message from a service that doesn't
+        properties = MagicMock(content_type=None, content_encoding=None)
+        consumer.on_message(MagicMock(), MagicMock(), properties, b'{"type": "foo", "payload": "baz"}')
+
+        handler.assert_any_call(action_type='foo', payload='bar')
+        handler.assert_any_call(action_type='foo', payload='baz')
+
+    def test_ignores_messages_with_unknown_codecs(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+
+        handler = MagicMock()
+        consumer = ActionConsumer(action_handler=handler)
+
+        properties = MagicMock(content_type='application/unknown', content_encoding=None)
+        consumer.on_message(MagicMock(), MagicMock(), properties, b'foo')
+
+        assert not handler.called, (
+            "Consumer passed an undecodable message to the handler."
+        )
+
+    def test_decompresses_messages(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+        from nautilus.network.codecs import compress
+
+        handler = MagicMock()
+        consumer = ActionConsumer(action_handler=handler)
+
+        payload = 'bar' * 100
+        body = compress('{{"type": "foo", "payload": "{}"}}'.format(payload).encode('utf-8'))
+        properties = MagicMock(content_type='application/json', content_encoding='zlib')
+        consumer.on_message(MagicMock(), MagicMock(), properties, body)
+
+        handler.assert_called_once_with(action_type='foo', payload=payload)
+
+    def test_topic_consumers_bind_handled_action_types(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+
+        def handler(action_type, payload): pass
+        handler.action_types = ['foo', 'bar']
+
+        # a fanout consumer gets everything regardless
+        consumer = ActionConsumer(action_handler=handler)
+        assert consumer.routing_keys() == [None], (
+            "Fanout consumer bound specific routing keys."
+        )
+
+        # a topic consumer only binds the declared types
+        consumer = ActionConsumer(action_handler=handler, exchange_type='topic')
+        assert consumer.routing_keys() == ['bar', 'foo'], (
+            "Topic consumer did not bind the handled action types."
+        )
+
+        # and falls back to everything if the handler doesn't say
+        consumer = ActionConsumer(action_handler=MagicMock(), exchange_type='topic')
+        assert consumer.routing_keys() == ['#'], (
+            "Topic consumer did not bind every action for an undeclared handler."
+        )
+
+    def test_settles_messages_once_handled(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+
+        handler = MagicMock(side_effect=[None, Exception('oops')])
+        consumer = ActionConsumer(action_handler=handler)
+        # pretend the consumer is connected
+        channel = consumer._channel = MagicMock()
+
+        properties = MagicMock(content_type=None, content_encoding=None, message_id=None)
+        body = b'{"type": "foo", "payload": "bar"}'
+        consumer.on_message(channel, MagicMock(delivery_tag=1), properties, body)
+        consumer.on_message(channel, MagicMock(delivery_tag=2), properties, body)
+
+        channel.basic_ack.assert_any_call(1, multiple=False)
+        # the failed action is sent off to be retried
+        exchange, routing_key, published_body, published = channel.basic_publish.call_args[0]
+        assert (exchange, routing_key, published_body) == ('actions.retry.1000', consumer._queue_name, body)
+        assert published.headers['x-retries'] == 1
+        assert published is not properties, (
+            "Consumer changed the properties of the delivered message."
+        )
+        channel.basic_ack.assert_called_with(2, multiple=False)
+
+    def test_only_retries_the_actions_a_batch_failed(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+        from nautilus.network.util import ActionsFailed
+
+        def handler(actions):
+            raise ActionsFailed([(actions[1], Exception('oops'))])
+        handler.batched = True
+        consumer = ActionConsumer(action_handler=handler)
+        # pretend the consumer is connected
+        channel = consumer._channel = MagicMock()
+
+        batch = []
+        for tag in [1, 2, 3]:
+            properties = MagicMock(content_type=None, content_encoding=None, message_id=str(tag))
+            consumer._messages[(channel, tag)] = (properties, b'{}')
+            batch.append((channel, tag, {'type': 'foo', 'payload': tag}))
+        consumer.handle_batch(batch)
+
+        assert channel.basic_publish.call_count == 1, (
+            "Consumer did not retry exactly the failed action."
+        )
+        assert channel.basic_publish.call_args[0][3].message_id == '2'
+        acks = [call[0] for call in channel.basic_ack.call_args_list]
+        assert acks == [(2,), (3,)] and channel.basic_ack.call_args[1] == {'multiple': True}, (
+            "Consumer did not acknowledge the rest of the batch."
+        )
+        assert '1' in consumer._handled_ids and '2' not in consumer._handled_ids
+
+    def test_drops_unwanted_actions_without_decoding_them(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+
+        handler = MagicMock(action_types=['foo'])
+        consumer = ActionConsumer(action_handler=handler)
+        # pretend the consumer is connected
+        channel = consumer._channel = MagicMock()
+
+        # a body that can't be decoded would be dead-lettered if we tried
+        properties = MagicMock(type='bar', content_type='application/unknown', message_id=None)
+        consumer.on_message(channel, MagicMock(delivery_tag=1), properties, b'garbage')
+
+        assert not handler.called and not channel.basic_publish.called, (
+            "Consumer decoded an action the handler did not want."
+        )
+        channel.basic_ack.assert_called_once_with(1, multiple=False)
+
+    def test_records_metrics_by_action_type(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+        from nautilus.network.dispatch import DISPATCHED_AT_HEADER
+        from nautilus.network.metrics import merge_snapshots
+
+        def handler(action_type, payload):
+            if payload == 'fail':
+                raise Exception('oops')
+        consumer = ActionConsumer(action_handler=handler, retry_delays=[])
+        channel = consumer._channel = MagicMock()
+
+        for tag, (action_type, payload) in enumerate([('foo', 'ok'), ('foo', 'fail'), ('bar', 'ok')]):
+            # dispatched two seconds ago
+            properties = MagicMock(content_type=None, content_encoding=None, message_id=None,
+                                   headers={DISPATCHED_AT_HEADER: (time.time() - 2) * 1000})
+            body = '{{"type": "{}", "payload": "{}"}}'.format(action_type, payload).encode()
+            consumer.on_message(channel, MagicMock(delivery_tag=tag), properties, body)
+
+        snapshot = consumer.metrics_snapshot()
+        foo = snapshot['actions']['foo']
+        assert (foo['received'], foo['handled'], foo['failed']) == (2, 1, 1), (
+            "Consumer did not count the actions of each type."
+        )
+        assert foo['handler']['count'] == 2 and foo['ack']['count'] == 2
+        assert 2 <= foo['lag']['sum'] / foo['lag']['count'] < 3, (
+            "Consumer did not measure how long the actions took to arrive."
+        )
+        assert snapshot['in_flight'] == 0
+
+        total = merge_snapshots([snapshot, snapshot])
+        assert total['actions']['bar']['handled'] == 2
+        assert total['actions']['foo']['decode']['count'] == 4
+
+    def test_skips_actions_it_has_handled_before(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+
+        handler = MagicMock()
+        consumer = ActionConsumer(action_handler=handler)
+        # pretend the consumer is connected
+        channel = consumer._channel = MagicMock()
+
+        body = b'{"type": "foo", "payload": "bar"}'
+        for delivery_tag in [1, 2]:
+            properties = MagicMock(content_type=None, content_encoding=None, message_id='abc')
+            consumer.on_message(channel, MagicMock(delivery_tag=delivery_tag), properties, body)
+
+        handler.assert_called_once_with(action_type='foo', payload='bar')
+        # the duplicate is acknowledged so it isn't delivered again
+        channel.basic_ack.assert_called_with(2, multiple=False)
+
+    def test_idempotency_cache_forgets_the_oldest_ids(self):
+        # import the cache to be tested
+        from nautilus.network import IdempotencyCache
+
+        store = MagicMock()
+        store.handled.side_effect = lambda message_ids: {
+            message_id for message_id in message_ids if message_id == 'stored'
+        }
+        cache = IdempotencyCache(size=2, store=store)
+        cache.add(['a', 'b'])
+        # seeing an id keeps it around
+        assert 'a' in cache
+        cache.add(['c'])
+
+        assert 'a' in cache and 'c' in cache and 'b' not in cache, (
+            "Cache did not evict the least recently seen id."
+        )
+        assert 'stored' in cache, (
+            "Cache did not fall back to its store."
+        )
+        store.add.assert_any_call(['a', 'b'])
+        # the ids that aren't in memory are looked up together
+        assert cache.handled(['c', 'stored', 'd']) == {'c', 'stored'}
+        store.handled.assert_called_with(['d'])
+
+    def test_looks_up_a_batch_in_the_idempotency_store_at_once(self):
+        # import the consumer to be tested
+        from nautilus.network import IdempotencyCache
+        from nautilus.network.consumers import ActionConsumer
+
+        handler = MagicMock(batched=True)
+        store = MagicMock()
+        store.handled.return_value = {'2'}
+        consumer = ActionConsumer(action_handler=handler,
+                                  idempotency_cache=IdempotencyCache(store=store))
+        # pretend the consumer is connected
+        channel = consumer._channel = MagicMock()
+
+        batch = []
+        for tag in [1, 2, 3]:
+            properties = MagicMock(content_type=None, content_encoding=None, message_id=str(tag))
+            consumer._messages[(channel, tag)] = (properties, b'{}')
+            batch.append((channel, tag, {'type': 'foo', 'payload': tag}))
+        consumer.handle_batch(batch)
+
+        store.handled.assert_called_once_with(['1', '2', '3'])
+        handler.assert_called_once_with([('foo', 1), ('foo', 3)])
+        store.add.assert_called_once_with(['1', '3'])
+        channel.basic_ack.assert_called_once_with(3, multiple=True)
+        assert consumer.metrics_snapshot()['actions']['foo']['duplicates'] == 1
+
+    def test_dead_letters_actions_that_run_out_of_attempts(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+
+        consumer = ActionConsumer(action_handler=MagicMock(side_effect=Exception('oops')))
+        # pretend the consumer is connected
+        channel = consumer._channel = MagicMock()
+
+        properties = MagicMock(content_type=None, content_encoding=None,
+                               headers={'x-retries': len(consumer.RETRY_DELAYS)})
+        body = b'{"type": "foo", "payload": "bar"}'
+        consumer.on_message(channel, MagicMock(delivery_tag=1), properties, body)
+
+        exchange, routing_key, published_body, published = channel.basic_publish.call_args[0]
+        assert (exchange, routing_key, published_body) == ('actions.dead', consumer._queue_name, body)
+        assert published.headers['x-error'] == 'Exception: oops', (
+            "Dead-lettered action did not carry its error."
+        )
+        assert properties.headers == {'x-retries': len(consumer.RETRY_DELAYS)}, (
+            "Consumer changed the headers of the delivered message."
+        )
+        channel.basic_ack.assert_called_once_with(1, multiple=False)
+
+    def test_dead_letters_actions_that_cannot_be_decoded(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+        from nautilus.network.dispatch import DEAD_LETTER_EXCHANGE
+
+        handler = MagicMock()
+        consumer = ActionConsumer(action_handler=handler)
+        # pretend the consumer is connected
+        channel = consumer._channel = MagicMock()
+
+        # a body that isn't json and a body that isn't really compressed
+        messages = [(None, b'{"type": "foo", '), ('zlib', b'not compressed')]
+        for tag, (content_encoding, body) in enumerate(messages):
+            properties = MagicMock(content_type=None, content_encoding=content_encoding,
+                                   message_id=None, headers={})
+            consumer.on_message(channel, MagicMock(delivery_tag=tag), properties, body)
+
+        assert not handler.called
+        exchanges = [call[0][0] for call in channel.basic_publish.call_args_list]
+        assert exchanges == [DEAD_LETTER_EXCHANGE['name']] * 2, (
+            "Undecodable actions were not dead-lettered."
+        )
+        assert [call[0][0] for call in channel.basic_ack.call_args_list] == [0, 1]
+
+    def test_inspects_dead_letters_that_cannot_be_decoded(self):
+        # import the function to be tested
+        from nautilus.network.deadLetters import inspect_dead_letters
+
+        # a body that isn't really compressed and a body that isn't an action
+        messages = [
+            (MagicMock(), MagicMock(content_type=None, content_encoding='zlib',
+                                    headers={'x-error': 'Error: bad body'}), b'not compressed'),
+            (MagicMock(), MagicMock(content_type=None, content_encoding=None, headers={}), b'[1]'),
+            (None, None, None),
+        ]
+        with patch('pika.BlockingConnection') as connection:
+            connection.return_value.channel.return_value.basic_get.side_effect = messages
+            dead_letters = inspect_dead_letters()
+
+        assert [letter['payload'] for letter in dead_letters] == [b'not compressed', [1]], (
+            "Dead letters that couldn't be decoded were not returned as they are."
+        )
+        assert dead_letters[0]['error'] == 'Error: bad body'
+
+    def test_reconnects_right_away_and_then_backs_off(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+
+        consumer = ActionConsumer(action_handler=MagicMock())
+        delays = [consumer.reconnect_delay() for _ in range(10)]
+
+        assert delays[0] == 0, (
+            "Consumer did not try to reconnect right away."
+        )
+        for attempt, delay in enumerate(delays[1:]):
+            assert 0 <= delay <= min(consumer.RECONNECT_MAX_DELAY,
+                                     consumer.RECONNECT_DELAY * 2 ** attempt)
+
+    def test_restores_its_topology_without_waiting_for_replies(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+
+        consumer = ActionConsumer(action_handler=MagicMock(), queue='service')
+        consumer._connection = MagicMock()
+        # the consumer has been connected before
+        consumer._declared = True
+
+        channel = MagicMock()
+        consumer.on_channel_open(channel)
+
+        declarations = channel.exchange_declare.call_args_list + \
+                       channel.queue_declare.call_args_list + \
+                       channel.queue_bind.call_args_list
+        assert declarations and all(call[1].get('nowait') for call in declarations), (
+            "Consumer waited on the broker to restore its topology."
+        )
+        assert channel.basic_consume.called
+
+    def test_concurrent_consumers_limit_prefetch(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+
+        consumer = ActionConsumer(action_handler=MagicMock(), concurrency=4)
+        assert consumer._prefetch_count == 4, (
+            "Concurrent consumer did not bound the number of actions in flight."
+        )
+
+    def test_keeps_actions_for_a_record_in_order(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+        import json, time
+
+        handled = []
+        def handler(action_type, payload):
+            # give the lanes a chance to reorder things
+            time.sleep(0.001 * (payload['id'] % 3))
+            handled.append((payload['id'], payload['version']))
+        handler.partition_fields = ['id']
+
+        consumer = ActionConsumer(action_handler=handler, concurrency=4)
+        consumer._connection = MagicMock()
+
+        properties = MagicMock(content_type=None, content_encoding=None, message_id=None)
+        for version in range(5):
+            for record in range(6):
+                body = json.dumps({'type': 'foo', 'payload': {'id': record, 'version': version}})
+                consumer.on_message(MagicMock(), MagicMock(), properties, body.encode('utf-8'))
+        # wait for the lanes to finish
+        consumer._executor.shutdown(wait=True)
+
+        for record in range(6):
+            assert [version for id, version in handled if id == record] == list(range(5)), (
+                "Actions for a record were handled out of order."
+            )
+
+    def test_waits_for_every_lane_around_multi_record_actions(self):
+        # import the consumer to be tested
+        from nautilus.network.consumers import ActionConsumer
+        import json, time
+
+        handled = []
+        def handler(action_type, payload):
+            # give the lanes a chance to reorder things
+            if action_type == 'foo':
+                time.sleep(0.001 * (payload['id'] % 3))
+            handled.append(action_type)
+        handler.partition_fields = ['id']
+        handler.multi_record_types = ['purge']
+
+        consumer = ActionConsumer(action_handler=handler, concurrency=4)
+        consumer._connection = MagicMock()
+
+        properties = MagicMock(content_type=None, content_encoding=None, message_id=None)
+        actions = [('foo', {'id': record}) for record in range(6)] + [('purge', [1, 2])] + \
+                  [('foo', {'id': record}) for record in range(6)]
+        for action_type, payload in actions:
+            body = json.dumps({'type': action_type, 'payload': payload})
+            consumer.on_message(MagicMock(), MagicMock(), properties, body.encode('utf-8'))
+        # wait for the lanes to finish
+        consumer._executor.shutdown(wait=True)
+
+        assert handled.index('purge') == 6, (
+            "Multi-record action was not handled between the actions around it."
+        )
@@ -0,0 +1,408 @@
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        # make sure every test starts without a publisher
+        from nautilus.network import dispatch
+        from nautilus.network.publishers import BasicPublisher
+        dispatch._publisher_factory = BasicPublisher
+        dispatch._publisher = None
+        dispatch._publisher_pid = None
+        dispatch._compress_threshold = None
+
+    def test_publisher_reuses_connections(self):
+        # import the publisher to be tested
+        from nautilus.network.publishers import BasicPublisher
+
+        with patch('pika.BlockingConnection') as connection_mock:
+            # the channel that will be used to publish
+            channel = connection_mock.return_value.channel.return_value
+            exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+
+            # publish a few messages in a row
+            publisher = BasicPublisher()
+            publisher.publish(body='bar', exchange=exchange)
+            publisher.publish(body='baz', exchange=exchange)
+
+        # make sure we only connected and declared the exchange once
+        assert connection_mock.call_count == 1, (
+            "Publisher did not reuse its connection."
+        )
+        assert channel.exchange_declare.call_count == 1, (
+            "Publisher did not cache the exchange declaration."
+        )
+        assert channel.basic_publish.call_count == 2, (
+            "Publisher did not publish every message."
+        )
+
+    def test_publisher_only_resends_what_a_failed_channel_did_not_send(self):
+        # external imports
+        import pika
+        # import the publisher to be tested
+        from nautilus.network.publishers import BasicPublisher
+
+        with patch('pika.BlockingConnection') as connection_mock:
+            channel = connection_mock.return_value.channel.return_value
+            # the connection drops while the second message is being sent
+            channel.basic_publish.side_effect = [
+                None, pika.exceptions.ConnectionClosed(320, 'CONNECTION_FORCED'), None, None
+            ]
+            exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+
+            BasicPublisher().publish_many([
+                (body, exchange, '', None) for body in ('bar', 'baz', 'qux')
+            ])
+
+        bodies = [call[1]['body'] for call in channel.basic_publish.call_args_list]
+        assert bodies == ['bar', 'baz', 'baz', 'qux'], (
+            "Publisher did not pick up where the failed channel left off."
+        )
+        assert connection_mock.call_count == 2
+
+    def test_publisher_replaces_idle_connections(self):
+        # import the publisher to be tested
+        from nautilus.network.publishers import BasicPublisher
+
+        with patch('pika.BlockingConnection') as connection_mock:
+            connection = connection_mock.return_value
+            exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+
+            publisher = BasicPublisher(max_idle=60)
+            publisher.publish(body='bar', exchange=exchange)
+            # a warm connection catches up on its heartbeats before it is used
+            publisher.publish(body='baz', exchange=exchange)
+            assert connection.process_data_events.called and connection_mock.call_count == 1, (
+                "Publisher did not process the I/O of an idle connection."
+            )
+
+            # the connection sits in the pool for too long
+            publisher._pool.queue[0].last_used -= 120
+            publisher.publish(body='qux', exchange=exchange)
+
+        assert connection_mock.call_count == 2, (
+            "Publisher reused a connection the broker might have dropped."
+        )
+        assert connection.close.call_count == 1
+
+    def test_publisher_is_recreated_after_fork(self):
+        # import the module to be tested
+        from nautilus.network import dispatch
+
+        factory = MagicMock(side_effect=lambda: MagicMock())
+        dispatch.configure_dispatch(publisher=factory)
+
+        # grab the publisher twice in the same process
+        parent_publisher = dispatch.get_publisher()
+        assert dispatch.get_publisher() is parent_publisher, (
+            "Publisher was not reused within the same process."
+        )
+
+        # pretend we are in a forked child
+        with patch('os.getpid', return_value=-1):
+            child_publisher = dispatch.get_publisher()
+
+        assert child_publisher is not parent_publisher, (
+            "Child process reused its parent's publisher."
+        )
+        assert not parent_publisher.close.called, (
+            "Child process closed its parent's connections."
+        )
+
+    def test_batch_publisher_flushes_when_full(self):
+        # import the publisher to be tested
+        from nautilus.network.publishers import BatchPublisher
+
+        inner = MagicMock()
+        exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+        publisher = BatchPublisher(publisher=inner, max_count=2, max_delay=60000)
+
+        # the first message should be held onto
+        publisher.publish(body='bar', exchange=exchange)
+        assert not inner.publish_many.called, (
+            "Batch publisher did not buffer the message."
+        )
+
+        # the second one fills the batch
+        publisher.publish(body='baz', exchange=exchange)
+        inner.publish_many.assert_called_once_with([
+            ('bar', exchange, '', None),
+            ('baz', exchange, '', None),
+        ])
+
+    def test_batch_publisher_can_be_flushed(self):
+        # import the publisher to be tested
+        from nautilus.network.publishers import BatchPublisher
+
+        inner = MagicMock()
+        exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+        publisher = BatchPublisher(publisher=inner, max_count=10, max_delay=60000)
+
+        publisher.publish(body='bar', exchange=exchange)
+        # flush the buffer by hand
+        publisher.flush()
+
+        inner.publish_many.assert_called_once_with([('bar', exchange, '', None)])
+
+    def test_batch_publisher_keeps_batches_it_could_not_send(self):
+        # import the publisher to be tested
+        from nautilus.network.publishers import BatchPublisher
+
+        inner = MagicMock()
+        inner.publish_many.side_effect = [IOError('broker is gone'), None]
+        exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+        publisher = BatchPublisher(publisher=inner, max_count=10, max_delay=60000)
+
+        future = publisher.publish(body='bar', exchange=exchange)
+        # the first flush fails
+        with self.assertRaises(IOError):
+            publisher.flush()
+        assert not future.done(), (
+            "Batch publisher resolved the future of a message it could not send."
+        )
+
+        # a message published in the meantime goes out after the failed batch
+        publisher.publish(body='baz', exchange=exchange)
+        publisher.flush()
+
+        inner.publish_many.assert_called_with([
+            ('bar', exchange, '', None),
+            ('baz', exchange, '', None),
+        ])
+        assert future.result(timeout=0) is True, (
+            "Batch publisher did not resolve the future once the message was sent."
+        )
+
+    def test_batch_publisher_does_not_raise_when_a_full_buffer_fails(self):
+        # import the publisher to be tested
+        from nautilus.network.publishers import BatchPublisher
+
+        inner = MagicMock()
+        inner.publish_many.side_effect = [IOError('broker is gone'), None]
+        exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+        publisher = BatchPublisher(publisher=inner, max_count=1, max_delay=60000)
+
+        # the message fills the buffer but can't be sent
+        future = publisher.publish(body='bar', exchange=exchange)
+        assert not future.done() and not future.cancel(), (
+            "Batch publisher gave up on a message it is still holding."
+        )
+
+        publisher.flush()
+        inner.publish_many.assert_called_with([('bar', exchange, '', None)])
+        assert future.result(timeout=0) is True
+
+    def test_batch_publisher_surfaces_confirmations(self):
+        # import the publisher to be tested
+        from concurrent.futures import Future
+        from nautilus.network.publishers import BatchPublisher, DeliveryFailed
+
+        confirmations = [Future(), Future()]
+        inner = MagicMock()
+        inner.publish_many.return_value = confirmations
+        exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+        publisher = BatchPublisher(publisher=inner, max_count=10, max_delay=60000)
+
+        futures = publisher.publish_many([
+            ('bar', exchange, '', None),
+            ('baz', exchange, '', None),
+        ])
+        publisher.flush()
+        assert not any(future.done() for future in futures), (
+            "Batch publisher resolved futures before the broker confirmed the messages."
+        )
+
+        # the broker acks the first message and nacks the second
+        confirmations[0].set_result(True)
+        confirmations[1].set_exception(DeliveryFailed('nacked'))
+
+        assert futures[0].result(timeout=0) is True
+        with self.assertRaises(DeliveryFailed):
+            futures[1].result(timeout=0)
+
+    def test_confirm_publisher_resolves_futures_on_ack(self):
+        # import the publisher to be tested
+        from nautilus.network.publishers import ConfirmPublisher, DeliveryFailed
+
+        exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+        publisher = ConfirmPublisher(window=2)
+        # pretend the IOLoop is running over an open channel
+        publisher._thread = MagicMock()
+        publisher._ioloop = MagicMock()
+        publisher._channel = MagicMock()
+
+        futures = publisher.publish_many([
+            ('bar', exchange, '', None),
+            ('baz', exchange, '', None),
+        ])
+        # write the messages to the channel
+        publisher._publish_pending()
+
+        # ack the first message and nack the second
+        ack = MagicMock()
+        ack.method.NAME = 'Basic.Ack'
+        ack.method.delivery_tag = 1
+        ack.method.multiple = False
+        publisher.on_delivery_confirmation(ack)
+        nack = MagicMock()
+        nack.method.NAME = 'Basic.Nack'
+        nack.method.delivery_tag = 2
+        nack.method.multiple = True
+        publisher.on_delivery_confirmation(nack)
+
+        assert futures[0].result() is True, (
+            "Acked message did not resolve its future."
+        )
+        self.assertRaises(DeliveryFailed, futures[1].result)
+        # the outcome of a message is up to the broker
+        assert not futures[0].cancel() and not futures[1].cancel(), (
+            "Publisher handed out futures that could be cancelled."
+        )
+        # a late confirmation doesn't touch a resolved future
+        publisher._time_out(futures[0], ('bar', exchange, '', None))
+        assert futures[0].result() is True
+        # the window should be empty again
+        assert publisher._window.acquire(blocking=False), (
+            "Confirmed messages did not leave the window."
+        )
+
+    def test_confirm_publisher_sends_batches_bigger_than_its_window(self):
+        # import the publisher to be tested
+        from nautilus.network.publishers import ConfirmPublisher
+
+        exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+        publisher = ConfirmPublisher(window=2)
+        # pretend the IOLoop is running over an open channel
+        publisher._thread = MagicMock()
+        publisher._channel = MagicMock()
+
+        # the IOLoop writes the messages and the broker confirms them right away
+        def run_on_ioloop(callback):
+            callback()
+            ack = MagicMock()
+            ack.method.NAME = 'Basic.Ack'
+            ack.method.delivery_tag = publisher._message_number
+            ack.method.multiple = True
+            publisher.on_delivery_confirmation(ack)
+        publisher._ioloop = MagicMock()
+        publisher._ioloop.add_callback_threadsafe.side_effect = run_on_ioloop
+
+        futures = publisher.publish_many([('bar', exchange, '', None)] * 3)
+
+        assert [future.result(timeout=1) for future in futures] == [True] * 3, (
+            "Publisher did not send a batch bigger than its window."
+        )
+
+    def test_confirm_publisher_times_out_messages_waiting_for_a_connection(self):
+        # import the publisher to be tested
+        from nautilus.network.publishers import ConfirmPublisher
+        from concurrent.futures import TimeoutError
+
+        publisher = ConfirmPublisher(timeout=0.01)
+        # pretend the IOLoop is running without a connection
+        publisher._thread = MagicMock()
+        publisher._ioloop = MagicMock()
+
+        future = publisher.publish('bar', {'name': 'foo', 'type': 'fanout', 'durable': True})
+        time.sleep(0.02)
+        publisher._check_timeouts()
+
+        self.assertRaises(TimeoutError, future.result, timeout=0)
+
+    def test_async_publisher_waits_for_confirmation(self):
+        # import the publisher to be tested
+        import asyncio
+        from nautilus.network.publishers import AsyncPublisher
+
+        loop = asyncio.new_event_loop()
+        exchange = {'name': 'foo', 'type': 'fanout', 'durable': True}
+        publisher = AsyncPublisher(loop=loop)
+
+        # a channel that declares exchanges right away
+        channel = MagicMock()
+        channel.exchange_declare.side_effect = lambda callback, *args, **kwds: callback(None)
+        # open the channel as soon as we connect
+        def connect():
+            loop.call_soon(publisher.on_channel_open, channel)
+            return MagicMock()
+        publisher.connect = connect
+
+        # ack every message as soon as it is published
+        def ack(**kwds):
+            frame = MagicMock()
+            frame.method.NAME = 'Basic.Ack'
+            frame.method.delivery_tag = publisher._message_number + 1
+            frame.method.multiple = False
+            loop.call_soon(publisher.on_delivery_confirmation, frame)
+        channel.basic_publish.side_effect = ack
+
+        # publish a few messages at once
+        async def publish():
+            return await asyncio.gather(
+                publisher.publish(body='bar', exchange=exchange),
+                publisher.publish(body='baz', exchange=exchange),
+            )
+        results = loop.run_until_complete(publish())
+        loop.close()
+
+        assert results == [True, True], (
+            "Publisher did not wait for the confirmations."
+        )
+        assert channel.exchange_declare.call_count == 1, (
+            "Publisher did not share the exchange declaration."
+        )
+
+    def test_codecs_round_trip(self):
+        # import the codecs to be tested
+        from nautilus.network import codecs
+
+        action = {'type': 'foo', 'payload': {'bar': 'baz'}}
+        for content_type in codecs._codecs:
+            codec = codecs.get_codec(content_type)
+            assert codec.decode(codec.encode(action)) == action, (
+                "{} codec did not round trip.".format(content_type)
+            )
+
+    def test_large_actions_are_compressed(self):
+        # import the module to be tested
+        from nautilus.network import dispatch, codecs
+
+        dispatch.configure_dispatch(compress_threshold=100)
+
+        # a small action is left alone
+        body, properties = dispatch._serialize_action('foo', 'bar')
+        assert properties.content_encoding is None, (
+            "Small action was compressed."
+        )
+
+        # a big one is compressed
+        body, properties = dispatch._serialize_action('foo', 'bar' * 100)
+        assert properties.content_encoding == 'zlib', (
+            "Large action was not compressed."
+        )
+        assert codecs.get_codec(properties.content_type).decode(
+            codecs.decompress(body, properties.content_encoding)
+        ) == {'type': 'foo', 'payload': 'bar' * 100}, (
+            "Compressed action could not be read."
+        )
+
+    def test_actions_are_stamped_with_a_message_id(self):
+        # import the module to be tested
+        from nautilus.network import dispatch
+
+        _, first = dispatch._serialize_action('foo', 'bar')
+        _, second = dispatch._serialize_action('foo', 'bar')
+        _, given = dispatch._serialize_action('foo', 'bar', message_id='abc')
+
+        assert first.message_id and first.message_id != second.message_id, (
+            "Actions were not given unique message ids."
+        )
+        assert given.message_id == 'abc'
+        assert first.type == 'foo', (
+            "Action type was not set in the message properties."
+        )
+        assert abs(first.headers[dispatch.DISPATCHED_AT_HEADER] / 1000 - time.time()) < 5, (
+            "Action was not stamped with the time it was dispatched."
+        )
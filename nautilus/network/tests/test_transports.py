@@ -0,0 +1,392 @@
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+class TestMemoryTransport(unittest.TestCase):
+
+    def setUp(self):
+        # import the transport to be tested
+        from nautilus.network.transports import MemoryTransport
+        # every test gets a broker of its own
+        self.transport = MemoryTransport()
+
+    def consume(self, action_handler, consumer_class=None, **options):
+        """ Run an action consumer over the transport until the test is done. """
+        from nautilus.network.consumers import ActionConsumer
+
+        consumer_class = consumer_class or ActionConsumer
+        consumer = consumer_class(action_handler=action_handler, transport=self.transport, **options)
+        thread = self.consumer_thread = threading.Thread(target=consumer.run)
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            consumer.stop_threadsafe()
+            thread.join(1)
+        self.addCleanup(stop)
+
+        # wait for the consumer to bind its queue
+        for _ in range(100):
+            if consumer._consumer_tag:
+                break
+            threading.Event().wait(0.01)
+
+        return consumer
+
+    def test_delivers_dispatched_actions_to_consumers(self):
+        from nautilus.network.dispatch import ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        received = threading.Event()
+        handler = MagicMock(side_effect=lambda **kwargs: received.set())
+        self.consume(handler)
+
+        # publish an action the way dispatch_action would
+        body = get_codec().encode({'type': 'foo', 'payload': 'bar'})
+        self.transport.publisher().publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+
+        assert received.wait(1), (
+            "Consumer did not receive the action."
+        )
+        handler.assert_called_once_with(action_type='foo', payload='bar')
+
+    def test_topic_exchanges_route_by_action_type(self):
+        from nautilus.network.dispatch import TOPIC_ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        received = threading.Event()
+        def handler(action_type, payload):
+            calls.append(action_type)
+            received.set()
+        handler.action_types = ['foo']
+        calls = []
+        self.consume(handler, exchange_type='topic')
+
+        publisher = self.transport.publisher()
+        for action_type in ['bar', 'foo']:
+            body = get_codec().encode({'type': action_type, 'payload': None})
+            publisher.publish(body=body, exchange=TOPIC_ACTION_EXCHANGE, routing_key=action_type)
+
+        received.wait(1)
+        assert calls == ['foo'], (
+            "Topic consumer received an action it does not handle."
+        )
+
+    def test_topic_matching(self):
+        from nautilus.network.transports.MemoryBroker import topic_matches
+
+        assert topic_matches('#', 'foo.bar')
+        assert topic_matches('foo.*', 'foo.bar')
+        assert topic_matches('foo.#', 'foo')
+        assert not topic_matches('foo.*', 'foo.bar.baz')
+        assert not topic_matches('foo', 'foo_bar')
+
+    def test_unacked_messages_are_requeued_when_the_channel_closes(self):
+        from nautilus.network.transports import MemoryConnection
+
+        broker = self.transport.broker
+        broker.declare_exchange('test', 'fanout')
+        queue = broker.declare_queue()
+        broker.bind_queue(queue, 'test', '')
+
+        connection = MemoryConnection(broker)
+        channel = connection.channel(lambda channel: None)
+        channel.basic_qos(prefetch_count=1)
+        channel.basic_consume(MagicMock(), queue)
+
+        broker.publish('test', '', b'foo', None)
+        broker.publish('test', '', b'bar', None)
+        # the second message has to wait for the first to be acked
+        assert broker.message_count(queue) == 1
+
+        channel.close()
+        assert broker.message_count(queue) == 2, (
+            "Closing the channel did not requeue the unacked message."
+        )
+        assert broker.get(queue).redelivered
+
+    def test_consumers_sharing_a_queue_split_the_actions(self):
+        from nautilus.network.dispatch import ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        handled = threading.Semaphore(0)
+        handlers = [MagicMock(side_effect=lambda **kwargs: handled.release()) for _ in range(2)]
+        consumers = [self.consume(handler, queue='service-queue') for handler in handlers]
+
+        publisher = self.transport.publisher()
+        for _ in range(4):
+            body = get_codec().encode({'type': 'foo', 'payload': None})
+            publisher.publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+
+        for _ in range(4):
+            assert handled.acquire(timeout=1), (
+                "Consumers sharing a queue did not handle every action."
+            )
+        assert [handler.call_count for handler in handlers] == [2, 2], (
+            "Actions were not split between the consumers sharing the queue."
+        )
+
+        # the queue goes away with the last of its consumers
+        for consumer in consumers:
+            consumer.stop_threadsafe()
+        for _ in range(100):
+            if 'service-queue' not in self.transport.broker._queues:
+                break
+            threading.Event().wait(0.01)
+        assert 'service-queue' not in self.transport.broker._queues, (
+            "The shared queue outlived its consumers."
+        )
+
+    def test_durable_queues_hold_actions_while_nobody_listens(self):
+        from nautilus.network.dispatch import ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        consumer = self.consume(MagicMock(), queue='service', durable=True)
+        consumer.stop_threadsafe()
+        self.consumer_thread.join(1)
+
+        body = get_codec().encode({'type': 'foo', 'payload': None})
+        self.transport.publisher().publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+
+        assert self.transport.broker.message_count('service') == 1, (
+            "Durable queue did not keep the action for the next consumer."
+        )
+
+        received = threading.Event()
+        self.consume(MagicMock(side_effect=lambda **kwargs: received.set()), queue='service', durable=True)
+        assert received.wait(1), (
+            "Consumer did not pick up the action left in the durable queue."
+        )
+
+    def test_failed_actions_are_retried_after_a_delay(self):
+        from nautilus.network.dispatch import ACTION_EXCHANGE, DEAD_LETTER_QUEUE
+        from nautilus.network.codecs import get_codec
+
+        handled = threading.Event()
+        def handler(action_type, payload):
+            attempts.append(action_type)
+            # fail the first two attempts
+            if len(attempts) < 3:
+                raise Exception('oops')
+            handled.set()
+        attempts = []
+        self.consume(handler, retry_delays=[10, 20])
+
+        body = get_codec().encode({'type': 'foo', 'payload': None})
+        self.transport.publisher().publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+
+        assert handled.wait(1), (
+            "Failed action was not retried."
+        )
+        assert len(attempts) == 3
+        assert self.transport.broker.message_count(DEAD_LETTER_QUEUE) == 0
+
+    def test_retries_come_back_to_a_restarted_service(self):
+        from nautilus.network.dispatch import ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        failed = threading.Event()
+        def failing_handler(action_type, payload):
+            failed.set()
+            raise Exception('oops')
+        consumer = self.consume(failing_handler, retry_delays=[100], service='service')
+
+        body = get_codec().encode({'type': 'foo', 'payload': None})
+        self.transport.publisher().publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+        assert failed.wait(1)
+
+        # the service goes down (taking its queue with it) while the action waits
+        consumer.stop_threadsafe()
+        self.consumer_thread.join(1)
+
+        retried = threading.Event()
+        self.consume(MagicMock(side_effect=lambda **kwargs: retried.set()), service='service')
+        assert retried.wait(1), (
+            "Retried action did not find its way back to the restarted service."
+        )
+
+    def test_actions_are_dead_lettered_once_out_of_attempts(self):
+        from nautilus.network.dispatch import ACTION_EXCHANGE, DEAD_LETTER_QUEUE
+        from nautilus.network.codecs import get_codec
+
+        handler = MagicMock(side_effect=Exception('oops'))
+        self.consume(handler, retry_delays=[10])
+
+        body = get_codec().encode({'type': 'foo', 'payload': None})
+        self.transport.publisher().publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+
+        for _ in range(100):
+            if self.transport.broker.message_count(DEAD_LETTER_QUEUE):
+                break
+            threading.Event().wait(0.01)
+
+        message = self.transport.broker.get(DEAD_LETTER_QUEUE)
+        assert message is not None, (
+            "Action was not dead-lettered."
+        )
+        assert message.body == body and message.properties.headers['x-error'] == 'Exception: oops'
+        assert handler.call_count == 2
+
+    def test_consumers_recover_from_a_lost_connection(self):
+        from nautilus.network.dispatch import ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        received = threading.Event()
+        consumer = self.consume(MagicMock(side_effect=lambda **kwargs: received.set()), queue='service')
+        # the broker drops the connection
+        connection = consumer._connection
+        connection.ioloop.add_callback_threadsafe(
+            lambda: connection.close(320, 'CONNECTION_FORCED')
+        )
+        for _ in range(100):
+            if consumer.recoveries:
+                break
+            threading.Event().wait(0.01)
+
+        assert consumer.recoveries == 1 and consumer.recovery_time < 1, (
+            "Consumer did not reconnect right away."
+        )
+
+        body = get_codec().encode({'type': 'foo', 'payload': None})
+        self.transport.publisher().publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+        assert received.wait(1), (
+            "Consumer did not receive actions after reconnecting."
+        )
+
+    def test_concurrent_handlers_ack_their_actions(self):
+        from nautilus.network.dispatch import ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        # the handlers can only get past the barrier if they run at the same time
+        barrier = threading.Barrier(2, timeout=1)
+        handled = threading.Semaphore(0)
+        def handler(action_type, payload):
+            barrier.wait()
+            handled.release()
+        consumer = self.consume(handler, concurrency=2)
+
+        publisher = self.transport.publisher()
+        for _ in range(2):
+            body = get_codec().encode({'type': 'foo', 'payload': None})
+            publisher.publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+
+        assert handled.acquire(timeout=1) and handled.acquire(timeout=1), (
+            "Handlers did not run concurrently."
+        )
+        # wait for the acks to make it back through the IO loop
+        for _ in range(100):
+            if not consumer._channel._unacked:
+                break
+            threading.Event().wait(0.01)
+        assert not consumer._channel._unacked, (
+            "Handled actions were not acknowledged."
+        )
+
+    def test_batched_handlers_receive_batches(self):
+        from nautilus.network.dispatch import ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        batches = []
+        done = threading.Event()
+        def handler(actions):
+            batches.append(actions)
+            if sum(len(batch) for batch in batches) == 5:
+                done.set()
+        handler.batched = True
+
+        consumer = self.consume(handler, batch_size=3, batch_delay=10)
+        publisher = self.transport.publisher()
+        for payload in range(5):
+            body = get_codec().encode({'type': 'foo', 'payload': payload})
+            publisher.publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+
+        assert done.wait(1), (
+            "Batched handler did not receive every action."
+        )
+        assert batches[0] == [('foo', 0), ('foo', 1), ('foo', 2)], (
+            "Batched handler did not receive a full batch."
+        )
+        # wait for the acks to make it back through the IO loop
+        for _ in range(100):
+            if not consumer._channel._unacked:
+                break
+            threading.Event().wait(0.01)
+        assert not consumer._channel._unacked, (
+            "Batched actions were not acknowledged."
+        )
+
+    def test_async_consumers_overlap_coroutine_handlers(self):
+        import asyncio
+        from nautilus.network.consumers import AsyncActionConsumer
+        from nautilus.network.dispatch import ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        running = []
+        handled = threading.Semaphore(0)
+        async def handler(action_type, payload):
+            running.append(payload)
+            # the first handler can only finish once the second one has started
+            while len(running) < 2:
+                await asyncio.sleep(0.01)
+            handled.release()
+        self.consume(handler, consumer_class=AsyncActionConsumer)
+
+        publisher = self.transport.publisher()
+        for payload in range(2):
+            body = get_codec().encode({'type': 'foo', 'payload': payload})
+            publisher.publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+
+        assert handled.acquire(timeout=1) and handled.acquire(timeout=1), (
+            "Coroutine handlers did not overlap."
+        )
+
+    def test_async_consumers_run_sync_handlers_on_threads(self):
+        from nautilus.network.consumers import AsyncActionConsumer
+        from nautilus.network.dispatch import ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        threads = []
+        handled = threading.Event()
+        def handler(action_type, payload):
+            threads.append(threading.current_thread())
+            handled.set()
+        self.consume(handler, consumer_class=AsyncActionConsumer)
+
+        body = get_codec().encode({'type': 'foo', 'payload': None})
+        self.transport.publisher().publish(body=body, exchange=ACTION_EXCHANGE, routing_key='foo')
+
+        assert handled.wait(1)
+        assert threads[0] is not self.consumer_thread, (
+            "Synchronous handler blocked the event loop."
+        )
+
+    def test_async_consumers_hold_back_multi_record_actions(self):
+        import asyncio
+        from nautilus.network.consumers import AsyncActionConsumer
+        from nautilus.network.dispatch import ACTION_EXCHANGE
+        from nautilus.network.codecs import get_codec
+
+        handled = []
+        done = threading.Event()
+        async def handler(action_type, payload):
+            # give the records a chance to overtake each other
+            if action_type == 'foo':
+                await asyncio.sleep(0.01 * (payload['id'] % 3))
+            handled.append(action_type)
+            if len(handled) == 13:
+                done.set()
+        handler.partition_fields = ['id']
+        handler.multi_record_types = ['purge']
+        self.consume(handler, consumer_class=AsyncActionConsumer)
+
+        actions = [('foo', {'id': record}) for record in range(6)] + [('purge', [1, 2])] + \
+                  [('foo', {'id': record}) for record in range(6)]
+        publisher = self.transport.publisher()
+        for action_type, payload in actions:
+            body = get_codec().encode({'type': action_type, 'payload': payload})
+            publisher.publish(body=body, exchange=ACTION_EXCHANGE, routing_key=action_type)
+
+        assert done.wait(1)
+        assert handled.index('purge') == 6, (
+            "Multi-record action was not handled between the actions around it."
+        )
@@ -25,3 +25,138 @@ class TestUtil(unittest.TestCase):
         handleMock1.assert_called_once_with(type, payload)
         handleMock2.assert_called_once_with(type, payload)
         handleMock3.assert_called_once_with(type, payload)
+
+    def test_merged_handlers_declare_their_action_types(self):
+        # import the functions to be tested
+        from nautilus.network.util import combine_action_handlers, action_types_for
+
+        def handler1(action_type, payload): pass
+        handler1.action_types = ['foo']
+        def handler2(action_type, payload): pass
+        handler2.action_types = ['bar']
+
+        merged = combine_action_handlers(handler1, handler2)
+        assert action_types_for(merged) == {'foo', 'bar'}, (
+            "Merged handler did not declare the action types of its handlers."
+        )
+
+        # a handler without a declaration wants every action
+        merged = combine_action_handlers(handler1, MagicMock())
+        assert action_types_for(merged) is None, (
+            "Merged handler ignored a handler that wants every action."
+        )
+
+    def test_merged_handlers_route_actions_by_type(self):
+        # import the function to be tested
+        from nautilus.network.util import combine_action_handlers
+
+        foo_handler = MagicMock(action_types=['foo'])
+        bar_handler = MagicMock(action_types=['bar'], batched=True)
+        legacy_handler = MagicMock()
+
+        merged = combine_action_handlers(foo_handler, bar_handler, legacy_handler)
+        merged('foo', 1)
+
+        foo_handler.assert_called_once_with('foo', 1)
+        assert not bar_handler.called, (
+            "Merged handler passed an action to a handler that did not declare its type."
+        )
+        legacy_handler.assert_called_once_with('foo', 1)
+        # types nobody declared only go to the handlers that want everything
+        assert merged.router.handlers_for('baz') == (legacy_handler,)
+        assert merged.router.handlers_for('bar') == (bar_handler, legacy_handler)
+
+    def test_merged_handlers_declare_their_partition_fields(self):
+        # import the functions to be tested
+        from nautilus.network.util import combine_action_handlers, partition_fields_for
+
+        def handler1(action_type, payload): pass
+        handler1.partition_fields = ['id']
+        def handler2(action_type, payload): pass
+        handler2.partition_fields = ()
+
+        # handlers that don't care about order don't get a say
+        merged = combine_action_handlers(handler1, handler2)
+        assert partition_fields_for(merged) == ('id',), (
+            "Merged handler did not declare the partition fields of its handlers."
+        )
+
+        # a handler without a declaration could care about anything
+        merged = combine_action_handlers(handler1, MagicMock())
+        assert partition_fields_for(merged) is None, (
+            "Merged handler ignored a handler without partition fields."
+        )
+
+    def test_partition_key(self):
+        # import the function to be tested
+        from nautilus.network.util import partition_key
+
+        # the same record gets the same key regardless of how the key was sent
+        assert partition_key(('id',), {'id': 1, 'name': 'foo'}) == partition_key(('id',), '1')
+        # payloads that don't identify a record don't have a key
+        assert partition_key(('id',), {'name': 'foo'}) is None
+        # neither do lists of records
+        assert partition_key(('id',), [1, 2]) is None
+
+    def test_merged_batch_handlers(self):
+        # import the functions to be tested
+        from nautilus.network.util import combine_action_handlers, accepts_batches
+
+        batch_handler = MagicMock(batched=True)
+        action_handler = MagicMock()
+
+        # handlers that all take batches make a handler that takes batches
+        merged = combine_action_handlers(batch_handler)
+        assert accepts_batches(merged)
+        merged([('foo', 'bar')])
+        batch_handler.assert_called_once_with([('foo', 'bar')])
+
+        # otherwise batch handlers get a batch of one
+        merged = combine_action_handlers(batch_handler, action_handler)
+        assert not accepts_batches(merged)
+        merged('foo', 'baz')
+        batch_handler.assert_called_with([('foo', 'baz')])
+        action_handler.assert_called_once_with('foo', 'baz')
+
+        # handlers that don't handle anything don't stop the others from batching
+        idle_handler = MagicMock(action_types=[])
+        assert accepts_batches(combine_action_handlers(batch_handler, idle_handler))
+
+    def test_merged_handlers_collect_partial_failures(self):
+        # import the functions to be tested
+        from nautilus.network.util import combine_action_handlers, ActionsFailed
+
+        error = Exception('oops')
+        def failing_handler(actions):
+            raise ActionsFailed([(actions[0], error)])
+        failing_handler.batched = True
+        batch_handler = MagicMock(batched=True)
+
+        merged = combine_action_handlers(failing_handler, batch_handler)
+        with self.assertRaises(ActionsFailed) as context:
+            merged([('foo', 'bar'), ('foo', 'baz')])
+
+        # the handlers after the one that failed still ran
+        batch_handler.assert_called_once_with([('foo', 'bar'), ('foo', 'baz')])
+        assert context.exception.failures == [(('foo', 'bar'), error)]
+
+    def test_merged_coroutine_handlers(self):
+        # import the function to be tested
+        from nautilus.network.util import combine_action_handlers
+        import asyncio
+
+        calls = []
+        async def async_handler(action_type, payload):
+            calls.append(('async', payload))
+        def sync_handler(action_type, payload):
+            calls.append(('sync', payload))
+
+        merged = combine_action_handlers(async_handler, sync_handler)
+        assert asyncio.iscoroutinefunction(merged), (
+            "Merged handler with a coroutine handler was not a coroutine function."
+        )
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(merged('foo', 'bar'))
+        loop.close()
+        assert calls == [('async', 'bar'), ('sync', 'bar')]
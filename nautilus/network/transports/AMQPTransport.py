@@ -0,0 +1,73 @@
+# external imports
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+# local imports
+from ..publishers import AsyncPublisher, BasicPublisher, ConfirmPublisher
+
+
+class AMQPTransport:
+    """
+        Sends actions through a RabbitMQ broker. This is the default transport
+        and the only one that can connect services running on different hosts.
+    """
+
+    name = 'amqp'
+    # services using this transport talk to each other over the network
+    in_process = False
+
+    def connect(self, amqp_url, on_open_callback, loop=None, on_open_error_callback=None):
+        """
+            Open a connection for a consumer, returning the connection handle.
+
+            Args:
+                amqp_url (str): The AMQP url to connect with.
+
+                on_open_callback (function): Called with the connection once
+                    it is open.
+
+                loop (optional, asyncio.AbstractEventLoop): Run the connection
+                    on the given event loop rather than its own IO loop.
+
+                on_open_error_callback (optional, function): Called with the
+                    connection and the error if the connection can't be opened.
+        """
+        # if the connection has to share an event loop
+        if loop:
+            return AsyncioConnection(pika.URLParameters(amqp_url),
+                                     on_open_callback,
+                                     on_open_error_callback,
+                                     stop_ioloop_on_close=False,
+                                     custom_ioloop=loop)
+
+        return pika.SelectConnection(pika.URLParameters(amqp_url),
+                                     on_open_callback,
+                                     on_open_error_callback,
+                                     stop_ioloop_on_close=False)
+
+    def publisher(self, pool_size=None, confirm=False, window=None, timeout=None):
+        """
+            Create a publisher for the transport.
+
+            Args:
+                pool_size (optional, int): The number of connections to keep open.
+
+                confirm (optional, bool): Whether or not to wait for the broker
+                    to confirm each message (see ConfirmPublisher).
+
+                window (optional, int): The number of messages that can be
+                    waiting on a confirmation at once.
+
+                timeout (optional, number): The number of seconds to wait for a
+                    confirmation.
+        """
+        # if the broker needs to confirm every message
+        if confirm:
+            # keep a window of messages in flight
+            return ConfirmPublisher(window=window, timeout=timeout)
+
+        # otherwise messages are sent over a pool of connections
+        return BasicPublisher(pool_size=pool_size)
+
+    def async_publisher(self, loop=None):
+        """ Create a publisher for coroutines running on the given event loop. """
+        return AsyncPublisher(loop=loop)
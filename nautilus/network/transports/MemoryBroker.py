@@ -0,0 +1,241 @@
+"""
+    This module defines a broker that lives inside of the current process. It
+    implements the parts of the AMQP model nautilus relies on (fanout, direct
+    and topic exchanges, named and automatically named queues, competing
+    consumers, prefetch, acks and requeues, message TTLs and dead-lettering)
+    without any network traffic.
+"""
+
+# external imports
+import collections
+import re
+import threading
+import time
+import uuid
+
+# a message sitting in one of the broker's queues
+Message = collections.namedtuple('Message', [
+    'exchange', 'routing_key', 'body', 'properties', 'redelivered', 'expires'
+])
+
+
+class _Queue:
+    """ A queue in the broker along with the consumers reading from it. """
+
+    def __init__(self, name, arguments=None, auto_delete=False):
+        self.name = name
+        self.arguments = arguments or {}
+        # whether the queue goes away along with its last consumer
+        self.auto_delete = auto_delete
+        self.messages = collections.deque()
+        self.consumers = []
+        # the position of the next consumer to try (for round robin delivery)
+        self.next_consumer = 0
+
+
+class _Exchange:
+    """ An exchange in the broker along with its bindings. """
+
+    def __init__(self, name, exchange_type):
+        self.name = name
+        self.type = exchange_type
+        # (queue name, binding key) pairs
+        self.bindings = []
+
+    def route(self, routing_key):
+        """ Return the names of the queues a message with the given routing key goes to. """
+        if self.type == 'fanout':
+            matches = [queue for queue, key in self.bindings]
+        elif self.type == 'topic':
+            matches = [queue for queue, key in self.bindings if topic_matches(key, routing_key)]
+        else:
+            matches = [queue for queue, key in self.bindings if key == routing_key]
+
+        # a queue only gets one copy of the message no matter how many bindings matched
+        return list(collections.OrderedDict.fromkeys(matches))
+
+
+def topic_matches(binding_key, routing_key):
+    """ Return whether the routing key matches the binding key of a topic exchange. """
+    # convert the binding key to a regular expression
+    pattern = []
+    for word in binding_key.split('.'):
+        if word == '#':
+            pattern.append(r'(?:[^.]+(?:\.[^.]+)*)?')
+        elif word == '*':
+            pattern.append(r'[^.]+')
+        else:
+            pattern.append(re.escape(word))
+
+    # '#' can match no words at all, in which case its dot is optional too
+    expression = r'\.?'.join(pattern) if '#' in binding_key else r'\.'.join(pattern)
+
+    return re.fullmatch(expression, routing_key or '') is not None
+
+
+class MemoryBroker:
+    """
+        An in-process message broker. Every method is thread-safe so the
+        broker can be shared by the publishers and consumers of every service
+        running in the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._exchanges = {}
+        self._queues = {}
+
+    def declare_exchange(self, name, exchange_type):
+        """
+            Make sure there is an exchange with the given name and type.
+
+            Raises:
+                ValueError: If the exchange exists with a different type.
+        """
+        with self._lock:
+            exchange = self._exchanges.setdefault(name, _Exchange(name, exchange_type))
+            if exchange.type != exchange_type:
+                raise ValueError("Exchange {} is a {} exchange, not {}".format(
+                    name, exchange.type, exchange_type
+                ))
+
+    def declare_queue(self, name='', arguments=None, auto_delete=False):
+        """
+            Make sure there is a queue with the given name, returning the name.
+            An auto-delete queue is deleted once its last consumer is cancelled.
+        """
+        with self._lock:
+            # generate a name if we weren't given one
+            name = name or 'amq.gen-{}'.format(uuid.uuid4().hex)
+            if name not in self._queues:
+                self._queues[name] = _Queue(name, arguments, auto_delete)
+            return name
+
+    def delete_queue(self, name):
+        with self._lock:
+            self._queues.pop(name, None)
+            for exchange in self._exchanges.values():
+                exchange.bindings = [binding for binding in exchange.bindings if binding[0] != name]
+
+    def bind_queue(self, queue, exchange, routing_key):
+        with self._lock:
+            bindings = self._exchanges[exchange].bindings
+            if (queue, routing_key) not in bindings:
+                bindings.append((queue, routing_key))
+
+    def message_count(self, queue):
+        """ The number of messages waiting in the given queue. """
+        with self._lock:
+            return len(self._queues[queue].messages)
+
+    def consumer_count(self, queue):
+        """ The number of consumers reading from the given queue. """
+        with self._lock:
+            return len(self._queues[queue].consumers)
+
+    def publish(self, exchange, routing_key, body, properties):
+        """ Route a message through the exchange to the matching queues. """
+        message = Message(exchange, routing_key, body, properties, False, None)
+
+        with self._lock:
+            # the default exchange sends messages to the queue named by the routing key
+            if exchange == '':
+                queues = [routing_key] if routing_key in self._queues else []
+            else:
+                queues = self._exchanges[exchange].route(routing_key)
+
+            for name in queues:
+                ttl = self._queues[name].arguments.get('x-message-ttl')
+                # if messages only get to wait in the queue for so long
+                if ttl is not None:
+                    expires = time.monotonic() + ttl / 1000
+                    self._queues[name].messages.append(message._replace(expires=expires))
+                    self._expire_later(name, ttl / 1000)
+                else:
+                    self._queues[name].messages.append(message)
+                self.pump(name)
+
+    def get(self, queue):
+        """ Remove and return the next message in the queue, or None if it is empty. """
+        with self._lock:
+            messages = self._queues[queue].messages
+            return messages.popleft() if messages else None
+
+    def requeue(self, queue, message):
+        """ Put a message back at the front of its queue. """
+        with self._lock:
+            # if the queue was deleted in the meantime, so is the message
+            if queue not in self._queues:
+                return
+            self._queues[queue].messages.appendleft(message._replace(redelivered=True))
+            self.pump(queue)
+
+    def reject(self, queue, message):
+        """ Drop a message, dead-lettering it if its queue has a dead-letter exchange. """
+        with self._lock:
+            arguments = self._queues[queue].arguments if queue in self._queues else {}
+            dead_letter_exchange = arguments.get('x-dead-letter-exchange')
+            # if there is nowhere to send the message
+            if dead_letter_exchange is None:
+                return
+
+            self.publish(
+                dead_letter_exchange,
+                arguments.get('x-dead-letter-routing-key', message.routing_key),
+                message.body,
+                message.properties
+            )
+
+    def expire(self, queue):
+        """ Dead-letter the messages at the front of the queue whose time is up. """
+        with self._lock:
+            # if the queue was deleted in the meantime
+            if queue not in self._queues:
+                return
+
+            messages = self._queues[queue].messages
+            now = time.monotonic()
+            while messages and messages[0].expires is not None and messages[0].expires <= now:
+                self.reject(queue, messages.popleft())
+
+    def _expire_later(self, queue, delay):
+        timer = threading.Timer(delay, self.expire, args=(queue,))
+        timer.daemon = True
+        timer.start()
+
+    def consume(self, queue, consumer):
+        """ Start delivering the messages in the queue to the given consumer. """
+        with self._lock:
+            self._queues[queue].consumers.append(consumer)
+            self.pump(queue)
+
+    def cancel(self, queue, consumer):
+        """ Stop delivering messages in the queue to the given consumer. """
+        with self._lock:
+            # the queue might have been deleted already
+            if queue in self._queues and consumer in self._queues[queue].consumers:
+                self._queues[queue].consumers.remove(consumer)
+                # if that was the last thing keeping the queue around
+                if self._queues[queue].auto_delete and not self._queues[queue].consumers:
+                    self.delete_queue(queue)
+
+    def pump(self, queue):
+        """ Hand out as many messages in the queue as the consumers can take. """
+        with self._lock:
+            queue = self._queues.get(queue)
+            if queue is None:
+                return
+
+            while queue.messages and queue.consumers:
+                # find the next consumer with room for another message
+                for offset in range(len(queue.consumers)):
+                    index = (queue.next_consumer + offset) % len(queue.consumers)
+                    consumer = queue.consumers[index]
+                    if consumer.has_capacity():
+                        break
+                # if every consumer is busy
+                else:
+                    return
+
+                queue.next_consumer = index + 1
+                consumer.deliver(queue.name, queue.messages.popleft())
@@ -0,0 +1,357 @@
+"""
+    This module mimics the parts of pika's SelectConnection and Channel that the
+    consumers use, backed by a MemoryBroker instead of a socket. Callbacks are
+    run by an IOLoop with the same interface as pika's so a consumer written
+    against pika works unchanged.
+"""
+
+# external imports
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+import pika
+from pika import frame, spec
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MemoryIOLoop:
+    """ A minimal IOLoop that runs callbacks (possibly from other threads) and timeouts. """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._callbacks = collections.deque()
+        # (deadline, sequence number, callback) heap
+        self._timeouts = []
+        self._sequence = itertools.count()
+        self._running = False
+        self._stopping = False
+
+    def add_callback_threadsafe(self, callback):
+        """ Run the callback on the IOLoop. Safe to call from any thread. """
+        with self._condition:
+            self._callbacks.append(callback)
+            self._condition.notify()
+
+    # callbacks are always threadsafe
+    add_callback = add_callback_threadsafe
+
+    def add_timeout(self, deadline, callback):
+        """ Run the callback on the IOLoop after the given number of seconds. """
+        timeout = (time.monotonic() + deadline, next(self._sequence), callback)
+        with self._condition:
+            heapq.heappush(self._timeouts, timeout)
+            self._condition.notify()
+        return timeout
+
+    def remove_timeout(self, timeout):
+        with self._condition:
+            if timeout in self._timeouts:
+                self._timeouts.remove(timeout)
+                heapq.heapify(self._timeouts)
+
+    def start(self):
+        """ Run callbacks until the IOLoop is stopped. """
+        # if the loop is already running further up the stack, let it carry on
+        if self._running:
+            return
+
+        self._running = True
+        self._stopping = False
+        try:
+            while not self._stopping:
+                for callback in self._ready():
+                    callback()
+        finally:
+            self._running = False
+
+    def stop(self):
+        """ Stop the IOLoop once the current callback returns. """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+
+    def _ready(self):
+        """ Wait for and return the callbacks that are ready to run. """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                # move any expired timeouts over to the callbacks
+                while self._timeouts and self._timeouts[0][0] <= now:
+                    self._callbacks.append(heapq.heappop(self._timeouts)[2])
+
+                if self._callbacks or self._stopping:
+                    ready = list(self._callbacks)
+                    self._callbacks.clear()
+                    return ready
+
+                # sleep until something is added or the next timeout expires
+                self._condition.wait(self._timeouts[0][0] - now if self._timeouts else None)
+
+
+class MemoryConnection:
+    """
+        A connection to a MemoryBroker with the same interface as a
+        pika.SelectConnection.
+
+        Args:
+            broker (MemoryBroker): The broker to connect to.
+
+            on_open_callback (optional, function): Called with the connection
+                once the IOLoop starts.
+
+            on_close_callback (optional, function): Called with (connection,
+                reply_code, reply_text) once the connection is closed.
+
+            ioloop (optional, MemoryIOLoop): The IOLoop to run callbacks on.
+    """
+
+    def __init__(self, broker, on_open_callback=None, on_close_callback=None, ioloop=None):
+        self.broker = broker
+        self.ioloop = ioloop or MemoryIOLoop()
+        self._channels = {}
+        self._channel_numbers = itertools.count(1)
+        self._on_close_callbacks = [on_close_callback] if on_close_callback else []
+        self.is_open = True
+        self.is_closing = False
+        self.is_closed = False
+
+        # the connection is "established" as soon as the IOLoop starts
+        if on_open_callback:
+            self.ioloop.add_callback_threadsafe(lambda: on_open_callback(self))
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        return self.ioloop.add_timeout(deadline, callback)
+
+    def remove_timeout(self, timeout):
+        self.ioloop.remove_timeout(timeout)
+
+    def channel(self, on_open_callback, channel_number=None):
+        """ Open a new channel, passing it to the callback. """
+        channel = MemoryChannel(self, channel_number or next(self._channel_numbers))
+        self._channels[channel.channel_number] = channel
+        self.ioloop.add_callback_threadsafe(lambda: on_open_callback(channel))
+        return channel
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        """ Close every channel and then the connection itself. """
+        # if we are already on our way out
+        if self.is_closing or self.is_closed:
+            return
+
+        self.is_open = False
+        self.is_closing = True
+        for channel in list(self._channels.values()):
+            channel.close(reply_code, reply_text)
+
+        def closed():
+            self.is_closing = False
+            self.is_closed = True
+            for callback in self._on_close_callbacks:
+                callback(self, reply_code, reply_text)
+
+        self.ioloop.add_callback_threadsafe(closed)
+
+    def _on_channel_closed(self, channel):
+        self._channels.pop(channel.channel_number, None)
+
+
+class _MemoryConsumer:
+    """ A consumer registered with the broker on behalf of a channel. """
+
+    def __init__(self, channel, tag, queue, callback, no_ack):
+        self.channel = channel
+        self.tag = tag
+        self.queue = queue
+        self.callback = callback
+        self.no_ack = no_ack
+
+    def has_capacity(self):
+        return self.no_ack or self.channel._has_capacity()
+
+    def deliver(self, queue, message):
+        self.channel._deliver(self, queue, message)
+
+
+class MemoryChannel:
+    """ A channel on a MemoryConnection with the same interface as a pika.channel.Channel. """
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+        self._broker = connection.broker
+        self._ioloop = connection.ioloop
+        self._lock = threading.Lock()
+        self._consumers = {}
+        self._consumer_tags = itertools.count(1)
+        # the messages that haven't been acked yet, by delivery tag
+        self._unacked = collections.OrderedDict()
+        self._delivery_tags = itertools.count(1)
+        self._prefetch_count = 0
+        self._on_close_callbacks = []
+        self._on_cancel_callbacks = []
+        self.is_open = True
+        self.is_closing = False
+        self.is_closed = False
+
+    def __int__(self):
+        return self.channel_number
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        self._on_cancel_callbacks.append(callback)
+
+    def exchange_declare(self, callback=None, exchange=None, exchange_type='direct',
+                         passive=False, durable=False, auto_delete=False,
+                         internal=False, nowait=False, arguments=None):
+        try:
+            self._broker.declare_exchange(exchange, exchange_type)
+        # redeclaring an exchange with a different type closes the channel
+        except ValueError as err:
+            self.close(406, 'PRECONDITION_FAILED - {}'.format(err))
+            return
+
+        self._reply(callback, spec.Exchange.DeclareOk())
+
+    def queue_declare(self, callback=None, queue='', passive=False, durable=False,
+                      exclusive=False, auto_delete=False, nowait=False, arguments=None):
+        name = self._broker.declare_queue(queue, arguments, auto_delete)
+        self._reply(callback, spec.Queue.DeclareOk(
+            queue=name,
+            message_count=self._broker.message_count(name),
+            consumer_count=self._broker.consumer_count(name),
+        ))
+
+    def queue_bind(self, callback, queue, exchange, routing_key=None, nowait=False,
+                   arguments=None):
+        # like amqp, the routing key defaults to the name of the queue
+        self._broker.bind_queue(queue, exchange, queue if routing_key is None else routing_key)
+        self._reply(callback, spec.Queue.BindOk())
+
+    def queue_delete(self, callback=None, queue='', if_unused=False, if_empty=False,
+                     nowait=False):
+        self._broker.delete_queue(queue)
+        self._reply(callback, spec.Queue.DeleteOk())
+
+    def basic_qos(self, callback=None, prefetch_size=0, prefetch_count=0, all_channels=False):
+        with self._lock:
+            self._prefetch_count = prefetch_count
+        self._reply(callback, spec.Basic.QosOk())
+        # a bigger window might let more messages through
+        self._pump()
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False, exclusive=False,
+                      consumer_tag=None, arguments=None):
+        """ Start consuming the queue, returning the consumer tag. """
+        tag = consumer_tag or 'ctag{}.{}'.format(self.channel_number, next(self._consumer_tags))
+        consumer = _MemoryConsumer(self, tag, queue, consumer_callback, no_ack)
+        self._consumers[tag] = consumer
+        self._broker.consume(queue, consumer)
+        return tag
+
+    def basic_cancel(self, callback=None, consumer_tag='', nowait=False):
+        consumer = self._consumers.pop(consumer_tag, None)
+        if consumer:
+            self._broker.cancel(consumer.queue, consumer)
+        self._reply(callback, spec.Basic.CancelOk(consumer_tag=consumer_tag))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False, immediate=False):
+        # the body is always bytes on the way out of a real broker
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self._broker.publish(exchange, routing_key, body, properties or pika.BasicProperties())
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._settle(delivery_tag, multiple)
+        self._pump()
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        for queue, message in self._settle(delivery_tag, multiple):
+            if requeue:
+                self._broker.requeue(queue, message)
+            else:
+                self._broker.reject(queue, message)
+        self._pump()
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self.basic_nack(delivery_tag, multiple=False, requeue=requeue)
+
+    def close(self, reply_code=0, reply_text='Normal shutdown'):
+        """ Cancel the consumers on the channel and requeue any unacked messages. """
+        if self.is_closing or self.is_closed:
+            return
+
+        self.is_open = False
+        self.is_closing = True
+        for consumer in list(self._consumers.values()):
+            self._broker.cancel(consumer.queue, consumer)
+        self._consumers.clear()
+
+        # like a real broker, messages that weren't acked go to another consumer
+        with self._lock:
+            unacked = list(self._unacked.values())
+            self._unacked.clear()
+        for queue, message in unacked:
+            self._broker.requeue(queue, message)
+
+        def closed():
+            self.is_closing = False
+            self.is_closed = True
+            self.connection._on_channel_closed(self)
+            for callback in self._on_close_callbacks:
+                callback(self, reply_code, reply_text)
+
+        self._ioloop.add_callback_threadsafe(closed)
+
+    def _reply(self, callback, method):
+        """ Pass the given method frame to the callback on the IOLoop. """
+        if callback:
+            method_frame = frame.Method(self.channel_number, method)
+            self._ioloop.add_callback_threadsafe(lambda: callback(method_frame))
+
+    def _has_capacity(self):
+        with self._lock:
+            return not self._prefetch_count or len(self._unacked) < self._prefetch_count
+
+    def _deliver(self, consumer, queue, message):
+        """ Hand a message from the broker to the consumer on the IOLoop. """
+        with self._lock:
+            delivery_tag = next(self._delivery_tags)
+            # keep track of the message until it is acked
+            if not consumer.no_ack:
+                self._unacked[delivery_tag] = (queue, message)
+
+        method = spec.Basic.Deliver(
+            consumer_tag=consumer.tag,
+            delivery_tag=delivery_tag,
+            redelivered=message.redelivered,
+            exchange=message.exchange,
+            routing_key=message.routing_key,
+        )
+        self._ioloop.add_callback_threadsafe(
+            lambda: consumer.callback(self, method, message.properties, message.body)
+        )
+
+    def _settle(self, delivery_tag, multiple):
+        """ Stop tracking the message(s) with the given delivery tag, returning them. """
+        with self._lock:
+            if multiple:
+                # a delivery tag of 0 covers every outstanding message
+                tags = [tag for tag in self._unacked if not delivery_tag or tag <= delivery_tag]
+            else:
+                tags = [delivery_tag] if delivery_tag in self._unacked else []
+            return [self._unacked.pop(tag) for tag in tags]
+
+    def _pump(self):
+        """ Let the broker know we might have room for more messages. """
+        for queue in {consumer.queue for consumer in list(self._consumers.values())}:
+            self._broker.pump(queue)
@@ -0,0 +1,48 @@
+# external imports
+from pika.adapters.asyncio_connection import IOLoopAdapter
+# local imports
+from .MemoryBroker import MemoryBroker
+from .MemoryConnection import MemoryConnection
+from ..publishers import MemoryPublisher, MemoryAsyncPublisher
+
+
+class MemoryTransport:
+    """
+        Sends actions through a broker that lives in the current process.
+        Every service in the process that uses this transport shares the same
+        broker, so a whole cloud can run on one host without RabbitMQ (for
+        tests and benchmarks) and co-located services skip the network
+        entirely. Services in other processes cannot see the actions.
+
+        Args:
+            broker (optional, MemoryBroker): The broker to use. Defaults to a
+                new one.
+    """
+
+    name = 'memory'
+    # consumers have to run in the same process as the publishers
+    in_process = True
+
+    def __init__(self, broker=None):
+        self.broker = broker or MemoryBroker()
+
+    def connect(self, amqp_url, on_open_callback, loop=None, on_open_error_callback=None):
+        """
+            Open a connection for a consumer (optionally on an asyncio event
+            loop), returning the connection handle. The broker is always there
+            so the connection never fails to open.
+        """
+        return MemoryConnection(
+            self.broker,
+            on_open_callback,
+            # pika's adapter gives the event loop the interface of an IO loop
+            ioloop=IOLoopAdapter(loop) if loop else None
+        )
+
+    def publisher(self, **options):
+        """ Create a publisher for the transport. Messages are never buffered so options are ignored. """
+        return MemoryPublisher(self.broker)
+
+    def async_publisher(self, loop=None):
+        """ Create a publisher for coroutines running on the given event loop. """
+        return MemoryAsyncPublisher(self.broker, loop=loop)
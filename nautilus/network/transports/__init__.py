@@ -0,0 +1,43 @@
+"""
+    Transports decide how actions travel between services. Publishers and
+    consumers ask the transport for their connections so the same service can
+    run over RabbitMQ or entirely in memory depending on its config.
+"""
+
+# local imports
+from .AMQPTransport import AMQPTransport
+from .MemoryTransport import MemoryTransport
+from .MemoryBroker import MemoryBroker
+from .MemoryConnection import MemoryConnection
+
+# the transports this process knows about, by name
+_transports = {}
+
+# the transport used when a service does not ask for one
+DEFAULT_TRANSPORT = AMQPTransport.name
+
+
+def register_transport(transport):
+    """ Make the given transport available under its name. """
+    _transports[transport.name] = transport
+
+
+def get_transport(name=None):
+    """
+        Return the transport with the given name.
+
+        Args:
+            name (optional, str): The name of the transport. If None, the
+                default (AMQP) transport is returned.
+
+        Raises:
+            ValueError: If there is no transport with the name.
+    """
+    try:
+        return _transports[name or DEFAULT_TRANSPORT]
+    except KeyError:
+        raise ValueError("No transport registered with the name: {}".format(name))
+
+
+register_transport(AMQPTransport())
+register_transport(MemoryTransport())
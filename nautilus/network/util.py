@@ -1,3 +1,5 @@
+import asyncio
+import functools
 import json
 import requests
 import socket
@@ -73,18 +75,285 @@ def query_api(query, mutation = None):
     return query_service(api_gateway_name(), query)
 
 
+def action_types_for(handler):
+    """
+        Return the set of action types the given handler declared (through its
+        `action_types` attribute) or None if it should receive every action.
+    """
+    action_types = getattr(handler, 'action_types', None)
+    # only trust actual declarations
+    if isinstance(action_types, (list, tuple, set, frozenset)):
+        return frozenset(action_types)
+
+    return None
+
+
+def partition_fields_for(handler):
+    """
+        Return the payload fields that identify the record an action applies to
+        (declared through the handler's `partition_fields` attribute) or None if
+        the handler did not declare any. An empty tuple means the order of the
+        handler's actions does not matter.
+    """
+    partition_fields = getattr(handler, 'partition_fields', None)
+    # only trust actual declarations
+    if isinstance(partition_fields, (list, tuple)):
+        return tuple(partition_fields)
+
+    return None
+
+
+def partition_key(partition_fields, payload):
+    """
+        Return the key of the record the given payload applies to, or None if
+        the payload does not identify one.
+
+        Args:
+            partition_fields (tuple): The fields that identify the record.
+            payload (anything serializable): The payload of the action. Payloads
+                that aren't objects (like the primary key sent with a delete)
+                identify the record themselves, except for lists which can
+                refer to any number of records.
+    """
+    # if the payload refers to several records
+    if isinstance(payload, list):
+        return None
+    # if the payload is the identifier
+    if not isinstance(payload, dict):
+        return (str(payload),)
+
+    # if the payload doesn't say which record it applies to
+    if not partition_fields or any(field not in payload for field in partition_fields):
+        return None
+
+    # note: values are compared as strings since the same key can arrive as a number or a string
+    return tuple(str(payload[field]) for field in partition_fields)
+
+
+def multi_record_types_for(handler):
+    """
+        Return the set of action types (declared through the handler's
+        `multi_record_types` attribute) whose actions can apply to any number of
+        records, like a delete with a list of ids or a set of filters. When
+        such an action doesn't identify a single record (see partition_key),
+        concurrent consumers wait for every action before it to be handled
+        and hold the ones after it back until it's done.
+    """
+    multi_record_types = getattr(handler, 'multi_record_types', None)
+    # only trust actual declarations
+    if isinstance(multi_record_types, (list, tuple, set, frozenset)):
+        return frozenset(multi_record_types)
+
+    return frozenset()
+
+
+def accepts_batches(handler):
+    """
+        Return whether the given handler should be called with a list of
+        (action_type, payload) tuples rather than one action at a time, which
+        it declares by setting its `batched` attribute to True.
+    """
+    return getattr(handler, 'batched', False) is True
+
+
+def batch_handler(handle_batch):
+    """
+        This decorator turns a function that takes a list of (action_type,
+        payload) tuples into a handler that takes batches (see accepts_batches)
+        and can still be called with a single action like any other handler,
+        ie. `handler(actions)` or `handler(action_type, payload)`.
+    """
+    def single_action(action_type, payload):
+        return action_type, payload
+
+    @functools.wraps(handle_batch)
+    def action_handler(*args, **kwargs):
+        # if the handler was given a single action
+        if len(args) + len(kwargs) > 1:
+            return handle_batch([single_action(*args, **kwargs)])
+
+        return handle_batch(*args, **kwargs)
+
+    # the handler wants its actions in batches
+    action_handler.batched = True
+
+    return action_handler
+
+
+class ActionsFailed(Exception):
+    """
+        Raised by a handler that takes batches when only some of its actions
+        failed. The consumer acknowledges the rest of the batch and retries
+        the failed actions on their own.
+
+        Args:
+            failures (list): The (action, error) pairs of the failed actions,
+                where action is the (action_type, payload) tuple the handler
+                was given.
+    """
+
+    def __init__(self, failures):
+        super().__init__('{} of the actions failed'.format(len(failures)))
+        self.failures = list(failures)
+
+
+class ActionRouter:
+    """
+        This router hands actions to the handlers that declared their types
+        (see action_types_for) using a table from action type to handlers that
+        is built once, so routing an action costs a dictionary lookup no matter
+        how many handlers there are. Handlers that didn't declare their types
+        receive every action.
+
+        Args:
+            handlers (list): The action handlers, in the order they are called.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = tuple(handlers)
+        # the action types each handler declared (None for every action)
+        declared_types = [action_types_for(handler) for handler in self.handlers]
+        # the positions of the handlers that receive every action
+        self._wildcard = tuple(
+            index for index, action_types in enumerate(declared_types) if action_types is None
+        )
+        # the positions of the handlers for each declared action type
+        self._table = {
+            action_type: tuple(
+                index for index, action_types in enumerate(declared_types)
+                if action_types is None or action_type in action_types
+            )
+            for action_type in frozenset().union(*(
+                action_types for action_types in declared_types if action_types is not None
+            ))
+        }
+        # whether each handler takes batches
+        self._batched = tuple(accepts_batches(handler) for handler in self.handlers)
+
+    def handlers_for(self, action_type):
+        """ Return the handlers for the given type of action, in order. """
+        return tuple(self.handlers[index] for index in self._table.get(action_type, self._wildcard))
+
+    def bind(self, actions):
+        """
+            Yield each handler with a call that passes it the (action_type, payload)
+            tuples routed to it. Handlers are called in order and only if they
+            have something to handle.
+        """
+        # the actions routed to each handler
+        routed = [[] for _ in self.handlers]
+        for action in actions:
+            for index in self._table.get(action[0], self._wildcard):
+                routed[index].append(action)
+
+        for handler, batched, handler_actions in zip(self.handlers, self._batched, routed):
+            # if the handler takes batches, it gets all of its actions at once
+            if batched:
+                if handler_actions:
+                    yield handler, functools.partial(handler, handler_actions)
+            # otherwise it gets them one at a time
+            else:
+                for action_type, payload in handler_actions:
+                    yield handler, functools.partial(handler, action_type, payload)
+
+
 def combine_action_handlers(*args):
     """
         This function combines the given action handlers into a single function
-        which will call all of them.
+        which routes each action to the handlers interested in it (see
+        ActionRouter). If every handler takes batches (or doesn't handle any
+        actions at all), so does the combined handler. If any of the handlers
+        is a coroutine function, the combined handler is one too (and runs the
+        synchronous handlers in the event loop's default executor). When handlers only fail some of their
+        actions (see ActionsFailed), the rest of the handlers still run and
+        the failures are raised together at the end.
     """
+    # whether the combined handler takes batches (handlers that declared they
+    # don't handle anything never get called so they don't get a say)
+    batched = bool(args) and all(
+        accepts_batches(handler) or action_types_for(handler) == frozenset()
+        for handler in args
+    )
+    # whether the combined handler has to be awaited
+    asynchronous = any(asyncio.iscoroutinefunction(handler) for handler in args)
+    # the table that sends each action to its handlers
+    router = ActionRouter(args)
+
+    # if some of the handlers are coroutines
+    if asynchronous:
+        async def call_handlers(actions):
+            loop = asyncio.get_event_loop()
+            # the actions the handlers failed to handle
+            failures = []
+            # goes over every handler interested in the actions
+            for handler, call in router.bind(actions):
+                try:
+                    # wait for the handler without blocking the loop
+                    if asyncio.iscoroutinefunction(handler):
+                        await call()
+                    else:
+                        await loop.run_in_executor(None, call)
+                # if the handler only failed some of its actions
+                except ActionsFailed as err:
+                    failures.extend(err.failures)
+
+            if failures:
+                raise ActionsFailed(failures)
+    else:
+        def call_handlers(actions):
+            # the actions the handlers failed to handle
+            failures = []
+            # goes over every handler interested in the actions
+            for handler, call in router.bind(actions):
+                try:
+                    # call the handler
+                    call()
+                # if the handler only failed some of its actions
+                except ActionsFailed as err:
+                    failures.extend(err.failures)
+
+            if failures:
+                raise ActionsFailed(failures)
+
     # the combined action handler
-    def combinedActionHandler(action_type, payload):
-        # goes over every given handler
-        for handler in args:
-            # call the handler
-            handler(action_type, payload)
+    if batched and asynchronous:
+        async def combinedActionHandler(actions):
+            await call_handlers(actions)
+    elif batched:
+        def combinedActionHandler(actions):
+            call_handlers(actions)
+    elif asynchronous:
+        async def combinedActionHandler(action_type, payload):
+            await call_handlers([(action_type, payload)])
+    else:
+        def combinedActionHandler(action_type, payload):
+            call_handlers([(action_type, payload)])
+
+    # if every handler takes batches
+    if batched:
+        combinedActionHandler.batched = True
+    # make the routing table available for inspection
+    combinedActionHandler.router = router
+
+    # the action types handled by each handler
+    declared_types = [action_types_for(handler) for handler in args]
+    # if every handler declared the actions it handles
+    if None not in declared_types:
+        # the combined handler handles all of them
+        combinedActionHandler.action_types = frozenset().union(*declared_types)
+
+    # the fields each handler uses to identify records
+    declared_fields = [partition_fields_for(handler) for handler in args]
+    # the handlers that care about the order of their actions
+    ordered_fields = {fields for fields in declared_fields if fields}
+    # if every handler declared its fields and the ones that care agree on them
+    if None not in declared_fields and len(ordered_fields) <= 1:
+        combinedActionHandler.partition_fields = ordered_fields.pop() if ordered_fields else ()
+
+    # the actions that can apply to several records for any of the handlers do for all of them
+    combinedActionHandler.multi_record_types = frozenset().union(*(
+        multi_record_types_for(handler) for handler in args
+    ))
 
     # return the combined action handler
     return combinedActionHandler
-
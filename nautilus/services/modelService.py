@@ -4,6 +4,7 @@ from nautilus.api import create_model_schema
 from nautilus.conventions.services import model_service_name
 from nautilus.network.actionHandlers import noop_handler
 from nautilus.admin import add_model as add_model_to_admin
+from nautilus.models import OutboxRelay
 from .service import Service
 
 class ModelService(Service):
@@ -14,6 +15,21 @@ class ModelService(Service):
         finished (whether successfully or not). The external API is
         automatically generated to match the given model.
 
+        If the model publishes its events through the outbox (`use_outbox = True`),
+        the service runs a relay that drains the outbox while it is up. The
+        OUTBOX_BATCH_SIZE, OUTBOX_INTERVAL and OUTBOX_CLAIM_TIMEOUT config keys
+        tune the relay.
+
+        The CRUD handler takes batches, so the actions that arrive within
+        CONSUMER_BATCH_DELAY milliseconds of each other (up to CONSUMER_BATCH_SIZE
+        of them) are applied together and the records they create are written
+        in a single transaction.
+
+        To run several replicas of the service, set CONSUMER_SHARED_QUEUE in
+        the config: the replicas then share a durable queue named after the
+        service (see nautilus.conventions.services.model_service_name) so
+        each action is applied by only one of them.
+
         Args:
             model (nautilus.BaseModel): The nautilus model to manage.
             additonal_action_handler (optional, function): An action handler
@@ -71,6 +87,16 @@ class ModelService(Service):
             **kwargs
         )
 
+        # if the model publishes its events through the outbox
+        if getattr(model, 'use_outbox', False):
+            # relay them from the service
+            self.outbox_relay = OutboxRelay(
+                self.app,
+                batch_size=self.app.config.get('OUTBOX_BATCH_SIZE'),
+                interval=self.app.config.get('OUTBOX_INTERVAL'),
+                claim_timeout=self.app.config.get('OUTBOX_CLAIM_TIMEOUT'),
+            )
+
     def run(self, **kwargs):
 
         # register the class with the admin interface
@@ -1,10 +1,25 @@
 # external imports
+import asyncio
+import logging
+import multiprocessing
 import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
 import requests
-from flask import Flask
+from flask import Flask, jsonify
 # local imports
-from nautilus.network.consumers import ActionConsumer
+from nautilus.network.consumers import ActionConsumer, AsyncActionConsumer
 from nautilus.network import registry
+from nautilus.network.dispatch import configure_dispatch, flush_actions, close_publisher
+from nautilus.network.metrics import merge_snapshots
+from nautilus.network.publishers import BatchPublisher
+from nautilus.network.transports import get_transport
+
+LOGGER = logging.getLogger(__name__)
 
 class Service:
     """
@@ -78,6 +93,17 @@ class Service:
         self.auto_register = auto_register
         self.auth = auth
         self.subprocesses = []
+        # the thread running the action consumer of an in-process transport
+        self.consumer_thread = None
+        self._stopping = threading.Event()
+        # the queue consumer processes send their metrics over
+        self._metrics_queue = None
+        # the thread collecting the metrics of the consumer processes
+        self.metrics_thread = None
+        # the time and latest metrics of each consumer process, by pid
+        self.consumer_metrics = {}
+        # the relay that publishes the actions in the outbox, if there is one
+        self.outbox_relay = None
 
         # apply any necessary flask app config
         self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
@@ -87,14 +113,93 @@ class Service:
             # apply the config object to the flask app
             self.app.config.from_object(configObject)
 
+        # the transport actions travel over
+        self.transport = get_transport(self.app.config.get('TRANSPORT'))
+
+        # coroutine handlers are consumed on an event loop
+        consumer_class = AsyncActionConsumer if asyncio.iscoroutinefunction(action_handler) \
+                                             else ActionConsumer
         # if there is an action consumer, create a wrapper for it
-        self.action_consumer = ActionConsumer(action_handler=action_handler) \
-                                                  if action_handler else None
+        self.action_consumer = consumer_class(
+            action_handler=action_handler,
+            exchange_type=self.app.config.get('ACTION_EXCHANGE_TYPE'),
+            transport=self.transport,
+            # the number of unacknowledged actions the broker will send at once
+            prefetch_count=self.app.config.get('CONSUMER_PREFETCH_COUNT'),
+            # the number of actions that can be handled at once
+            concurrency=self.app.config.get('CONSUMER_CONCURRENCY'),
+            # the way actions are grouped for handlers that take batches
+            batch_size=self.app.config.get('CONSUMER_BATCH_SIZE'),
+            batch_delay=self.app.config.get('CONSUMER_BATCH_DELAY'),
+            # the milliseconds to wait before each retry of a failed action
+            retry_delays=self.app.config.get('CONSUMER_RETRY_DELAYS'),
+            # the record of the actions that have been handled already
+            idempotency_cache=self.idempotency_cache(),
+            # the queue the service reads actions from (and failed actions come back to)
+            **self.consumer_queue()
+        ) if action_handler else None
         # setup various functionalities
+        self.setup_dispatch()
         self.setup_db()
         self.setup_admin()
         self.setup_auth()
         self.setup_api(schema)
+        self.setup_metrics()
+
+
+    def consumer_queue(self):
+        """
+            Return the options for the queue the action consumer reads from.
+            If the CONSUMER_SHARED_QUEUE config key is set, every replica of
+            the service reads from a durable queue named after the service so
+            the replicas split the actions between them (other services still
+            get a copy of their own) and failed actions come back to whichever
+            replica is around. Otherwise the consumer processes of this
+            instance share a durable queue named after the service and
+            CONSUMER_INSTANCE (the host name by default), so the actions that
+            arrive while the instance restarts are waiting for it when it comes
+            back. Instances that run side by side on one host need a
+            CONSUMER_INSTANCE of their own, and the queue of an instance that
+            is retired for good has to be deleted by hand.
+        """
+        # if the service is scaled out over several replicas
+        if self.app.config.get('CONSUMER_SHARED_QUEUE'):
+            return {'queue': self.name, 'durable': True, 'service': self.name}
+        # if the consumer runs on a thread, it doesn't share its queue
+        elif self.transport.in_process:
+            return {}
+        # consumer processes share a queue of their own, which outlives any one of them.
+        # failed actions come back to it by its name so the other instances don't see them
+        else:
+            instance = self.app.config.get('CONSUMER_INSTANCE') or socket.gethostname()
+            return {'queue': '{}-{}'.format(self.name, instance), 'durable': True}
+
+
+    def idempotency_cache(self):
+        """
+            Return the cache the action consumer uses to skip the actions it
+            has handled before. CONSUMER_IDEMPOTENCY_SIZE sets the number of
+            action ids kept in memory. If CONSUMER_IDEMPOTENCY_STORE is set,
+            the ids are also recorded in the service's database so every
+            consumer process (and replica) shares them, for
+            CONSUMER_IDEMPOTENCY_RETENTION seconds (a week by default). The
+            ids are recorded once the handler returns, so an action can still
+            be handled twice if the consumer dies in between.
+        """
+        from nautilus.network import IdempotencyCache
+
+        # if the ids should outlive the process
+        if self.app.config.get('CONSUMER_IDEMPOTENCY_STORE'):
+            from nautilus.models import DatabaseIdempotencyStore
+            store = DatabaseIdempotencyStore(
+                self.app,
+                self.name,
+                retention=self.app.config.get('CONSUMER_IDEMPOTENCY_RETENTION'),
+            )
+        else:
+            store = None
+
+        return IdempotencyCache(size=self.app.config.get('CONSUMER_IDEMPOTENCY_SIZE'), store=store)
 
 
     def run(self,
@@ -104,57 +209,250 @@ class Service:
             secret_key='supersecret',
             **kwargs
            ):
-
+        """
+            Run the service until the server is stopped. Actions are consumed
+            by CONSUMER_PROCESSES (1 by default) processes that share the
+            service's queue. They are forked by a supervisor process, which
+            replaces the ones that crash. The supervisor is forked before the
+            service starts any threads (and doesn't start any of its own) so
+            the consumer processes don't inherit locks held by other threads.
+        """
         # save command line arguments
         self.app.config['DEBUG'] = debug
         self.app.config['HOST'] = host
         self.app.config['PORT'] = port
         self.app.config['SECRET_KEY'] = secret_key
 
-        # don't assume we are going to spawn a subprocess
-        pid = None
-
-        # if we need to spin up an action consumer
-        if self.action_consumer:
-            # create a subprocess
-            self.subprocesses.append(os.fork())
-            # if we are on the subprocess
-            if self.subprocesses[-1] == 0:
-                # start the action consumer
-                self.action_consumer.run()
-                # when we're done with what we're doing
-                raise SystemExit(0)
-
-            # if the service needs to register itself
-            if self.auto_register:
-                # register with the service registry
-                registry.keep_alive(self)
-
-            # run the service at the designated port
-            self.app.run(
-                host=self.app.config['HOST'],
-                port=self.app.config['PORT'],
-                use_reloader=False
-            )
+        # if the action consumer has to share the process with the publishers
+        if self.action_consumer and self.transport.in_process:
+            # run it on a background thread instead
+            self.consumer_thread = threading.Thread(target=self.action_consumer.run)
+            self.consumer_thread.daemon = True
+            self.consumer_thread.start()
+
+        # if we need to spin up action consumers
+        elif self.action_consumer:
+            self._stopping.clear()
+            # the subprocesses report their metrics to us (the queue has to exist before they fork)
+            self._metrics_queue = multiprocessing.Queue()
+            # fork the process that looks after the consumers while we are still single threaded
+            self.subprocesses.append(self.start_supervisor_process())
+            self.metrics_thread = threading.Thread(target=self.collect_metrics)
+            self.metrics_thread.daemon = True
+            self.metrics_thread.start()
+
+        # if the service publishes actions from an outbox
+        if self.outbox_relay:
+            # start draining it (after forking so the child doesn't share the thread)
+            self.outbox_relay.start()
+
+        # if the service needs to register itself
+        if self.auto_register:
+            # register with the service registry
+            registry.keep_alive(self)
+
+        # run the service at the designated port
+        self.app.run(
+            host=self.app.config['HOST'],
+            port=self.app.config['PORT'],
+            use_reloader=False
+        )
+
+        # app.run is blocking while the server is running.
+        # the lines afterwards are executed when the server stops so it is a
+        # perfect time to clean up and ensure no leaks
+        self.stop()
+
+
+    def start_supervisor_process(self):
+        """ Fork the process that runs the consumer processes, returning its pid. """
+        pid = os.fork()
+        # if we are on the parent
+        if pid != 0:
+            return pid
+
+        # the supervisor only owns the consumer processes it starts
+        self.subprocesses = []
+        parent = os.getppid()
+
+        status = 0
+        try:
+            # create the consumer processes
+            for _ in range(self.app.config.get('CONSUMER_PROCESSES') or 1):
+                self.subprocesses.append(self.start_consumer_process())
+            # and keep an eye on them
+            self.supervise_consumers(parent)
+        # the parent interrupts us when it stops
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            LOGGER.exception('Consumer supervisor crashed')
+            status = 1
+        finally:
+            # don't let another interrupt cut the shutdown short
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.stop_consumer_processes()
+
+        # leave without running any of the parent's cleanup
+        logging.shutdown()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+    def start_consumer_process(self):
+        """ Fork a process that runs the action consumer, returning its pid. """
+        pid = os.fork()
+        # if we are on the parent
+        if pid != 0:
+            return pid
+
+        # the subprocess doesn't own any of its parent's children
+        self.subprocesses = []
+        # send our metrics to the service every so often
+        reporter = threading.Thread(target=self.report_metrics)
+        reporter.daemon = True
+        reporter.start()
+
+        status = 0
+        try:
+            # start the action consumer
+            self.action_consumer.run()
+        # the supervisor interrupts us when it stops
+        except KeyboardInterrupt:
+            # let the running handlers finish and settle their actions
+            self.action_consumer.stop()
+        # if the consumer died, let the supervisor know so it can start another one
+        except Exception:
+            LOGGER.exception('Action consumer crashed')
+            status = 1
+        finally:
+            # send any actions the handlers left behind
+            close_publisher()
+
+        # leave without running any of the supervisor's cleanup
+        logging.shutdown()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+    def supervise_consumers(self, parent, interval=1):
+        """ Replace the consumer processes that crash until the service goes away. """
+        while os.getppid() == parent:
+            time.sleep(interval)
+            for pid in list(self.subprocesses):
+                try:
+                    # check on the process without waiting for it
+                    exited, status = os.waitpid(pid, os.WNOHANG)
+                # if the process was collected by someone else
+                except ChildProcessError:
+                    exited, status = pid, 0
+
+                # if the process is still running
+                if not exited:
+                    continue
+
+                self.subprocesses.remove(pid)
+                # if the process left because it was asked to
+                if status == 0:
+                    continue
+
+                LOGGER.warning('Consumer process %s exited with status %s, restarting it', pid,
+                               os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status))
+                self.subprocesses.append(self.start_consumer_process())
+
+
+    def stop_consumer_processes(self):
+        """ Interrupt every process we started and wait for them to exit. """
+        # interrupt every process so they shut down together
+        for pid in self.subprocesses:
+            try:
+                os.kill(pid, signal.SIGINT)
+            # if the process is already gone
+            except ProcessLookupError:
+                pass
+        # and collect their statuses so we don't create zombies
+        for pid in self.subprocesses:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.subprocesses = []
+
+
+    def report_metrics(self):
+        """ Send the metrics of this consumer process to the service until the process exits. """
+        interval = self.metrics_interval()
+        while True:
+            self._metrics_queue.put((os.getpid(), self.action_consumer.metrics_snapshot()))
+            time.sleep(interval)
 
-            # app.run is blocking while the server is running.
-            # the lines afterwards are executed when the server stops so it is a
-            # perfect time to clean up and ensure no leaks
-            self.stop()
+
+    def collect_metrics(self):
+        """ Keep the latest metrics sent by each consumer process until the service stops. """
+        while not self._stopping.is_set():
+            try:
+                pid, snapshot = self._metrics_queue.get(timeout=1)
+            # if nobody had anything to say
+            except queue.Empty:
+                continue
+            self.consumer_metrics[pid] = (time.monotonic(), snapshot)
+
+
+    def metrics_interval(self):
+        """ The number of seconds between the reports of the consumer processes. """
+        return self.app.config.get('CONSUMER_METRICS_INTERVAL') or 5
+
+
+    def metrics(self):
+        """
+            Return the metrics of the action consumer (see
+            nautilus.network.consumers.ActionConsumer.metrics_snapshot) of every
+            consumer process, along with their total.
+        """
+        # if the consumer runs in this process, we can ask it directly
+        if self.consumer_thread:
+            processes = {os.getpid(): self.action_consumer.metrics_snapshot()}
+        # otherwise use the latest reports of the processes that are still around (the
+        # ones that stopped reporting have exited)
+        else:
+            cutoff = time.monotonic() - 3 * self.metrics_interval()
+            processes = {
+                pid: snapshot for pid, (reported, snapshot) in list(self.consumer_metrics.items())
+                if reported >= cutoff
+            }
+
+        return {
+            'processes': {str(pid): snapshot for pid, snapshot in processes.items()},
+            'total': merge_snapshots(processes.values()),
+        }
 
 
     def stop(self):
         try:
-            # for each subprocess id we know about
-            for pid in self.subprocesses:
-                # if its a child process
-                if pid != 0:
-                    # send a sigterm to the child process
-                    os.kill(pid, 2)
-                    # collect the status so we don't create a zombie
-                    status, sub_pid = os.waitpid(pid, 0)
-                    # remove the subprocess from the list
-                    self.subprocesses.remove(pid)
+            self._stopping.set()
+            if self.metrics_thread:
+                self.metrics_thread.join()
+                self.metrics_thread = None
+
+            # stop the consumer processes (through their supervisor)
+            self.stop_consumer_processes()
+
+            # if the action consumer is running on a thread
+            if self.consumer_thread:
+                # wait for it to cancel its consumer and close its connection
+                self.action_consumer.stop_threadsafe()
+                self.consumer_thread.join()
+                self.consumer_thread = None
+
+            # stop publishing from the outbox
+            if self.outbox_relay:
+                self.outbox_relay.stop()
+
+            # send any buffered actions and close the connections used to dispatch them
+            flush_actions()
+            close_publisher()
 
             # if the service is responsible for registering itself
             if self.auto_register:
@@ -166,6 +464,94 @@ class Service:
             pass
 
 
+    def setup_dispatch(self):
+        """
+            Configure the way this process publishes actions. The following
+            keys of the service config are recognized:
+
+                TRANSPORT: 'amqp' (the default) to send actions through
+                    RabbitMQ or 'memory' to send them through a broker that
+                    lives in the current process (see nautilus.network.transports).
+                ACTION_EXCHANGE_TYPE: 'fanout' (the default) to send every action
+                    to every service or 'topic' to only send actions to the
+                    services that handle their type. This also decides which
+                    exchange the service's consumer listens to, so every service
+                    in the cloud should use the same value.
+                DISPATCH_CODEC: The content type of the codec used to encode
+                    actions (see nautilus.network.codecs).
+                DISPATCH_COMPRESS_THRESHOLD: Compress action bodies of at least
+                    this many bytes.
+                DISPATCH_POOL_SIZE: The number of connections to keep open.
+                DISPATCH_BATCH_SIZE: Buffer actions until this many are waiting.
+                DISPATCH_BATCH_BYTES: Buffer actions until their bodies take up
+                    this many bytes.
+                DISPATCH_BATCH_DELAY: Never buffer an action for longer than
+                    this many milliseconds.
+                DISPATCH_CONFIRM: Wait for the broker to confirm each action.
+                DISPATCH_CONFIRM_WINDOW: The number of actions that can be
+                    waiting on a confirmation at once.
+                DISPATCH_CONFIRM_TIMEOUT: The number of seconds to wait for a
+                    confirmation.
+
+            Actions are only buffered if one of the DISPATCH_BATCH_* keys is set.
+            When confirms are enabled, actions are sent over a single connection
+            and DISPATCH_POOL_SIZE is ignored.
+        """
+        config = self.app.config
+
+        # if the service routes actions through a different exchange
+        if config.get('ACTION_EXCHANGE_TYPE'):
+            configure_dispatch(exchange_type=config['ACTION_EXCHANGE_TYPE'])
+
+        # if the service does not customize the way actions are published
+        if not config.get('TRANSPORT') and not any(key.startswith('DISPATCH_') for key in config):
+            # use the defaults
+            return
+
+        # the factory for the publisher
+        def publisher():
+            # ask the transport for a publisher
+            publisher = self.transport.publisher(
+                pool_size=config.get('DISPATCH_POOL_SIZE'),
+                confirm=config.get('DISPATCH_CONFIRM', False),
+                window=config.get('DISPATCH_CONFIRM_WINDOW'),
+                timeout=config.get('DISPATCH_CONFIRM_TIMEOUT'),
+            )
+
+            # if actions should be sent in batches
+            if any(key.startswith('DISPATCH_BATCH_') for key in config):
+                # buffer them in front of the pool
+                publisher = BatchPublisher(
+                    publisher=publisher,
+                    max_count=config.get('DISPATCH_BATCH_SIZE'),
+                    max_bytes=config.get('DISPATCH_BATCH_BYTES'),
+                    max_delay=config.get('DISPATCH_BATCH_DELAY'),
+                )
+
+            return publisher
+
+        # use the publisher for every action dispatched by this process
+        configure_dispatch(
+            publisher=publisher,
+            async_publisher=self.transport.async_publisher,
+            codec=config.get('DISPATCH_CODEC'),
+            compress_threshold=config.get('DISPATCH_COMPRESS_THRESHOLD'),
+        )
+
+
+    def setup_metrics(self):
+        """
+            Serve the metrics of the action consumer at /metrics. Consumer
+            processes report their metrics every CONSUMER_METRICS_INTERVAL
+            seconds (5 by default).
+        """
+        # if there is nothing to measure
+        if not self.action_consumer:
+            return
+
+        self.app.add_url_rule('/metrics', 'consumer_metrics', lambda: jsonify(self.metrics()))
+
+
     def setup_db(self):
         # import the nautilus db configuration
         from nautilus.db import db
@@ -29,6 +29,30 @@ class ServiceManager:
             """ Start the service. """
             service.run(host = host, port = int(port), debug = debug, secretKey = secretKey)
 
+        @self.commandManager.command
+        def dead_letters(limit = 20):
+            """ List the actions waiting in the dead-letter queue. """
+            from nautilus.network import ActionConsumer
+            from nautilus.network.deadLetters import inspect_dead_letters
+            # look at the dead actions without taking them out of the queue
+            actions = inspect_dead_letters(ActionConsumer.MESSAGE_URL, limit = int(limit))
+            for action in actions:
+                print("{type} from {service} after {retries} retries: {error}".format(**action))
+                print("    {}".format(action['payload']))
+            print("{} dead action(s) shown.".format(len(actions)))
+
+        @self.commandManager.command
+        def replay_dead_letters(limit = None, service = None):
+            """ Send the actions in the dead-letter queue back to the services they came from. """
+            from nautilus.network import ActionConsumer
+            from nautilus.network.deadLetters import replay_dead_letters
+            replayed = replay_dead_letters(
+                ActionConsumer.MESSAGE_URL,
+                limit = int(limit) if limit else None,
+                service = service
+            )
+            print("Replayed {} dead action(s).".format(replayed))
+
 
     def run(self):
         """ run the command manager """
@@ -0,0 +1,86 @@
+import unittest
+
+class TestService(unittest.TestCase):
+
+    def service(self, **config):
+        """ Return a service with an action consumer and the given config. """
+        # local imports
+        from nautilus import Service
+
+        return Service(
+            name='foo',
+            action_handler=lambda action_type, payload: None,
+            auth=False,
+            configObject=type('Config', (object,), config),
+        )
+
+    def test_consumer_processes_share_a_queue_that_survives_restarts(self):
+        first = self.service(CONSUMER_INSTANCE='bar').action_consumer
+        second = self.service(CONSUMER_INSTANCE='bar').action_consumer
+
+        assert first.QUEUE == second.QUEUE == 'foo-bar', (
+            "A restarted instance did not read from the queue it had before."
+        )
+        assert first.QUEUE_DURABLE and not first.QUEUE_AUTO_DELETE, (
+            "The queue of an instance goes away with its consumers."
+        )
+
+    def test_retries_come_back_to_the_queue_of_the_instance(self):
+        consumer = self.service(CONSUMER_INSTANCE='bar').action_consumer
+        consumer._queue_name = consumer.QUEUE
+
+        assert consumer.service == 'foo-bar', (
+            "Retries of an instance's actions were sent to every instance of the service."
+        )
+
+    def test_replicas_share_a_queue_named_after_the_service(self):
+        consumer = self.service(CONSUMER_SHARED_QUEUE=True).action_consumer
+        consumer._queue_name = consumer.QUEUE
+
+        assert consumer.QUEUE == consumer.service == 'foo'
+        assert consumer.QUEUE_DURABLE
+
+    def test_supervisor_replaces_consumer_processes_that_crash(self):
+        # external imports
+        import multiprocessing
+        import os
+        import signal
+        import tempfile
+        import time
+
+        service = self.service(CONSUMER_PROCESSES=2, CONSUMER_INSTANCE='bar')
+        service._metrics_queue = multiprocessing.Queue()
+        # every consumer process writes down its pid and waits to be interrupted
+        started = tempfile.NamedTemporaryFile()
+        def run():
+            with open(started.name, 'a') as pids:
+                pids.write('{}\n'.format(os.getpid()))
+            time.sleep(30)
+        service.action_consumer.run = run
+        service.action_consumer.stop = lambda: None
+
+        def consumers(count):
+            """ Wait for the given number of consumer processes to start. """
+            for _ in range(200):
+                with open(started.name) as pids:
+                    pids = [int(pid) for pid in pids.read().split()]
+                if len(pids) >= count:
+                    return pids
+                time.sleep(0.01)
+            return pids
+
+        supervisor = service.start_supervisor_process()
+        service.subprocesses = [supervisor]
+        try:
+            first, second = consumers(2)
+            # one of the consumers crashes
+            os.kill(first, signal.SIGKILL)
+            assert len(consumers(3)) == 3, (
+                "Supervisor did not replace the consumer process that crashed."
+            )
+        finally:
+            service.stop_consumer_processes()
+
+        for pid in consumers(3):
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
@@ -33,7 +33,8 @@ setup(
         'jinja2',
         'sqlalchemy',
         'nose2',
-        'pika',
+        # the connections and channels use the callback-first api of pika 0.x
+        'pika>=0.12,<1.0',
         'python-consul',
         'singledispatch',
         'wtforms',